@@ -0,0 +1,91 @@
+'''Measures the time to read the all link database of a device, one record
+per read against all of the records in one read, on the pty emulator.
+
+The emulator holds one device with RECORD_COUNT aldb records, HOPS hops
+away.  The aldb of the device is read one record at a time and then in
+bulk, and each scan runs until the query ends.  A loss rate above 0 drops
+that share of the records the device sends, which the bulk download reads
+again one at a time.
+
+    python bench_aldb.py [record count] [hops] [loss rate]
+'''
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import time
+
+import env
+from insteon.core import Insteon_Core
+from insteon.emulator import PLM_Emulator, Emulated_Device
+
+RECORD_COUNT = 100
+HOPS = 1
+# The address the aldb records of the device link to
+ID_BYTES = bytes.fromhex('20F5F5')
+
+
+def build(record_count, hops, loss_rate):
+    records = [bytes([0xA2, i % 256]) + ID_BYTES + bytes(3)
+               for i in range(record_count)]
+    device = Emulated_Device('100000', hops=hops, aldb_records=records,
+                             aldb_loss_rate=loss_rate)
+    emulator = PLM_Emulator(devices=[device], seed=1)
+    emulator.start()
+    core = Insteon_Core()
+    plm = core.add_plm(attributes=emulator.plm_attributes(),
+                       device_id=emulator.plm_id)
+    # Finish the aldb query and the device init
+    end = time.time() + 5
+    while plm.next_deadline() is not None and time.time() < end:
+        core.run_once(timeout=0.05)
+    return emulator, core, plm
+
+
+def scan(core, device, bulk, timeout):
+    start = time.time()
+    device._aldb.query_aldb(bulk=bulk)
+    while device.state_pending('query_aldb') and time.time() < start + timeout:
+        core.run_once(timeout=0.05)
+    return time.time() - start
+
+
+def main():
+    record_count = RECORD_COUNT
+    hops = HOPS
+    loss_rate = 0.0
+    if len(sys.argv) > 1:
+        record_count = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        hops = int(sys.argv[2])
+    if len(sys.argv) > 3:
+        loss_rate = float(sys.argv[3])
+    os.chdir(tempfile.mkdtemp())
+    with contextlib.redirect_stdout(io.StringIO()):
+        emulator, core, plm = build(record_count, hops, loss_rate)
+        device = plm.get_device_by_addr('100000')
+        timings = []
+        for bulk in (False, True):
+            before = device._aldb.stats
+            elapsed = scan(core, device, bulk, record_count * 5)
+            stats = device._aldb.stats
+            for key in stats:
+                stats[key] -= before[key]
+            timings.append((bulk, elapsed,
+                            len(device._aldb.get_all_records()), stats))
+    print('{} records, {} hops, {:.0%} lost'.format(record_count, hops,
+                                                    loss_rate))
+    for bulk, elapsed, records, stats in timings:
+        print('{:6}: {:3} records in {:6.1f} s, {:5.1f} records/s, {} '
+              'streamed, {} refetched, {} stalls'.format(
+                  'bulk' if bulk else 'single', records, elapsed,
+                  records / elapsed, stats['streamed'], stats['refetched'],
+                  stats['stalls']))
+    print('emulator', emulator.stats)
+    core.close()
+    emulator.stop()
+
+
+if __name__ == '__main__':
+    main()
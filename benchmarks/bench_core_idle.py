@@ -0,0 +1,110 @@
+'''Compares the cpu used and the input latency of the ways to run the core.
+
+The plm is connected to a pseudo terminal, standing in for the serial port.
+After the startup messages have timed out the core is left idle, except for
+a message written to the terminal every 50 ms, as if a device was sending
+it.  The messages are written from a separate process so that the writer
+does not compete with the core for the GIL.  The latency is the time from
+writing the message to it reaching process_inc_msg.
+'''
+import contextlib
+import io
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
+
+import env
+from insteon.core import Insteon_Core
+
+RUN_TIME = 2
+MSG = bytes.fromhex('02501CB58720F5F5412B00')
+
+
+def build_core():
+    master, slave = os.openpty()
+    core = Insteon_Core()
+    plm = core.add_plm(port=os.ttyname(slave), device_id='20F5F5')
+    arrivals = []
+    process_inc_msg = plm.process_inc_msg
+
+    def record_arrival(raw_msg):
+        arrivals.append(time.perf_counter())
+        process_inc_msg(raw_msg)
+    plm.process_inc_msg = record_arrival
+    # Let the startup messages time out
+    end = time.time() + 1
+    while time.time() < end:
+        core.run_once(timeout=0.05)
+        drain(master)
+    return core, master, arrivals
+
+
+def drain(master):
+    os.set_blocking(master, False)
+    try:
+        os.read(master, 4096)
+    except BlockingIOError:
+        pass
+
+
+def send_msgs(master, conn, end):
+    sent = []
+    while time.perf_counter() < end:
+        time.sleep(0.05)
+        sent.append(time.perf_counter())
+        os.write(master, MSG)
+    conn.send(sent)
+
+
+def spin(core, end):
+    while time.perf_counter() < end:
+        core.loop_once()
+
+
+def poll(core, end):
+    while time.perf_counter() < end:
+        core.loop_once()
+        time.sleep(0.01)
+
+
+def run_forever(core, end):
+    timer = threading.Timer(end - time.perf_counter(), core.stop)
+    timer.start()
+    core.run_forever()
+
+
+def measure(name, runner):
+    core, master, arrivals = build_core()
+    del arrivals[:]
+    end = time.perf_counter() + RUN_TIME
+    conn, child_conn = multiprocessing.Pipe()
+    sender = multiprocessing.Process(target=send_msgs,
+                                     args=(master, child_conn, end))
+    cpu_start = time.process_time()
+    sender.start()
+    runner(core, end)
+    cpu = time.process_time() - cpu_start
+    sent = conn.recv()
+    sender.join()
+    count = min(len(sent), len(arrivals))
+    latencies = sorted(arrivals[i] - sent[i] for i in range(count))
+    return ('{:12}: cpu {:5.1f}% of a core, latency median {:7.1f} us, '
+            'max {:7.1f} us'.format(
+                name, cpu / RUN_TIME * 100,
+                latencies[count // 2] * 1000000, latencies[-1] * 1000000))
+
+
+def main():
+    os.chdir(tempfile.mkdtemp())
+    for name, runner in (('loop_once', spin),
+                         ('10 ms poll', poll),
+                         ('run_forever', run_forever)):
+        with contextlib.redirect_stdout(io.StringIO()):
+            result = measure(name, runner)
+        print(result)
+
+
+if __name__ == '__main__':
+    main()
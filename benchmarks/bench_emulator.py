@@ -0,0 +1,110 @@
+'''Measures the command throughput and latency of a PLM driven end to end
+against the pty emulator.
+
+The emulator holds DEVICE_COUNT devices.  A third of them are one hop
+away and a third two hops away, each repeating its acks once, and the
+rest answer directly.  Every device has a small random ack latency.  The
+messages queued by the device init steps are dropped, then COMMAND_COUNT
+on commands are queued on random devices and the core runs until every
+command is acked.  The latency of a command is from it being queued to
+its ack, so it includes the time spent waiting behind the commands queued
+before it.  An in flight window larger than 1 lets commands to other
+devices go out while a device ack is still awaited.
+
+    python bench_emulator.py [device count] [command count] [window]
+'''
+import contextlib
+import io
+import os
+import random
+import sys
+import tempfile
+import time
+
+import env
+from insteon.core import Insteon_Core
+from insteon.emulator import PLM_Emulator, Emulated_Device
+
+DEVICE_COUNT = 1000
+COMMAND_COUNT = 100
+
+
+def build(device_count, seed):
+    rand = random.Random(seed)
+    devices = []
+    for i in range(device_count):
+        hops = i % 3
+        devices.append(Emulated_Device('{:06X}'.format(0x100000 + i),
+                                       hops=hops,
+                                       duplicates=1 if hops else 0,
+                                       ack_latency=rand.uniform(0, 0.02)))
+    emulator = PLM_Emulator(devices=devices, seed=seed)
+    emulator.start()
+    core = Insteon_Core()
+    plm = core.add_plm(attributes=emulator.plm_attributes(),
+                       device_id=emulator.plm_id)
+    # Finish the aldb query, then drop the device init messages
+    end = time.time() + 5
+    while plm.state_pending('query_aldb') and time.time() < end:
+        core.run_once(timeout=0.05)
+    while plm.send_scheduler.next_device() is not None:
+        plm.send_scheduler.next_device().pop_device_queue()
+    core.run_once(timeout=1)
+    return emulator, core, plm
+
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def main():
+    device_count = DEVICE_COUNT
+    command_count = COMMAND_COUNT
+    if len(sys.argv) > 1:
+        device_count = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        command_count = int(sys.argv[2])
+    window = 1
+    if len(sys.argv) > 3:
+        window = int(sys.argv[3])
+    os.chdir(tempfile.mkdtemp())
+    rand = random.Random(1)
+    with contextlib.redirect_stdout(io.StringIO()):
+        emulator, core, plm = build(device_count, 1)
+        plm.in_flight_window = window
+        devices = plm.get_all_devices()
+        start = time.time()
+        futures = []
+        for i in range(command_count):
+            device = rand.choice(devices)
+            futures.append(device.send_command('on'))
+        pending = core.run_until_complete(futures,
+                                          timeout=command_count * 2)
+        elapsed = time.time() - start
+    failed = [future for future in futures
+              if not future.done() or future.exception() is not None]
+    latencies = sorted(future.latency for future in futures
+                       if future.done() and future.exception() is None)
+    send_latencies = sorted(future.send_latency for future in futures
+                            if future.done() and future.exception() is None)
+    print('{} devices, {} commands, window {}, in {:.1f} s, {:.1f} '
+          'commands/s, {} failed, {} not done'.format(
+              device_count, command_count, window, elapsed,
+              command_count / elapsed, len(failed), len(pending)))
+    for name, values in (('queued to ack', latencies),
+                         ('sent to ack', send_latencies)):
+        if not values:
+            continue
+        print('{:14}: p50 {:7.1f} ms, p90 {:7.1f} ms, p99 {:7.1f} ms, '
+              'max {:7.1f} ms'.format(
+                  name, percentile(values, 0.5) * 1000,
+                  percentile(values, 0.9) * 1000,
+                  percentile(values, 0.99) * 1000, values[-1] * 1000))
+    print('emulator', emulator.stats)
+    print('pacer', plm.pacer.stats)
+    core.close()
+    emulator.stop()
+
+
+if __name__ == '__main__':
+    main()
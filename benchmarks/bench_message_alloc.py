@@ -0,0 +1,77 @@
+'''Counts the buffer copies and dictionary builds made while dispatching an
+incoming message.
+
+Each message is an all link cleanup ack from a known device, which runs the
+whole incoming path: building the PLM_Message, the duplicate check, the
+device dispatch and the trigger matching.  Calls to the copy and update
+methods of bytearrays and dicts are counted with a profile hook, then the
+messages are dispatched again without the hook to time them.
+'''
+import collections
+import contextlib
+import io
+import sys
+import time
+
+import env
+from insteon.plm import PLM
+from insteon.base_objects import Trigger
+
+MSG_COUNT = 2000
+
+
+def build_plm():
+    with contextlib.redirect_stdout(io.StringIO()):
+        plm = PLM(None, port='/nonexistent', device_id='20F5F5')
+        plm.add_device('1CB587')
+    for group in range(10):
+        trigger = Trigger({'plm_cmd': 0x51, 'cmd_1': 0x2F, 'usr_3': group})
+        plm._trigger_mngr.add_trigger('bench' + str(group), trigger)
+    return plm
+
+
+def build_msgs():
+    msgs = []
+    for i in range(MSG_COUNT):
+        msgs.append(bytes.fromhex('02501CB58720F5F563110{:01X}'.format(
+            i % 16)) + bytes([i // 16 % 256]))
+    return msgs
+
+
+COUNTED_CALLS = ('bytearray.copy', 'dict.copy', 'dict.update')
+
+
+def count_calls(plm, msgs):
+    counts = collections.Counter()
+
+    def profile(frame, event, arg):
+        if event == 'c_call' and arg.__qualname__ in COUNTED_CALLS:
+            counts[arg.__qualname__] += 1
+
+    sys.setprofile(profile)
+    for raw in msgs:
+        plm.process_inc_msg(bytearray(raw))
+    sys.setprofile(None)
+    return counts
+
+
+def main():
+    plm = build_plm()
+    msgs = build_msgs()
+    half = len(msgs) // 2
+    with contextlib.redirect_stdout(io.StringIO()):
+        counts = count_calls(plm, msgs[:half])
+        start = time.perf_counter()
+        for raw in msgs[half:]:
+            plm.process_inc_msg(bytearray(raw))
+        elapsed = time.perf_counter() - start
+    print('messages dispatched: {}'.format(len(msgs)))
+    for name in COUNTED_CALLS:
+        print('{:>15} calls per message: {:6.1f}'.format(
+            name, counts[name] / half))
+    print('time per message: {:.1f} us'.format(
+        elapsed / (len(msgs) - half) * 1000000))
+
+
+if __name__ == '__main__':
+    main()
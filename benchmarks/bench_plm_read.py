@@ -0,0 +1,76 @@
+'''Compares the byte at a time PLM read path against the bulk read path.
+
+A fake port replays a burst of insteon_received messages, such as the
+cleanup acks that follow an all link broadcast.  Each pass reads everything
+waiting on the port and then removes the messages from the front of the
+read buffer, the same way the framing code does.
+'''
+import time
+import types
+
+import env
+from insteon.plm import PLM
+from insteon.buffer import Read_Buffer
+
+MSG = bytes.fromhex('02501CB58720F5F5212BF5')
+
+
+class Fake_Port(object):
+    '''Returns the burst in chunks, the way a serial port would'''
+
+    def __init__(self, burst, chunk_size):
+        self._burst = burst
+        self._chunk_size = chunk_size
+        self._pos = 0
+        self._available = 0
+        self.read_calls = 0
+
+    def arrive(self):
+        self._available = min(self._available + self._chunk_size,
+                              len(self._burst) - self._pos)
+
+    def inWaiting(self):
+        return self._available
+
+    def read(self, size=1):
+        self.read_calls += 1
+        size = min(size, self._available)
+        data = self._burst[self._pos:self._pos + size]
+        self._pos += size
+        self._available -= size
+        return data
+
+    @property
+    def done(self):
+        return self._pos >= len(self._burst)
+
+
+def run(bulk_read, read_buffer, msg_count, chunk_size):
+    port = Fake_Port(MSG * msg_count, chunk_size)
+    plm = types.SimpleNamespace(port_active=True,
+                                bulk_read=bulk_read,
+                                _serial=port,
+                                _read_buffer=read_buffer)
+    start = time.perf_counter()
+    while not port.done:
+        port.arrive()
+        PLM._read(plm)
+        while len(plm._read_buffer) >= len(MSG):
+            del plm._read_buffer[0:len(MSG)]
+    return time.perf_counter() - start, port.read_calls
+
+
+def main():
+    msg_count = 20000
+    for chunk_size in (11, 64, 512):
+        byte_time, byte_calls = run(False, bytearray(), msg_count, chunk_size)
+        bulk_time, bulk_calls = run(True, Read_Buffer(), msg_count,
+                                    chunk_size)
+        print('chunk size {:4d}: byte at a time {:7.3f}s {:7d} reads, '
+              'bulk {:7.3f}s {:7d} reads, {:5.1f}x faster'.format(
+                  chunk_size, byte_time, byte_calls, bulk_time, bulk_calls,
+                  byte_time / bulk_time))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+'''Measures the latency of interactive commands while devices are
+rescanning their all link database against the pty emulator.
+
+The emulator holds DEVICE_COUNT devices with RECORD_COUNT aldb records
+each.  The aldb query of half the devices is started at once, which
+queues a long run of background reads.  Then COMMAND_COUNT on commands
+are sent COMMAND_INTERVAL seconds apart to random devices at the
+priority given, interactive by default, and the core runs until every
+command is acked.  The latency of a command is from it being queued to
+its ack.  A priority of 2 queues the commands with the background reads,
+in order of time, as every message was queued before the priorities.
+
+A command to a device whose own aldb query has started is sent between
+two reads of the query, at its next safe point.  Those commands are
+reported apart from the commands to devices that are not scanning,
+with the number of times a scan was preempted.
+
+    python bench_priority.py [device count] [record count] [priority]
+'''
+import contextlib
+import io
+import os
+import random
+import sys
+import tempfile
+import time
+
+import env
+from insteon.core import Insteon_Core
+from insteon.emulator import PLM_Emulator, Emulated_Device
+from insteon.message import PRIORITY_INTERACTIVE
+
+DEVICE_COUNT = 20
+RECORD_COUNT = 10
+COMMAND_COUNT = 20
+COMMAND_INTERVAL = 0.5
+# The address the aldb records of the devices link to
+ID_BYTES = bytes.fromhex('20F5F5')
+
+
+def build(device_count, record_count, seed):
+    rand = random.Random(seed)
+    devices = []
+    for i in range(device_count):
+        records = [bytes([0xA2, j]) + ID_BYTES + bytes(3)
+                   for j in range(record_count)]
+        devices.append(Emulated_Device('{:06X}'.format(0x100000 + i),
+                                       ack_latency=rand.uniform(0, 0.02),
+                                       aldb_records=records))
+    emulator = PLM_Emulator(devices=devices, seed=seed)
+    emulator.start()
+    core = Insteon_Core()
+    plm = core.add_plm(attributes=emulator.plm_attributes(),
+                       device_id=emulator.plm_id)
+    # Finish the aldb query, then drop the device init messages
+    end = time.time() + 5
+    while plm.state_pending('query_aldb') and time.time() < end:
+        core.run_once(timeout=0.05)
+    while plm.send_scheduler.next_device() is not None:
+        plm.send_scheduler.next_device().pop_device_queue()
+    core.run_once(timeout=1)
+    return emulator, core, plm
+
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def main():
+    device_count = DEVICE_COUNT
+    record_count = RECORD_COUNT
+    priority = PRIORITY_INTERACTIVE
+    if len(sys.argv) > 1:
+        device_count = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        record_count = int(sys.argv[2])
+    if len(sys.argv) > 3:
+        priority = int(sys.argv[3])
+    os.chdir(tempfile.mkdtemp())
+    rand = random.Random(1)
+    with contextlib.redirect_stdout(io.StringIO()):
+        emulator, core, plm = build(device_count, record_count, 1)
+        devices = plm.get_all_devices()
+        start = time.time()
+        for device in devices[::2]:
+            device._aldb.query_aldb()
+        futures = []
+        for i in range(COMMAND_COUNT):
+            device = rand.choice(devices)
+            scanning = device.state_machine == 'query_aldb'
+            futures.append((device.send_command('on', '', {'cmd_2': i},
+                                                priority), scanning))
+            end = time.time() + COMMAND_INTERVAL
+            while time.time() < end:
+                core.run_once(timeout=end - time.time())
+        core.run_until_complete([future for future, scanning in futures],
+                                timeout=device_count * record_count)
+        while (any(device.state_pending('query_aldb') or
+                   device.state_pending('set_aldb_delta')
+                   for device in devices)
+                and time.time() < start + device_count * record_count):
+            core.run_once(timeout=0.05)
+        elapsed = time.time() - start
+    print('{} devices, {} records, {} commands at priority {}, rescan in '
+          '{:.1f} s'.format(device_count, record_count, COMMAND_COUNT,
+                            priority, elapsed))
+    for name, want in (('idle device', False), ('scanning device', True)):
+        latencies = sorted(future.latency for future, scanning in futures
+                           if scanning == want and future.done() and
+                           future.exception() is None)
+        failed = len([future for future, scanning in futures
+                      if scanning == want]) - len(latencies)
+        if not latencies:
+            continue
+        print('{:16}: {:3} commands, p50 {:7.1f} ms, p99 {:7.1f} ms, '
+              'max {:7.1f} ms, {} failed'.format(
+                  name, len(latencies), percentile(latencies, 0.5) * 1000,
+                  percentile(latencies, 0.99) * 1000, latencies[-1] * 1000,
+                  failed))
+    print('preemptions', sum(device.preemptions for device in devices))
+    print('emulator', emulator.stats)
+    core.close()
+    emulator.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+'''Measures how fast the input path of a PLM can process captured traffic.
+
+A PLM is run against the pty emulator with its traffic captured, while
+COMMAND_COUNT on commands are sent to DEVICE_COUNT devices.  The capture
+is then replayed, with the same commands queued, into a PLM that is not
+connected to anything, as fast as possible.  The replay rate is the rate
+the framing, dispatch and state machines could keep up with if the port
+and the network were not the limit.
+
+    python bench_replay.py [device count] [command count]
+'''
+import contextlib
+import io
+import os
+import random
+import sys
+import tempfile
+import time
+
+import env
+from insteon.capture import Capture_Replay, Capture_Reader
+from bench_emulator import build
+
+DEVICE_COUNT = 100
+COMMAND_COUNT = 100
+
+
+def main():
+    device_count = DEVICE_COUNT
+    command_count = COMMAND_COUNT
+    if len(sys.argv) > 1:
+        device_count = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        command_count = int(sys.argv[2])
+    os.chdir(tempfile.mkdtemp())
+    path = os.path.abspath('plm.cap')
+    rand = random.Random(1)
+    with contextlib.redirect_stdout(io.StringIO()):
+        emulator, core, plm = build(device_count, 1)
+        attributes = emulator.plm_attributes()
+        addresses = [rand.choice(list(attributes['Devices']))
+                     for i in range(command_count)]
+        plm.start_capture(path)
+        live_frames = plm.input_stats['total_frames']
+        start = time.time()
+        futures = [plm.get_device_by_addr(address).send_command('on')
+                   for address in addresses]
+        core.run_until_complete(futures, timeout=command_count * 2)
+        live_elapsed = time.time() - start
+        live_frames = plm.input_stats['total_frames'] - live_frames
+        plm.stop_capture()
+        core.close()
+        emulator.stop()
+
+        attributes['port'] = '/nonexistent'
+        replay_plm = core.add_plm(attributes=attributes,
+                                  device_id=emulator.plm_id)
+        while replay_plm.send_scheduler.next_device() is not None:
+            replay_plm.send_scheduler.next_device().pop_device_queue()
+        for address in addresses:
+            replay_plm.get_device_by_addr(address).send_command('on')
+        stats = Capture_Replay(replay_plm, path).run()
+    frames = replay_plm.input_stats['total_frames']
+    records = sum(1 for record in Capture_Reader(path))
+    print('{} records, {} bytes, {} frames'.format(records, stats['bytes'],
+                                                    frames))
+    print('live   {:8.2f} s, {:10.1f} frames/s'.format(
+        live_elapsed, live_frames / live_elapsed))
+    print('replay {:8.2f} s, {:10.1f} frames/s'.format(
+        stats['elapsed'], frames / stats['elapsed']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+'''Compares picking the next device to send to with a scan of every device
+against the Send_Scheduler, for 10 to 10,000 devices.
+
+Every device starts with the messages queued by its init steps, these are
+drained first.  Each pass then queues one message on a random device and
+sends it, the way the loop runs while a few commands trickle in, and
+finishes with an idle pick where no device has anything to send.
+'''
+import contextlib
+import io
+import random
+import time
+
+import env
+from insteon.plm import PLM
+
+# Fewer passes for large device counts, the scan is slow
+PASS_BUDGET = 200000
+
+
+def build_plm(device_count):
+    with contextlib.redirect_stdout(io.StringIO()):
+        plm = PLM(None, port='/nonexistent', device_id='20F5F5')
+        for i in range(device_count):
+            plm.add_device('{:06X}'.format(0x100000 + i),
+                           attributes={'engine_version': 0x02,
+                                       'dev_cat': 0x02,
+                                       'sub_cat': 0x20,
+                                       'firmware': 0x41})
+        while plm.send_scheduler.next_device() is not None:
+            plm.send_scheduler.next_device().pop_device_queue()
+    return plm
+
+
+def scan_next_device(plm):
+    '''The loop that PLM.process_queue used before the scheduler'''
+    devices = [plm, ]
+    msg_time = 0
+    sending_device = False
+    for id, device in plm._devices.items():
+        devices.append(device)
+    for device in devices:
+        dev_msg_time = device.next_msg_create_time()
+        if dev_msg_time and (msg_time == 0 or dev_msg_time < msg_time):
+            sending_device = device
+            msg_time = dev_msg_time
+    return sending_device
+
+
+def run(plm, next_device, passes):
+    rand = random.Random(1)
+    devices = list(plm._devices.values())
+    msgs = [device.create_message('on') for device in devices[:64]]
+    start = time.perf_counter()
+    for i in range(passes):
+        device = rand.choice(devices)
+        device._queue_device_msg(msgs[i % len(msgs)], '')
+        sending_device = next_device(plm)
+        sending_device.pop_device_queue()
+        next_device(plm)
+    return (time.perf_counter() - start) / passes
+
+
+def main():
+    for device_count in (10, 100, 1000, 10000):
+        plm = build_plm(device_count)
+        passes = max(100, min(2000, PASS_BUDGET // device_count))
+        with contextlib.redirect_stdout(io.StringIO()):
+            scan_time = run(plm, scan_next_device, passes)
+            heap_time = run(plm,
+                            lambda plm: plm.send_scheduler.next_device(),
+                            passes)
+        print('{:6d} devices: scan {:9.1f} us per send, '
+              'scheduler {:6.1f} us per send, {:7.1f}x faster'.format(
+                  device_count, scan_time * 1000000, heap_time * 1000000,
+                  scan_time / heap_time))
+
+
+if __name__ == '__main__':
+    main()
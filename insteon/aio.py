@@ -0,0 +1,282 @@
+'''
+asyncio support for the PLM and the Insteon_Core.
+
+An Async_PLM drives a PLM from an asyncio event loop.  The serial port is
+watched with loop.add_reader.  The ack timeouts, wait_to_send and the state
+machine expiry are loop timers set from PLM.next_deadline, so an idle PLM
+uses no cpu and one loop can drive any number of PLMs.
+
+Commands are awaited through Async_PLM and Async_Device.  A command returns
+its message once the device acks it, or once the PLM acks it for commands
+that are only sent to the PLM.
+'''
+import asyncio
+import time
+
+from .core import SAVE_INTERVAL
+from .message import Message_Failed, Message_Nak, PRIORITY_NORMAL
+from .helpers import *
+
+
+class Async_PLM(object):
+    '''Drives a PLM from an asyncio event loop'''
+
+    def __init__(self, plm, loop=None):
+        self._plm = plm
+        self._loop = loop
+        self._fd = None
+        self._timer = None
+        self._service_handle = None
+        self._in_service = False
+        self._waiters = []
+
+    @property
+    def plm(self):
+        return self._plm
+
+    def start(self):
+        '''Starts watching the serial port, call this from the event loop
+        if no loop was passed'''
+        if self._loop is None:
+            self._loop = asyncio.get_running_loop()
+        self._fd = self._plm.fileno()
+        if self._fd is not None:
+            self._loop.add_reader(self._fd, self._process)
+        self._plm.send_scheduler.listener = self._wake
+        self._wake()
+
+    def stop(self):
+        if self._fd is not None:
+            self._loop.remove_reader(self._fd)
+            self._fd = None
+        self._plm.send_scheduler.listener = None
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._service_handle is not None:
+            self._service_handle.cancel()
+            self._service_handle = None
+
+    def get_device_by_addr(self, addr):
+        '''Returns an Async_Device for the device, or None'''
+        device = self._plm.get_device_by_addr(addr)
+        if device is None:
+            return None
+        return Async_Device(self, device)
+
+    async def send_command(self, command, state='', plm_bytes={},
+                           timeout=None, priority=PRIORITY_NORMAL):
+        '''Sends a command to the plm, returns the message once the plm
+        acks it'''
+        future = self._plm.send_command(command, state, plm_bytes, priority)
+        return await self.wait_for_msg(future.msg, timeout)
+
+    async def query_aldb(self, timeout=None):
+        '''Reads the links on the plm, returns the records once the end
+        of the plm's aldb is reached'''
+        self._plm._aldb.query_aldb()
+        await self.wait_for_state(self._plm, 'query_aldb', timeout)
+        return self._plm._aldb.get_all_records()
+
+    def messages(self, maxsize=1000):
+        '''Returns a Message_Stream of the messages received by the plm'''
+        return Message_Stream(self._plm, maxsize)
+
+    async def wait_for_msg(self, msg, timeout=None):
+        '''Waits until msg is acked, raises Message_Failed if the message is
+        abandoned or Message_Nak if the device nak's it'''
+        # Shielded so that a timeout does not cancel the message's future
+        future = asyncio.shield(asyncio.wrap_future(msg.future,
+                                                    loop=self._loop))
+        self._wake()
+        if timeout is None:
+            return await future
+        return await asyncio.wait_for(future, timeout)
+
+    async def wait_for_state(self, device, state, timeout=None):
+        '''Waits until the state machine of device has finished state'''
+        def state_done(future):
+            if device.state_pending(state):
+                return False
+            future.set_result(None)
+            return True
+        return await self._wait(state_done, timeout)
+
+    async def _wait(self, check, timeout):
+        future = self._loop.create_future()
+        self._waiters.append((check, future))
+        self._wake()
+        if timeout is None:
+            return await future
+        return await asyncio.wait_for(future, timeout)
+
+    def _wake(self):
+        '''Schedules a pass over the plm, called when a message is queued'''
+        if self._in_service or self._service_handle is not None:
+            return
+        self._service_handle = self._loop.call_soon(self._service)
+
+    def _process(self):
+        self._plm.process_input()
+        self._service()
+
+    def _service(self):
+        self._service_handle = None
+        self._in_service = True
+        try:
+            self._plm.process_unacked_msg()
+            self._plm.process_queue()
+            self._check_waiters()
+            deadline = self._plm.next_deadline()
+        finally:
+            self._in_service = False
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if deadline is not None:
+            delay = max(0, deadline - time.time())
+            self._timer = self._loop.call_at(self._loop.time() + delay,
+                                             self._process)
+
+    def _check_waiters(self):
+        if not self._waiters:
+            return
+        waiting = []
+        for check, future in self._waiters:
+            if future.done():
+                # Cancelled, or timed out
+                continue
+            if not check(future):
+                waiting.append((check, future))
+        self._waiters = waiting
+
+
+class Async_Device(object):
+    '''Awaitable commands for a device on an Async_PLM'''
+
+    def __init__(self, async_plm, device):
+        self._async_plm = async_plm
+        self._device = device
+
+    @property
+    def device(self):
+        return self._device
+
+    async def send_command(self, command_name, state='', dev_bytes={},
+                           timeout=None, priority=PRIORITY_NORMAL):
+        '''Sends a command to the device, returns the message once the
+        device acks it'''
+        future = self._device.send_command(command_name, state, dev_bytes,
+                                           priority)
+        if future is None:
+            raise ValueError(command_name + ' is not available for this '
+                             'device')
+        return await self._async_plm.wait_for_msg(future.msg, timeout)
+
+    async def query_aldb(self, timeout=None):
+        '''Reads the links on the device, returns the records once the
+        last record is reached'''
+        self._device._aldb.query_aldb()
+        await self._async_plm.wait_for_state(self._device, 'query_aldb',
+                                             timeout)
+        return self._device._aldb.get_all_records()
+
+
+class Message_Stream(object):
+    '''An async iterator of the messages received by a plm.  If the
+    messages are not read, the oldest are dropped once maxsize are
+    waiting'''
+
+    def __init__(self, plm, maxsize=1000):
+        self._plm = plm
+        self._queue = asyncio.Queue(maxsize)
+        self._closed = False
+        self.dropped = 0
+        self._plm.add_msg_listener(self._put)
+
+    def _put(self, msg):
+        if self._queue.full():
+            self._queue.get_nowait()
+            self.dropped += 1
+        self._queue.put_nowait(msg)
+
+    def close(self):
+        '''Stops the stream, iteration ends after the waiting messages'''
+        if not self._closed:
+            self._closed = True
+            self._plm.remove_msg_listener(self._put)
+            if self._queue.full():
+                self._queue.get_nowait()
+            self._queue.put_nowait(None)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self._closed and self._queue.empty():
+            raise StopAsyncIteration
+        msg = await self._queue.get()
+        if msg is None:
+            raise StopAsyncIteration
+        return msg
+
+
+class Async_Core(object):
+    '''Drives every PLM of an Insteon_Core from an asyncio event loop and
+    saves the config on a loop timer'''
+
+    def __init__(self, core, loop=None):
+        self._core = core
+        self._loop = loop
+        self._plms = []
+        self._save_timer = None
+
+    @property
+    def core(self):
+        return self._core
+
+    def start(self):
+        if self._loop is None:
+            self._loop = asyncio.get_running_loop()
+        for plm in self._core.get_all_plms():
+            self._start_plm(plm)
+        self._save_timer = self._loop.call_later(SAVE_INTERVAL, self._save)
+
+    def stop(self):
+        for async_plm in self._plms:
+            async_plm.stop()
+        if self._save_timer is not None:
+            self._save_timer.cancel()
+            self._save_timer = None
+
+    def add_plm(self, **kwargs):
+        '''Adds a plm to the core, see Insteon_Core.add_plm, and returns its
+        Async_PLM'''
+        plm = self._core.add_plm(**kwargs)
+        if plm is None:
+            return None
+        for async_plm in self._plms:
+            if async_plm.plm is plm:
+                return async_plm
+        return self._start_plm(plm)
+
+    def get_plm_by_id(self, id):
+        ret = None
+        for async_plm in self._plms:
+            if async_plm.plm.dev_addr_str == id:
+                ret = async_plm
+        return ret
+
+    def _start_plm(self, plm):
+        async_plm = Async_PLM(plm, self._loop)
+        async_plm.start()
+        self._plms.append(async_plm)
+        return async_plm
+
+    def _save(self):
+        self._core._save_state()
+        # The timer can fire a little early, in which case the save was
+        # skipped and is retried shortly
+        delay = self._core._last_saved_time + SAVE_INTERVAL - time.time()
+        self._save_timer = self._loop.call_later(max(delay, 0.01),
+                                                 self._save)
@@ -2,8 +2,17 @@ import time
 import datetime
 import pprint
 
+from .message import PRIORITY_NORMAL, PRIORITY_BACKGROUND
 from .helpers import *
 
+# Seconds a state machine can go without being updated before it expires
+STATE_MACHINE_TIMEOUT = 8
+# Seconds a bulk aldb download can go without a record before it is taken
+# to have stalled
+ALDB_STREAM_TIMEOUT = 2
+# The address of the first record in a device aldb
+ALDB_FIRST_ADDRESS = 0x0FFF
+
 
 class ALDB(object):
 
@@ -96,9 +105,31 @@ class ALDB(object):
 
 
 class Device_ALDB(ALDB):
+    '''The aldb of an i2 device is read either one record per read_aldb,
+    or in bulk, where a single read_aldb asks for all of the records and
+    the device sends them one after the other.  A bulk download stores
+    the records as they arrive.  Once the last record is in, the records
+    lost on the way are read again one at a time.  If the records stop
+    coming for ALDB_STREAM_TIMEOUT before the last one, the records
+    missing so far are read again and the rest are read one at a time'''
 
     def __init__(self, parent):
         super().__init__(parent)
+        self._streaming = False
+        self._missing = []
+        self._resume_address = None
+        self._read = None
+        self._stats = {
+            'streamed': 0,
+            'refetched': 0,
+            'stalls': 0,
+        }
+
+    @property
+    def stats(self):
+        '''Returns a dictionary of the records received in bulk, the
+        records read again and the queries that stalled'''
+        return self._stats.copy()
 
     def _get_aldb_key(self, msb, lsb):
         offset = 7 - (lsb % 8)
@@ -106,67 +137,146 @@ class Device_ALDB(ALDB):
         key = bytes([msb, highest_byte])
         return BYTE_TO_HEX(key)
 
-    def query_aldb(self):
+    def query_aldb(self, bulk=True):
+        '''Reads the aldb of the device.  An i2 device is asked for all of
+        its records at once, or one record at a time if bulk is False'''
         self.clear_all_records()
+        self._streaming = False
+        self._missing = []
+        self._resume_address = None
+        self._read = None
         if self._parent.attribute('engine_version') == 0:
             self.i1_start_aldb_entry_query(0x0F, 0xF8)
+        elif bulk:
+            self._streaming = True
+            self._i2_read_aldb(0x00, 0x00, 0x00, self.i2_stream_aldb)
+        else:
+            self._i2_read_aldb(0x00, 0x00, 0x01, self.i2_next_aldb)
+
+    def _i2_read_aldb(self, msb, lsb, num_records, trigger_function):
+        '''Queues a read_aldb of num_records from msb and lsb, a
+        num_records of 0 reads them all.  trigger_function is called on
+        the first record that arrives'''
+        dev_bytes = {'msb': msb, 'lsb': lsb, 'num_records': num_records}
+        self._parent.send_command('read_aldb',
+                                  'query_aldb',
+                                  dev_bytes=dev_bytes,
+                                  priority=PRIORITY_BACKGROUND)
+        self._read = (msb, lsb, num_records, trigger_function)
+        if msb or lsb:
+            self._set_aldb_trigger(trigger_function, msb, lsb)
         else:
-            dev_bytes = {'msb': 0x00, 'lsb': 0x00}
-            self._parent.send_command('read_aldb',
-                                      'query_aldb',
-                                      dev_bytes=dev_bytes)
-            # It would be nice to link the trigger to the msb and lsb, but we
-            # don't technically have that yet at this point
-            trigger_attributes = {
-                'plm_cmd': 0x51,
-                'cmd_1': 0x2F,
-                'from_addr_hi': self._parent.dev_addr_hi,
-                'from_addr_mid': self._parent.dev_addr_mid,
-                'from_addr_low': self._parent.dev_addr_low,
-            }
-            trigger = Trigger(trigger_attributes)
-            trigger.trigger_function = lambda: self.i2_next_aldb()
-            trigger_name = self._parent.dev_addr_str + 'query_aldb'
-            self._parent.plm._trigger_mngr.add_trigger(trigger_name, trigger)
+            # It would be nice to link the trigger to the msb and lsb, but
+            # we don't technically have that yet at this point
+            self._set_aldb_trigger(trigger_function)
+        # Nothing is outstanding until the read is sent
+        self._parent.mark_safe_point('query_aldb')
+
+    def _set_aldb_trigger(self, trigger_function, msb=None, lsb=None):
+        trigger_attributes = {
+            'plm_cmd': 0x51,
+            'cmd_1': 0x2F,
+            'from_addr_hi': self._parent.dev_addr_hi,
+            'from_addr_mid': self._parent.dev_addr_mid,
+            'from_addr_low': self._parent.dev_addr_low,
+        }
+        if msb is not None:
+            trigger_attributes['usr_3'] = msb
+            trigger_attributes['usr_4'] = lsb
+        trigger = Trigger(trigger_attributes)
+        trigger.trigger_function = lambda: trigger_function()
+        trigger_name = self._parent.dev_addr_str + 'query_aldb'
+        self._parent.plm._trigger_mngr.add_trigger(trigger_name, trigger)
 
     def i2_next_aldb(self):
         # TODO parse by real names on incomming
         msb = self._parent.last_rcvd_msg.get_byte_by_name('usr_3')
         lsb = self._parent.last_rcvd_msg.get_byte_by_name('usr_4')
         if self.is_last_aldb(self._get_aldb_key(msb, lsb)):
-            self._parent.remove_state_machine('query_aldb')
-            records = self.get_all_records()
-            for key in sorted(records):
-                print(key, ":", BYTE_TO_HEX(records[key]))
-            self._parent.send_command('light_status_request', 'set_aldb_delta')
+            self._end_query()
         else:
             if lsb == 0x07:
                 msb -= 1
                 lsb = 0xFF
             else:
                 lsb -= 8
-            dev_bytes = {'msb': msb, 'lsb': lsb}
-            self._parent.send_command('read_aldb',
-                                      'query_aldb',
-                                      dev_bytes=dev_bytes)
-            # Set Trigger
-            trigger_attributes = {
-                'plm_cmd': 0x51,
-                'cmd_1': 0x2F,
-                'usr_3': msb,
-                'usr_4': lsb,
-                'from_addr_hi': self._parent.dev_addr_hi,
-                'from_addr_mid': self._parent.dev_addr_mid,
-                'from_addr_low': self._parent.dev_addr_low,
-            }
-            trigger = Trigger(trigger_attributes)
-            trigger.trigger_function = lambda: self.i2_next_aldb()
-            trigger_name = self._parent.dev_addr_str + 'query_aldb'
-            self._parent.plm._trigger_mngr.add_trigger(trigger_name, trigger)
+            self._i2_read_aldb(msb, lsb, 0x01, self.i2_next_aldb)
+
+    def i2_stream_aldb(self):
+        '''Called on each record of a bulk download'''
+        msb = self._parent.last_rcvd_msg.get_byte_by_name('usr_3')
+        lsb = self._parent.last_rcvd_msg.get_byte_by_name('usr_4')
+        self._stats['streamed'] += 1
+        if self.is_last_aldb(self._get_aldb_key(msb, lsb)):
+            self._streaming = False
+            self._read = None
+            self._missing = self._missing_addresses((msb << 8) | lsb)
+            self.i2_next_missing()
+        else:
+            self._parent.update_state_machine('query_aldb',
+                                              ALDB_STREAM_TIMEOUT)
+            self._set_aldb_trigger(self.i2_stream_aldb)
+
+    def i2_next_missing(self):
+        '''Reads the next record missing from a bulk download.  Once they
+        are all in, the query either ends or, if the download stalled,
+        goes on one record at a time'''
+        if self._missing:
+            address = self._missing.pop(0)
+            self._stats['refetched'] += 1
+            self._i2_read_aldb(address >> 8, address & 0xFF, 0x01,
+                               self.i2_next_missing)
+        elif self._resume_address is not None:
+            address = self._resume_address - 8
+            self._resume_address = None
+            self._i2_read_aldb(address >> 8, address & 0xFF, 0x01,
+                               self.i2_next_aldb)
+        else:
+            self._end_query()
+
+    def query_stalled(self):
+        '''Called when the query_aldb state expires.  A bulk download goes
+        on with the records it is missing, a lost single record is read
+        again'''
+        if self._parent.state_pending('query_aldb') or self._read is None:
+            # A message is still queued or the query is not running
+            return
+        self._stats['stalls'] += 1
+        if self._streaming:
+            self._streaming = False
+            addresses = [int(key, 16) for key in self.get_all_records()]
+            if addresses:
+                self._resume_address = min(addresses)
+                self._missing = self._missing_addresses(self._resume_address)
+                self.i2_next_missing()
+            else:
+                self.query_aldb(bulk=False)
+        else:
+            self._i2_read_aldb(*self._read)
+
+    def _missing_addresses(self, end):
+        '''Returns the addresses of the records from the first one down
+        to end, not included, that have not been received'''
+        ret = []
+        records = self.get_all_records()
+        for address in range(ALDB_FIRST_ADDRESS, end, -8):
+            if self._get_aldb_key(address >> 8, address & 0xFF) not in records:
+                ret.append(address)
+        return ret
+
+    def _end_query(self):
+        self._read = None
+        self._parent.remove_state_machine('query_aldb')
+        records = self.get_all_records()
+        for key in sorted(records):
+            print(key, ":", BYTE_TO_HEX(records[key]))
+        self._parent.send_command('light_status_request', 'set_aldb_delta',
+                                  priority=PRIORITY_BACKGROUND)
 
     def i1_start_aldb_entry_query(self, msb, lsb):
         message = self._parent.create_message('set_address_msb')
         message._insert_bytes_into_raw({'msb': msb})
+        message.priority = PRIORITY_BACKGROUND
         message.insteon_msg.device_success_callback = \
             lambda: \
             self.peek_aldb(lsb)
@@ -175,7 +285,11 @@ class Device_ALDB(ALDB):
     def peek_aldb(self, lsb):
         message = self._parent.create_message('peek_one_byte')
         message._insert_bytes_into_raw({'lsb': lsb})
+        message.priority = PRIORITY_BACKGROUND
         self._parent._queue_device_msg(message, 'query_aldb')
+        if lsb % 8 == 0:
+            # The previous record has been read in full
+            self._parent.mark_safe_point('query_aldb')
 
     def create_responder(self, controller, d1, d2, d3):
                 # Device Responder
@@ -214,7 +328,8 @@ class PLM_ALDB(ALDB):
         '''Queries the PLM for a list of the link records saved on
         the PLM and stores them in the cache'''
         self.clear_all_records()
-        self._parent.send_command('all_link_first_rec', 'query_aldb')
+        self._parent.send_command('all_link_first_rec', 'query_aldb',
+                                  priority=PRIORITY_BACKGROUND)
 
     def create_responder(self, controller, *args):
         self._write_link(controller, is_plm_controller=False)
@@ -258,6 +373,10 @@ class Base_Device(object):
         self._plm = plm
         self._state_machine = 'default'
         self._state_machine_time = 0
+        self._state_timeout = STATE_MACHINE_TIMEOUT
+        self._safe_point = False
+        self._sent_state = 'default'
+        self._preemptions = 0
         self._device_msg_queue = {}
         self._attributes = {}
         self._out_history = []
@@ -282,21 +401,75 @@ class Base_Device(object):
         Whenever a state is set, only messages of that state will be
         sent to the device, all other messages will wait in a queue.
         To avoid locking up a device, a state will automatically be
-        eliminated if it has not been updated within 8 seconds. You
-        can update a state by calling update_state_machine or sending
-        a command with the appropriate state value'''
-        if self._state_machine_time <= (time.time() - 8) or \
-                self._state_machine == 'default':
+        eliminated if it has not been updated within 8 seconds, or the
+        timeout given to update_state_machine.  You can update a state
+        by calling update_state_machine or sending a command with the
+        appropriate state value.  An expired state is told through
+        _state_expired
+
+        A state can be preempted at the safe points it marks with
+        mark_safe_point, see _send_state'''
+        if self._state_machine_time <= (time.time() - self._state_timeout) \
+                or self._state_machine == 'default':
             # Always check for states other than default
+            prev_state = self._state_machine
             if self._state_machine != 'default':
                 now = datetime.datetime.now().strftime("%M:%S.%f")
                 print(now, self._state_machine, "state expired")
                 pprint.pprint(self._device_msg_queue)
+                # The state is left first, so that it can queue messages
+                # to go on with
+                self._state_machine = 'default'
+                self._safe_point = False
+                self._state_expired(prev_state)
             self._state_machine = self._get_next_state_machine()
             if self._state_machine != 'default':
                 self._state_machine_time = time.time()
+                self._state_timeout = STATE_MACHINE_TIMEOUT
+            if self._state_machine != prev_state:
+                self._safe_point = False
+                self._queue_changed()
         return self._state_machine
 
+    @property
+    def preemptions(self):
+        '''The number of messages sent ahead of a state machine at its
+        safe points'''
+        return self._preemptions
+
+    def mark_safe_point(self, state):
+        '''Called by a state machine once nothing it sent is outstanding
+        and its next message is queued.  Until that message is sent, a
+        message in the default queue with a higher priority is sent
+        first, after which the state machine resumes from its queue'''
+        if state == self.state_machine:
+            self._safe_point = True
+            self._queue_changed()
+
+    def _send_state(self):
+        '''Returns the state whose queue the next message is sent from'''
+        ret = self.state_machine
+        if ret != 'default' and self._safe_point:
+            default_queue = self._device_msg_queue.get('default')
+            state_queue = self._device_msg_queue.get(ret)
+            if (default_queue and state_queue and
+                    default_queue[0].priority < state_queue[0].priority):
+                ret = 'default'
+        return ret
+
+    @property
+    def state_machine_expiry(self):
+        '''The time at which the current state machine expires, None if the
+        device is in the default state'''
+        if self._state_machine == 'default':
+            return None
+        return self._state_machine_time + self._state_timeout
+
+    def _state_expired(self, state):
+        '''Called when state expires, with messages of the state still
+        queued or not'''
+        pass
+
     def _get_next_state_machine(self):
         next_state = 'default'
         msg_time = 0
@@ -308,17 +481,29 @@ class Base_Device(object):
                     msg_time = test_time
         return next_state
 
+    def state_pending(self, state):
+        '''Returns True if state is the active state machine or has messages
+        waiting in its queue'''
+        return (self._state_machine == state or
+                bool(self._device_msg_queue.get(state)))
+
     def remove_state_machine(self, value):
         if value == self.state_machine:
             print('finished', self.state_machine)
             self._state_machine = 'default'
             self._state_machine_time = time.time()
+            self._state_timeout = STATE_MACHINE_TIMEOUT
+            self._safe_point = False
+            self._queue_changed()
         else:
             print(value, 'was not the active state_machine')
 
-    def update_state_machine(self, value):
+    def update_state_machine(self, value, timeout=STATE_MACHINE_TIMEOUT):
+        '''Keeps the state alive for timeout more seconds'''
         if value == self.state_machine:
             self._state_machine_time = time.time()
+            self._state_timeout = timeout
+            self._queue_changed()
         else:
             print(value, 'was not the active state_machine')
 
@@ -328,32 +513,57 @@ class Base_Device(object):
         if state not in self._device_msg_queue:
             self._device_msg_queue[state] = []
         self._device_msg_queue[state].append(message)
+        self._queue_changed()
 
     def _resend_msg(self, message):
-        # This is a bit of a hack, assumes the state has not changed
-        # Maybe move state to the message class?
-        state = self.state_machine
+        # This is a bit of a hack, assumes the message was the last one
+        # sent, maybe move state to the message class?
+        state = self._sent_state
         if state not in self._device_msg_queue:
             self._device_msg_queue[state] = []
         self._device_msg_queue[state].insert(0, message)
         self._state_machine_time = time.time()
+        self._queue_changed()
 
     def pop_device_queue(self):
         '''Returns and removes the next message in the queue'''
         ret = None
-        if self.state_machine in self._device_msg_queue and \
-                self._device_msg_queue[self.state_machine]:
-            ret = self._device_msg_queue[self.state_machine].pop(0)
+        state = self._send_state()
+        if state in self._device_msg_queue and \
+                self._device_msg_queue[state]:
+            ret = self._device_msg_queue[state].pop(0)
+            if state != self.state_machine:
+                self._preemptions += 1
+            else:
+                self._safe_point = False
+            self._sent_state = state
             self._update_message_history(ret)
             self._state_machine_time = time.time()
+            self._state_timeout = STATE_MACHINE_TIMEOUT
+            self._queue_changed()
         return ret
 
+    def _queue_changed(self):
+        '''Tells the plm that the next message of this device may have
+        changed.  Call this after changing the queue or the state machine'''
+        self.plm.send_scheduler.touch(self)
+
     def next_msg_create_time(self):
         '''Returns the creation time of the message to be sent in the queue'''
         ret = None
-        if self.state_machine in self._device_msg_queue and \
-                self._device_msg_queue[self.state_machine]:
-            ret = self._device_msg_queue[self.state_machine][0].creation_time
+        state = self._send_state()
+        if state in self._device_msg_queue and \
+                self._device_msg_queue[state]:
+            ret = self._device_msg_queue[state][0].creation_time
+        return ret
+
+    def next_msg_priority(self):
+        '''Returns the priority of the message to be sent in the queue'''
+        ret = None
+        state = self._send_state()
+        if state in self._device_msg_queue and \
+                self._device_msg_queue[state]:
+            ret = self._device_msg_queue[state][0].priority
         return ret
 
     def _update_message_history(self, msg):
@@ -496,14 +706,13 @@ class Trigger_Manager(object):
     # TODO remove expired triggers?
 
     def match_msg(self, msg):
-        haystack = msg.parsed_attributes
         matched_keys = []
         for trigger_key, trigger in self._triggers.items():
             needle = trigger.attributes
             trigger_match = True
             for test_key, test_val in needle.items():
-                if ((test_key in haystack) and
-                        (needle[test_key] != haystack[test_key])):
+                if (msg.has_byte_name(test_key) and
+                        test_val != msg.get_byte_by_name(test_key)):
                     trigger_match = False
                     break
             if (trigger_match):
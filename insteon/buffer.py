@@ -0,0 +1,112 @@
+class Read_Buffer(object):
+    '''A preallocated buffer that holds the bytes read from a PLM until
+    they are framed into messages.
+
+    The unread bytes always sit in one contiguous block between a head and
+    a tail cursor.  Consuming bytes only moves the head, nothing is shifted.
+    When the buffer is emptied both cursors wrap back to the start, and if
+    new data will not fit at the end, the few unread bytes are moved back
+    to the start first.  The storage is only reallocated if more bytes are
+    waiting than the buffer can hold.
+
+    The object supports the subset of the bytearray interface used by the
+    framing code, so either can be used as a PLM read buffer.'''
+
+    def __init__(self, size=4096):
+        self._buffer = bytearray(size)
+        self._head = 0
+        self._tail = 0
+
+    def __len__(self):
+        return self._tail - self._head
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+            return self._buffer[self._head + start:self._head + stop:step]
+        if key < 0:
+            key += len(self)
+        if key < 0 or key >= len(self):
+            raise IndexError('read buffer index out of range')
+        return self._buffer[self._head + key]
+
+    def __delitem__(self, key):
+        '''Only deleting from the front of the buffer is supported'''
+        if not isinstance(key, slice) or key.step not in (None, 1):
+            raise TypeError('read buffer only supports deleting a slice')
+        start, stop, step = key.indices(len(self))
+        if start != 0:
+            raise ValueError('read buffer can only delete from the front')
+        self.consume(stop)
+
+    def __eq__(self, other):
+        return bytes(self) == other
+
+    def __bytes__(self):
+        return bytes(self._buffer[self._head:self._tail])
+
+    @property
+    def capacity(self):
+        return len(self._buffer)
+
+    def view(self):
+        '''Returns a memoryview of the unread bytes.  The view is only valid
+        until more bytes are added to the buffer'''
+        return memoryview(self._buffer)[self._head:self._tail]
+
+    def startswith(self, prefix):
+        if not isinstance(prefix, tuple):
+            prefix = (prefix,)
+        for test in prefix:
+            if (len(test) <= len(self) and
+                    self._buffer[self._head:self._head + len(test)] == test):
+                return True
+        return False
+
+    def find(self, sub):
+        index = self._buffer.find(sub, self._head, self._tail)
+        if index >= 0:
+            index -= self._head
+        return index
+
+    def consume(self, length):
+        '''Removes length bytes from the front of the buffer'''
+        self._head = min(self._head + length, self._tail)
+        if self._head == self._tail:
+            self._head = 0
+            self._tail = 0
+
+    def clear(self):
+        self._head = 0
+        self._tail = 0
+
+    def _make_room(self, length):
+        '''Ensures that length bytes can be written at the tail'''
+        if self._tail + length <= len(self._buffer):
+            return
+        used = len(self)
+        if used + length <= len(self._buffer):
+            # Wrap the unread bytes back to the start of the buffer
+            self._buffer[0:used] = self._buffer[self._head:self._tail]
+        else:
+            new_buffer = bytearray(max(len(self._buffer) * 2, used + length))
+            new_buffer[0:used] = self._buffer[self._head:self._tail]
+            self._buffer = new_buffer
+        self._head = 0
+        self._tail = used
+
+    def extend(self, data):
+        length = len(data)
+        self._make_room(length)
+        self._buffer[self._tail:self._tail + length] = data
+        self._tail += length
+
+    def fill_from(self, port):
+        '''Drains every byte waiting on the port with a single read call.
+        Returns the number of bytes added to the buffer'''
+        waiting = port.inWaiting()
+        if waiting <= 0:
+            return 0
+        data = port.read(waiting)
+        self.extend(data)
+        return len(data)
@@ -0,0 +1,188 @@
+'''
+Binary captures of the bytes passing between a PLM and this library.
+
+A capture is a journal file.  It starts with FILE_MAGIC, followed by one
+record for each chunk of bytes read from or written to the port.  Every
+record has a fixed size header, packed as RECORD_HEADER: the time as a
+double, the length of the data and the direction, read or written.  The
+data follows the header.  Because the headers have a fixed size, a
+capture can be walked in place through an mmap without parsing the data.
+
+Capture_Writer appends records, Capture_Reader iterates over them, and
+Capture_Replay feeds the bytes read in a capture back through a PLM.
+'''
+import mmap
+import struct
+import threading
+import time
+
+FILE_MAGIC = b'INSTCAP\x01'
+# time, data length, direction, padding
+RECORD_HEADER = struct.Struct('<dHBx')
+CAPTURE_READ = 0
+CAPTURE_WRITE = 1
+# Records hold at most this many bytes, longer data is split
+MAX_RECORD_DATA = 0xFFFF
+
+
+class Capture_Writer(object):
+    '''Appends records to a capture file.  Reads and writes may be
+    recorded from different threads'''
+
+    def __init__(self, path):
+        self._path = path
+        self._file = open(path, 'ab')
+        if self._file.tell() == 0:
+            self._file.write(FILE_MAGIC)
+        self._lock = threading.Lock()
+        self._records = 0
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def records(self):
+        return self._records
+
+    def write(self, direction, data, rcvd_time=None):
+        if rcvd_time is None:
+            rcvd_time = time.time()
+        data = bytes(data)
+        with self._lock:
+            for start in range(0, len(data), MAX_RECORD_DATA):
+                chunk = data[start:start + MAX_RECORD_DATA]
+                self._file.write(RECORD_HEADER.pack(rcvd_time, len(chunk),
+                                                    direction))
+                self._file.write(chunk)
+                self._records += 1
+
+    def flush(self):
+        with self._lock:
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+class Capture_Reader(object):
+    '''Iterates over the records of a capture file, as tuples of the time,
+    the direction and the data'''
+
+    def __init__(self, path):
+        self._path = path
+
+    def __iter__(self):
+        with open(self._path, 'rb') as infile:
+            if infile.seek(0, 2) <= len(FILE_MAGIC):
+                return
+            with mmap.mmap(infile.fileno(), 0,
+                           access=mmap.ACCESS_READ) as journal:
+                if journal[0:len(FILE_MAGIC)] != FILE_MAGIC:
+                    raise ValueError(self._path + ' is not a capture file')
+                offset = len(FILE_MAGIC)
+                size = len(journal)
+                while offset + RECORD_HEADER.size <= size:
+                    rcvd_time, length, direction = \
+                        RECORD_HEADER.unpack_from(journal, offset)
+                    offset += RECORD_HEADER.size
+                    if offset + length > size:
+                        # The last record was cut short
+                        break
+                    yield rcvd_time, direction, journal[offset:offset + length]
+                    offset += length
+
+
+class Replay_Port(object):
+    '''Stands in for the port of a PLM during a replay.  Reads return the
+    bytes fed from the capture, writes are kept in written'''
+
+    def __init__(self):
+        self._data = bytearray()
+        self.written = []
+
+    def feed(self, data):
+        self._data.extend(data)
+
+    def fileno(self):
+        return None
+
+    def next_poll(self):
+        return None
+
+    def inWaiting(self):
+        return len(self._data)
+
+    def read(self, size=1):
+        ret = bytes(self._data[0:size])
+        del self._data[0:size]
+        return ret
+
+    def write(self, data):
+        self.written.append(bytes(data))
+        return len(data)
+
+    def close(self):
+        pass
+
+
+class Capture_Replay(object):
+    '''Feeds the bytes read in a capture through the PLM, the way they
+    arrived from the port.
+
+    Each read record is handed to process_input and the PLM is then run
+    like the core would run it, so the framing, the dispatch and the state
+    machines all see the captured traffic.  The PLM's own writes go to a
+    Replay_Port and are not sent anywhere.  Commands sent by the
+    application are not in the capture, send them to the PLM before the
+    replay for their acks to be matched.  The pause the PLM keeps between
+    sends is skipped before each record, so the PLM sends its next message
+    before the captured answer to it is fed, as it did when the capture was
+    made.  When replaying faster than the original speed, timeouts in the
+    PLM fire later relative to the traffic than they did when it was
+    captured.'''
+
+    def __init__(self, plm, path):
+        self._plm = plm
+        self._path = path
+        self._port = Replay_Port()
+
+    @property
+    def port(self):
+        return self._port
+
+    def run(self, speed=None):
+        '''Replays the capture.  A speed of 1 keeps the original timing,
+        2 runs twice as fast and None as fast as possible.  Returns a
+        dictionary of the records and bytes replayed and the seconds
+        taken'''
+        plm = self._plm
+        plm.port_active = True
+        plm._serial = self._port
+        stats = {'records': 0, 'bytes': 0, 'elapsed': 0}
+        first_time = None
+        start = time.perf_counter()
+        for rcvd_time, direction, data in Capture_Reader(self._path):
+            if direction != CAPTURE_READ:
+                continue
+            if first_time is None:
+                first_time = rcvd_time
+            if speed is not None:
+                wait = ((rcvd_time - first_time) / speed -
+                        (time.perf_counter() - start))
+                if wait > 0:
+                    time.sleep(wait)
+            plm._wait_to_send = 0
+            plm.pacer.refill()
+            plm.process_queue()
+            self._port.feed(data)
+            plm.process_input()
+            while plm._input_pending:
+                plm.process_input()
+            plm.process_unacked_msg()
+            plm.process_queue()
+            stats['records'] += 1
+            stats['bytes'] += len(data)
+        stats['elapsed'] = time.perf_counter() - start
+        return stats
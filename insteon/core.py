@@ -5,22 +5,87 @@ import time
 import atexit
 import signal
 import sys
+import os
+import collections
+import selectors
 
 from .plm import PLM
 from .msg_schema import *
 from .helpers import *
 from .rest_server import *
 
+# Seconds between saves of the config file
+SAVE_INTERVAL = 60
+
+
+def plm_state(plm, devices=True):
+    '''Returns the config of the plm and its devices as saved in the config
+    file.  If devices is False the Devices entry is left out'''
+    ret = plm._attributes.copy()
+    ret['ALDB'] = plm._aldb.get_all_records_str()
+    if devices:
+        ret['Devices'] = {}
+        for address, device in plm._devices.items():
+            ret['Devices'][address] = device_state(device)
+    return ret
+
+
+def device_state(device):
+    '''Returns the config of the device as saved in the config file'''
+    ret = device._attributes.copy()
+    ret['ALDB'] = device._aldb.get_all_records_str()
+    return ret
+
+
+def write_config(out_data):
+    '''Writes the config of every plm to the config file'''
+    try:
+        json_string = json.dumps(out_data,
+                                 sort_keys=True,
+                                 indent=4,
+                                 ensure_ascii=False)
+    except Exception:
+        print ('error writing config to file')
+    else:
+        outfile = open('config.json', 'w')
+        outfile.write(json_string)
+        outfile.close()
+
+
+def read_config():
+    '''Returns the config saved by write_config, or an empty dict'''
+    try:
+        with open('config.json', 'r') as infile:
+            read_data = infile.read()
+        read_data = json.loads(read_data)
+    except FileNotFoundError:
+        read_data = {}
+    except ValueError:
+        read_data = {}
+        print('unable to read config file, skipping')
+    return read_data
+
 
 class Insteon_Core(object):
     '''Provides global management functions'''
 
-    def __init__(self):
+    def __init__(self, threaded_io=False):
+        '''If threaded_io is True, each plm reads and writes its serial port
+        on its own threads and only the message handling runs on the thread
+        running the core'''
         self._plms = []
+        self._threaded_io = threaded_io
         self._last_saved_time = 0
+        self._selector = selectors.DefaultSelector()
+        self._wakeup_read, self._wakeup_write = os.pipe()
+        os.set_blocking(self._wakeup_read, False)
+        os.set_blocking(self._wakeup_write, False)
+        self._selector.register(self._wakeup_read, selectors.EVENT_READ)
+        self._submitted = collections.deque()
+        self._running = False
         self._load_state()
-        # Be sure to save before exiting
-        atexit.register(self._save_state, True)
+        # Be sure to save and stop the io threads before exiting
+        atexit.register(self.close)
         signal.signal(signal.SIGINT, self._signal_handler)
 
     def start_rest_server(self):
@@ -36,6 +101,96 @@ class Insteon_Core(object):
             plm.process_queue()
         self._save_state()
 
+    def run_once(self, timeout=None):
+        '''Sleeps until a plm has data waiting, the next deadline of a plm
+        is reached, or wakeup is called, then runs any submitted functions
+        and one loop.  If timeout is set, sleeps at most timeout seconds'''
+        wait = self._time_to_deadline()
+        if timeout is not None and (wait is None or timeout < wait):
+            wait = timeout
+        for key, events in self._selector.select(wait):
+            if key.fd == self._wakeup_read:
+                self._drain_wakeup()
+        self._run_submitted()
+        self.loop_once()
+
+    def run_until_complete(self, futures, timeout=None):
+        '''Processes the plms until every future, such as those returned by
+        send_command, is done or timeout seconds have passed.  Returns the
+        set of futures that are not done'''
+        end = None if timeout is None else time.time() + timeout
+        pending = set(future for future in futures if not future.done())
+        while pending:
+            wait = None
+            if end is not None:
+                wait = end - time.time()
+                if wait <= 0:
+                    break
+            self.run_once(timeout=wait)
+            pending = set(future for future in pending if not future.done())
+        return pending
+
+    def run_forever(self):
+        '''Processes the plms until stop is called, without using the cpu
+        while there is nothing to do'''
+        self._running = True
+        while self._running:
+            self.run_once()
+
+    def stop(self):
+        '''Makes run_forever return, can be called from any thread'''
+        self._running = False
+        self.wakeup()
+
+    def close(self):
+        '''Saves the config, stops the io threads of the plms and closes
+        their captures'''
+        self._save_state(True)
+        for plm in self._plms:
+            plm.stop_io_thread()
+            plm.stop_capture()
+
+    def submit(self, function, *args, **kwargs):
+        '''Calls function with args from the thread running the core.  Use
+        this to send commands from other threads'''
+        self._submitted.append((function, args, kwargs))
+        self.wakeup()
+
+    def wakeup(self):
+        '''Wakes run_once if it is sleeping'''
+        try:
+            os.write(self._wakeup_write, b'\x00')
+        except BlockingIOError:
+            # The pipe is full, so a wake up is already waiting
+            pass
+
+    def _drain_wakeup(self):
+        try:
+            while os.read(self._wakeup_read, 4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    def _run_submitted(self):
+        while self._submitted:
+            function, args, kwargs = self._submitted.popleft()
+            try:
+                function(*args, **kwargs)
+            except Exception as e:
+                # One failing function should not stop the core or lose
+                # the functions submitted after it
+                print('error running submitted function', function, e)
+
+    def _time_to_deadline(self):
+        '''Returns the seconds until something needs to be processed even
+        if no data arrives'''
+        deadline = self._last_saved_time + SAVE_INTERVAL
+        for plm in self._plms:
+            plm_deadline = plm.next_deadline()
+            if plm_deadline is not None and plm_deadline < deadline:
+                deadline = plm_deadline
+        return max(0, deadline - time.time())
+
     def add_plm(self, **kwargs):
         '''Inform the core of a plm that should be monitored as part
         of the core process'''
@@ -55,8 +210,13 @@ class Insteon_Core(object):
                 ret = PLM(self, device_id=device_id, port=port)
         else:
             print('you need to define a port for this plm')
-        if ret is not None:
+        if ret is not None and ret not in self._plms:
             self._plms.append(ret)
+            if self._threaded_io:
+                ret.start_io_thread(wakeup=self.wakeup)
+            elif ret.fileno() is not None:
+                self._selector.register(ret.fileno(), selectors.EVENT_READ,
+                                        ret)
         return ret
 
     def get_plm_by_id(self, id):
@@ -74,49 +234,22 @@ class Insteon_Core(object):
 
     def _save_state(self, is_exit=False):
         # Saves the config of the entire core to a file
-        if self._last_saved_time < time.time() - 60 or is_exit:
+        if self._last_saved_time < time.time() - SAVE_INTERVAL or is_exit:
             # Save once a minute, on on exit
             out_data = {'PLMs': {}}
             for plm in self._plms:
-                plm_point = {}
-                plm_point = plm._attributes.copy()
-                plm_point['ALDB'] = plm._aldb.get_all_records_str()
-                plm_point['Devices'] = {}
-                out_data['PLMs'][plm.dev_addr_str] = plm_point
-                for address, device in plm._devices.items():
-                    dev_point = device._attributes.copy()
-                    dev_point['ALDB'] = device._aldb.get_all_records_str()
-                    plm_point['Devices'][address] = dev_point
-            try:
-                json_string = json.dumps(out_data,
-                                         sort_keys=True,
-                                         indent=4,
-                                         ensure_ascii=False)
-            except Exception:
-                print ('error writing config to file')
-            else:
-                outfile = open('config.json', 'w')
-                outfile.write(json_string)
-                outfile.close()
+                out_data['PLMs'][plm.dev_addr_str] = plm_state(plm)
+            write_config(out_data)
             self._saved_state = out_data
             self._last_saved_time = time.time()
 
     def _load_state(self):
-        try:
-            with open('config.json', 'r') as infile:
-                read_data = infile.read()
-            read_data = json.loads(read_data)
-        except FileNotFoundError:
-            read_data = {}
-        except ValueError:
-            read_data = {}
-            print('unable to read config file, skipping')
+        read_data = read_config()
         if 'PLMs' in read_data:
             for plm_id, plm_data in read_data['PLMs'].items():
                 self.add_plm(attributes=plm_data, device_id=plm_id)
 
     def _signal_handler(self, signal, frame):
-        # Catches a Ctrl + C and Saves the Config before exiting
-        self._save_state(True)
+        # Catches a Ctrl + C, the config is saved by close at exit
         print('You pressed Ctrl+C!')
         sys.exit(0)
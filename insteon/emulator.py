@@ -0,0 +1,336 @@
+'''
+An emulated PLM and Insteon network on a pseudo terminal.
+
+PLM_Emulator opens a pty and answers the PLM protocol on the master side,
+so a real PLM object can be connected to the slave side like any serial
+port.  It is meant for tests and load tests, where no hardware is
+available.
+
+The emulator acks each message sent to it and answers plm_info and the
+all link database queries.  Messages sent to one of its Emulated_Devices
+are answered by that device after its ack latency and one hop delay per
+hop used.  A device can also repeat its ack as the repeaters on the
+network would, each copy one hop delay later with one less hop left, and
+can nak a share of the messages sent to it.  The PLM itself can be made
+to answer a share of the messages with a 0x15 busy byte or with a nak.
+
+A device with aldb_records answers the extended read_aldb command with its
+records, one per 0x51 message, either the one record asked for or every
+record from the one asked for to the end.  The end of the database is an
+empty high water record after the last one given.  A share of the records
+sent can be lost on the way.
+
+The answers are written from a thread.  Random choices come from a
+random.Random, which can be seeded to make a run repeatable.
+'''
+import heapq
+import itertools
+import os
+import random
+import select
+import threading
+import time
+
+from .framing import Frame_Decoder, SENT_LENGTHS
+from .helpers import *
+
+PLM_ACK = 0x06
+PLM_NAK = 0x15
+# Seconds taken by one hop of a standard and of an extended message
+HOP_DELAY = {False: 0.050, True: 0.109}
+# Message types in the top bits of the message flags
+MSG_TYPE_ACK = 0x20
+MSG_TYPE_NAK = 0xA0
+EXTENDED_FLAG = 0x10
+# The address of the first record in a device all link database
+ALDB_START = 0x0FFF
+
+
+class Emulated_Device(object):
+    '''A device on the emulated network'''
+
+    def __init__(self, address, dev_cat=0x02, sub_cat=0x20, firmware=0x41,
+                 engine_version=0x02, aldb_delta=0x00, ack_latency=0.0,
+                 hops=0, duplicates=0, nak_rate=0.0, nak_reason=0xFE,
+                 aldb_records=(), aldb_loss_rate=0.0):
+        '''hops is the number of hops a message needs to reach the device,
+        duplicates the number of repeated copies of each ack.  nak_rate is
+        the share of messages answered with a nak with cmd_2 of
+        nak_reason.  aldb_records are the 8 byte records of the all link
+        database and aldb_loss_rate the share of the records sent that
+        never arrive'''
+        self._address = bytes(ID_STR_TO_BYTES(address))
+        self._dev_cat = dev_cat
+        self._sub_cat = sub_cat
+        self._firmware = firmware
+        self._engine_version = engine_version
+        self._aldb_delta = aldb_delta
+        self.ack_latency = ack_latency
+        self.hops = hops
+        self.duplicates = duplicates
+        self.nak_rate = nak_rate
+        self.nak_reason = nak_reason
+        self.level = 0x00
+        self.rcvd = []
+        self.aldb = [bytes(record) for record in aldb_records]
+        self.aldb_loss_rate = aldb_loss_rate
+
+    @property
+    def address(self):
+        return self._address
+
+    @property
+    def dev_addr_str(self):
+        return BYTE_TO_ID(*self._address)
+
+    @property
+    def attributes(self):
+        '''The attributes a PLM needs to know the device without asking'''
+        return {
+            'dev_cat': self._dev_cat,
+            'sub_cat': self._sub_cat,
+            'firmware': self._firmware,
+            'engine_version': self._engine_version,
+            'aldb_delta': self._aldb_delta,
+        }
+
+    def aldb_records(self, msb, lsb, count):
+        '''Returns the address and the record of each record read by a
+        read_aldb of count records from msb and lsb.  A count of 0 reads
+        to the end, an address of 0 is the first record'''
+        ret = []
+        address = (msb << 8) | lsb
+        if address == 0:
+            address = ALDB_START
+        index = (ALDB_START - address) // 8
+        records = self.aldb + [bytes(8)]
+        end = len(records) if count == 0 else index + count
+        for index in range(max(0, index), min(end, len(records))):
+            ret.append((ALDB_START - index * 8, records[index]))
+        return ret
+
+    def answer(self, cmd_1, cmd_2):
+        '''Returns the cmd_1 and cmd_2 of the ack to a direct message'''
+        if cmd_1 == 0x19:
+            # Status request, answered with the aldb delta and level
+            return self._aldb_delta, self.level
+        if cmd_1 == 0x0D:
+            return cmd_1, self._engine_version - 1
+        if cmd_1 in (0x11, 0x12):
+            self.level = cmd_2
+        elif cmd_1 in (0x13, 0x14):
+            self.level = 0x00
+        return cmd_1, cmd_2
+
+
+class PLM_Emulator(object):
+    '''Answers the PLM protocol on the master side of a pseudo terminal'''
+
+    def __init__(self, plm_id='20F5F5', devices=(), aldb_records=(),
+                 dev_cat=0x03, sub_cat=0x15, firmware=0x9B, busy_rate=0.0,
+                 plm_nak_rate=0.0, hop_delay=HOP_DELAY, seed=None):
+        '''aldb_records are the 8 byte records of the PLM all link
+        database.  busy_rate is the share of messages answered with a busy
+        byte and plm_nak_rate the share answered with a nak'''
+        self._plm_id = bytes(ID_STR_TO_BYTES(plm_id))
+        self._info = bytes([dev_cat, sub_cat, firmware])
+        self._devices = {}
+        for device in devices:
+            self.add_device(device)
+        self._aldb_records = [bytes(record) for record in aldb_records]
+        self._aldb_pos = 0
+        self.busy_rate = busy_rate
+        self.plm_nak_rate = plm_nak_rate
+        self._hop_delay = hop_delay
+        self._random = random.Random(seed)
+        self._master, self._slave = os.openpty()
+        self._decoder = Frame_Decoder(length_tables=SENT_LENGTHS)
+        self._scheduled = []
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+        self._wakeup_read, self._wakeup_write = os.pipe()
+        os.set_blocking(self._wakeup_write, False)
+        self._thread = None
+        self._running = False
+        self._stats = {
+            'rcvd': 0,
+            'plm_acks': 0,
+            'plm_naks': 0,
+            'busy': 0,
+            'device_acks': 0,
+            'device_naks': 0,
+            'duplicates': 0,
+            'unknown_devices': 0,
+            'aldb_records': 0,
+            'aldb_lost': 0,
+        }
+
+    @property
+    def port(self):
+        '''The name of the pty to give the PLM as its port'''
+        return os.ttyname(self._slave)
+
+    @property
+    def plm_id(self):
+        return BYTE_TO_ID(*self._plm_id)
+
+    @property
+    def stats(self):
+        '''Returns a dictionary of the message counters'''
+        return self._stats.copy()
+
+    def add_device(self, device):
+        self._devices[device.address] = device
+
+    def get_device_by_addr(self, addr):
+        return self._devices.get(bytes(ID_STR_TO_BYTES(addr)))
+
+    def plm_attributes(self):
+        '''Attributes for building a PLM that already knows the devices'''
+        devices = {}
+        for device in self._devices.values():
+            devices[device.dev_addr_str] = device.attributes
+        return {'port': self.port, 'Devices': devices}
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        self._wakeup()
+        if self._thread is not None:
+            self._thread.join()
+        for fd in (self._master, self._slave, self._wakeup_read,
+                   self._wakeup_write):
+            os.close(fd)
+
+    def push(self, data, delay=0):
+        '''Writes data to the PLM after delay seconds, as if it came from
+        the network'''
+        self._schedule(delay, bytes(data))
+
+    def _schedule(self, delay, data):
+        with self._lock:
+            heapq.heappush(self._scheduled, (time.time() + delay,
+                                             next(self._counter), data))
+        self._wakeup()
+
+    def _wakeup(self):
+        try:
+            os.write(self._wakeup_write, b'\x00')
+        except BlockingIOError:
+            # The pipe is full, so a wake up is already waiting
+            pass
+
+    def _run(self):
+        while self._running:
+            timeout = None
+            with self._lock:
+                if self._scheduled:
+                    timeout = max(0, self._scheduled[0][0] - time.time())
+            readable = select.select([self._master, self._wakeup_read], [],
+                                     [], timeout)[0]
+            if self._wakeup_read in readable:
+                os.read(self._wakeup_read, 4096)
+            if self._master in readable:
+                self._decoder.feed(os.read(self._master, 4096))
+                frame = self._decoder.next_frame()
+                while frame is not None:
+                    self._answer(bytes(frame))
+                    frame = self._decoder.next_frame()
+            self._write_due()
+
+    def _write_due(self):
+        now = time.time()
+        due = []
+        with self._lock:
+            while self._scheduled and self._scheduled[0][0] <= now:
+                due.append(heapq.heappop(self._scheduled)[2])
+        if due:
+            os.write(self._master, b''.join(due))
+
+    def _answer(self, frame):
+        '''Answers one message sent by the PLM'''
+        self._stats['rcvd'] += 1
+        if self._random.random() < self.busy_rate:
+            self._stats['busy'] += 1
+            os.write(self._master, bytes([PLM_NAK]))
+            return
+        if self._random.random() < self.plm_nak_rate:
+            self._stats['plm_naks'] += 1
+            os.write(self._master, frame + bytes([PLM_NAK]))
+            return
+        prefix = frame[1]
+        if prefix == 0x60:
+            reply = frame + self._plm_id + self._info + bytes([PLM_ACK])
+        elif prefix in (0x69, 0x6A):
+            if prefix == 0x69:
+                self._aldb_pos = 0
+            if self._aldb_pos < len(self._aldb_records):
+                record = self._aldb_records[self._aldb_pos]
+                self._aldb_pos += 1
+                reply = frame + bytes([PLM_ACK, 0x02, 0x57]) + record
+            else:
+                reply = frame + bytes([PLM_NAK])
+        else:
+            reply = frame + bytes([PLM_ACK])
+        self._stats['plm_acks'] += 1
+        os.write(self._master, reply)
+        if prefix == 0x62:
+            self._device_answer(frame)
+
+    def _device_answer(self, frame):
+        '''Schedules the acks of the device a direct message was sent to'''
+        device = self._devices.get(frame[2:5])
+        if device is None:
+            self._stats['unknown_devices'] += 1
+            return
+        device.rcvd.append(frame)
+        flags = frame[5]
+        max_hops = flags & 0b11
+        hops_used = min(device.hops, max_hops)
+        hops_left = max_hops - hops_used
+        # The ack is a standard message whatever the length of the command
+        hop_delay = self._hop_delay[False]
+        delay = (device.ack_latency +
+                 hops_used * self._hop_delay[bool(flags & EXTENDED_FLAG)])
+        if self._random.random() < device.nak_rate:
+            msg_type = MSG_TYPE_NAK
+            cmd_1, cmd_2 = frame[6], device.nak_reason
+            self._stats['device_naks'] += 1
+        else:
+            msg_type = MSG_TYPE_ACK
+            cmd_1, cmd_2 = device.answer(frame[6], frame[7])
+            self._stats['device_acks'] += 1
+        for copy in range(device.duplicates + 1):
+            if hops_left - copy < 0:
+                break
+            ack = (bytes([0x02, 0x50]) + device.address + self._plm_id +
+                   bytes([msg_type | ((hops_left - copy) << 2) | max_hops,
+                          cmd_1, cmd_2]))
+            self._schedule(delay + copy * hop_delay, ack)
+            if copy:
+                self._stats['duplicates'] += 1
+        if (msg_type == MSG_TYPE_ACK and frame[6] == 0x2F and
+                flags & EXTENDED_FLAG and frame[9] == 0x00):
+            self._send_aldb(device, frame, delay, hops_left, max_hops)
+
+    def _send_aldb(self, device, frame, delay, hops_left, max_hops):
+        '''Schedules the records asked for by a read_aldb, each in its own
+        extended message'''
+        interval = self._hop_delay[True] * (max_hops - hops_left + 1)
+        records = device.aldb_records(frame[10], frame[11], frame[12])
+        for i, (address, record) in enumerate(records):
+            if self._random.random() < device.aldb_loss_rate:
+                self._stats['aldb_lost'] += 1
+                continue
+            data = (bytes([0x2F, 0x00, 0x00, 0x01, address >> 8,
+                           address & 0xFF, 0x00]) + record)
+            checksum = (-sum(data)) & 0xFF
+            msg = (bytes([0x02, 0x51]) + device.address + self._plm_id +
+                   bytes([EXTENDED_FLAG | (hops_left << 2) | max_hops]) +
+                   data + bytes([checksum]))
+            self._schedule(delay + (i + 1) * interval, msg)
+            self._stats['aldb_records'] += 1
@@ -0,0 +1,142 @@
+from .buffer import Read_Buffer
+from .msg_layout import PLM_REGISTRY
+from .helpers import *
+
+MSG_START = 0x02
+PLM_BUSY = 0x15
+EXTENDED_FLAG = 0b00010000
+
+
+def _build_length_tables(registry, is_incomming):
+    '''Returns three 256 entry tables indexed by the plm command prefix.
+    The standard length of the message, the extended length of the
+    message, and the position of the msg_flags byte which decides
+    between the two.  A length of 0 marks an unknown prefix and a flag
+    position of 0 marks a message with only one length.'''
+    std_lengths = [0] * 256
+    ext_lengths = [0] * 256
+    flag_positions = [0] * 256
+    for layout in registry.layouts():
+        std_layout = layout.field_layout(is_incomming)
+        if std_layout is None:
+            continue
+        ext_layout = layout.field_layout(is_incomming, True)
+        std_lengths[layout.prefix] = std_layout.length
+        ext_lengths[layout.prefix] = ext_layout.length
+        if ext_layout is not std_layout:
+            flag_positions[layout.prefix] = std_layout.positions['msg_flags']
+    return tuple(std_lengths), tuple(ext_lengths), tuple(flag_positions)
+
+RCVD_LENGTHS = _build_length_tables(PLM_REGISTRY, True)
+# The lengths of the messages sent to a plm, for framing them on the plm end
+# of the port
+SENT_LENGTHS = _build_length_tables(PLM_REGISTRY, False)
+
+
+class Frame_Decoder(object):
+    '''Incrementally splits the bytes received from a PLM into messages.
+
+    Bytes are added to the read buffer as they arrive, each call to
+    next_frame returns a memoryview of the next complete message or None if
+    only a partial message remains.  The returned view points into the read
+    buffer and is only valid until more bytes are added to the buffer.
+
+    Bytes that do not start a message are skipped until the next 0x02.  A
+    0x15 at the start of a message is the PLM saying that it is busy, these
+    are removed and passed to busy_callback.'''
+
+    def __init__(self, read_buffer=None, busy_callback=None,
+                 length_tables=RCVD_LENGTHS):
+        if read_buffer is None:
+            read_buffer = Read_Buffer()
+        self._buffer = read_buffer
+        self._busy_callback = busy_callback
+        self._std_lengths, self._ext_lengths, self._flag_positions = \
+            length_tables
+        self._stats = {
+            'frames': 0,
+            'busy_bytes': 0,
+            'skipped_bytes': 0,
+            'unknown_prefixes': 0,
+            'resyncs': 0,
+        }
+
+    @property
+    def buffer(self):
+        return self._buffer
+
+    @property
+    def stats(self):
+        '''Returns a dictionary of the frame and resync counters'''
+        return self._stats.copy()
+
+    def feed(self, data):
+        '''Adds received bytes to the read buffer'''
+        self._buffer.extend(data)
+
+    def frames(self, limit=None):
+        '''Yields each complete message in the buffer, up to limit'''
+        count = 0
+        while limit is None or count < limit:
+            frame = self.next_frame()
+            if frame is None:
+                break
+            count += 1
+            yield frame
+
+    def next_frame(self):
+        '''Returns a memoryview of the next complete message or None'''
+        view = self._buffer.view()
+        end = len(view)
+        pos = 0
+        ret = None
+        while pos < end:
+            byte = view[pos]
+            if byte == MSG_START:
+                if end - pos < 2:
+                    break
+                prefix = view[pos + 1]
+                length = self._std_lengths[prefix]
+                if length == 0:
+                    print("error, I don't know this prefix",
+                          BYTE_TO_HEX(bytes([prefix])))
+                    self._stats['unknown_prefixes'] += 1
+                    pos = self._skip_to_msg_start(view, pos + 1)
+                    continue
+                flag_pos = self._flag_positions[prefix]
+                if flag_pos:
+                    # 0x62 messages can be either standard or extended
+                    # length, only the message flags tell us which
+                    if end - pos <= flag_pos:
+                        break
+                    if view[pos + flag_pos] & EXTENDED_FLAG:
+                        length = self._ext_lengths[prefix]
+                if end - pos < length:
+                    break
+                ret = view[pos:pos + length]
+                pos += length
+                self._stats['frames'] += 1
+                break
+            elif byte == PLM_BUSY:
+                self._stats['busy_bytes'] += 1
+                pos += 1
+                if self._busy_callback is not None:
+                    self._busy_callback()
+            else:
+                pos = self._skip_to_msg_start(view, pos)
+        self._buffer.consume(pos)
+        return ret
+
+    def _skip_to_msg_start(self, view, pos):
+        '''Returns the position of the next byte that can start a message,
+        counting the bytes skipped along the way'''
+        start = pos
+        end = len(view)
+        while pos < end and view[pos] != MSG_START and view[pos] != PLM_BUSY:
+            pos += 1
+        if pos > start:
+            print('Removed bad starting string',
+                  BYTE_TO_HEX(bytes(view[start:pos])))
+            self._stats['skipped_bytes'] += pos - start
+        self._stats['resyncs'] += 1
+        return pos
@@ -0,0 +1,83 @@
+'''
+The time an Insteon message takes to hop, learned from the network.
+
+Each repeater that hears a message sends it again one hop time later with
+one less hop left, so a PLM often receives copies of the same message.
+After receiving a message the PLM waits for the copies still to come
+before sending, and drops copies that arrive within a dedup window.  Both
+are a number of hop times, which depend on the installation.
+
+Hop_Timing measures the hop time from the copies themselves: the time
+between the first copy and a later one, divided by the hops between them.
+A Latency_Tracker per message length turns the gaps into a hop time with
+a safety margin of several mean deviations, within HOP_TIMING_MIN and
+twice the default.  The dedup window adds HOP_DEDUP_MARGIN on top.  Until
+enough copies have been seen the defaults, which come from real world
+use, are kept.  Each PLM has its own Hop_Timing and saves it in its
+attributes.
+'''
+from .latency import Latency_Tracker
+
+# Seconds per hop waited after a message, and per hop of the dedup
+# window, until the hop time has been measured
+HOP_WAIT = {'standard': 0.050, 'extended': 0.109}
+HOP_DEDUP = {'standard': 0.087, 'extended': 0.183}
+# The least hop time that is used, whatever the measurements
+HOP_TIMING_MIN = 0.020
+# The dedup window per hop is the hop time times this
+HOP_DEDUP_MARGIN = 1.5
+
+
+class Hop_Timing(object):
+    '''Learns the hop time of the standard and extended messages'''
+
+    def __init__(self):
+        self._trackers = {}
+        for msg_length, default in HOP_WAIT.items():
+            self._trackers[msg_length] = Latency_Tracker(HOP_TIMING_MIN,
+                                                         default * 2)
+
+    def add_gap(self, msg_length, gap):
+        '''Adds the seconds per hop between two copies of a message.  Gaps
+        too long to be copies are ignored'''
+        if 0 < gap <= HOP_DEDUP[msg_length] * 2:
+            self._trackers[msg_length].add(gap)
+
+    def hop_wait(self, msg_length):
+        '''Returns the seconds to wait for each hop left on a message'''
+        return self._trackers[msg_length].timeout(HOP_WAIT[msg_length])
+
+    def dedup_window(self, msg_length):
+        '''Returns the seconds per hop left during which copies of a
+        message are dropped'''
+        ret = HOP_DEDUP[msg_length]
+        tracker = self._trackers[msg_length]
+        measured = tracker.timeout(None)
+        if measured is not None:
+            ret = measured * HOP_DEDUP_MARGIN
+        return ret
+
+    @property
+    def stats(self):
+        '''Returns a dictionary of the gaps measured and the times in use
+        for each message length'''
+        ret = {}
+        for msg_length, tracker in self._trackers.items():
+            ret[msg_length] = tracker.stats
+            ret[msg_length]['hop_wait'] = self.hop_wait(msg_length)
+            ret[msg_length]['dedup_window'] = self.dedup_window(msg_length)
+        return ret
+
+    def save(self):
+        '''Returns the state to store in the attributes'''
+        ret = {}
+        for msg_length, tracker in self._trackers.items():
+            ret[msg_length] = tracker.save()
+        return ret
+
+    def load(self, state):
+        '''Restores the state returned by save, state may be None'''
+        if state:
+            for msg_length, tracker_state in state.items():
+                if msg_length in self._trackers:
+                    self._trackers[msg_length].load(tracker_state)
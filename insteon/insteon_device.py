@@ -4,14 +4,103 @@ import pprint
 
 from .base_objects import Base_Device, Device_ALDB, Insteon_Group, Root_Insteon
 from .msg_schema import *
-from .message import PLM_Message, Insteon_Message
+from .message import PLM_Message, Insteon_Message, Command_Template, \
+    PRIORITY_NORMAL, PRIORITY_BACKGROUND
+from .latency import Latency_Tracker
 from .helpers import *
 
+# Changing any of these changes which commands the device supports
+IDENTITY_ATTRIBUTES = ('dev_cat', 'sub_cat', 'firmware', 'engine_version')
+# Bounds of the device ack timeout derived from the measured acks
+DEVICE_ACK_TIMEOUT_MIN = 0.1
+DEVICE_ACK_TIMEOUT_MAX = 5.0
+
+
+def search_cmd_schema(command, search_item):
+    '''Returns the value of the entry in command matching search_item, an
+    entry listing the value is preferred over an 'all' entry.  Returns False
+    if nothing matches'''
+    unique_cmd = ''
+    catch_all_cmd = ''
+    for command_item in command:
+        if isinstance(command_item[search_item[0]], tuple):
+            if search_item[1] in command_item[search_item[0]]:
+                unique_cmd = command_item['value']
+        elif command_item[search_item[0]] == 'all':
+            catch_all_cmd = command_item['value']
+    if unique_cmd != '':
+        return unique_cmd
+    elif catch_all_cmd != '':
+        return catch_all_cmd
+    else:
+        return False
+
+
+class Handler_Cache(object):
+    '''Remembers which handler in an incoming message schema applies to a
+    cmd_1, dev_cat, sub_cat, firmware and cmd_2.
+
+    The handlers in the schema take the device as an argument, so one cache
+    is shared by every device and each model only pays for the schema
+    search once.  Searches that find no handler are remembered as well.'''
+
+    def __init__(self, schema, max_size=4096):
+        self._schema = schema
+        self._max_size = max_size
+        self._handlers = {}
+        self._stats = {'hits': 0, 'misses': 0, 'clears': 0}
+
+    @property
+    def schema(self):
+        return self._schema
+
+    @property
+    def stats(self):
+        '''Returns a dictionary of the hit and miss counters'''
+        ret = self._stats.copy()
+        ret['size'] = len(self._handlers)
+        return ret
+
+    def resolve(self, cmd_1, dev_cat, sub_cat, firmware, cmd_2):
+        '''Returns the handler for the message or False if there is none'''
+        key = (cmd_1, dev_cat, sub_cat, firmware, cmd_2)
+        try:
+            ret = self._handlers[key]
+        except KeyError:
+            pass
+        else:
+            self._stats['hits'] += 1
+            return ret
+        self._stats['misses'] += 1
+        ret = self._search(key)
+        if len(self._handlers) >= self._max_size:
+            # Only reached if devices send a flood of distinct cmd_2 values
+            self._handlers.clear()
+            self._stats['clears'] += 1
+        self._handlers[key] = ret
+        return ret
+
+    def _search(self, key):
+        command = self._schema.get(key[0], False)
+        for search_item in zip(('DevCat', 'SubCat', 'Firmware', 'Cmd2'),
+                               key[1:]):
+            if not command:
+                break
+            command = search_cmd_schema(command, search_item)
+        return command
+
+    def clear(self):
+        self._handlers.clear()
+
+EXT_DIRECT_HANDLERS = Handler_Cache(EXT_DIRECT_SCHEMA)
+STD_DIRECT_ACK_HANDLERS = Handler_Cache(STD_DIRECT_ACK_SCHEMA)
+
 
 class Insteon_Device(Root_Insteon):
 
     def __init__(self, core, plm, **kwargs):
         self._aldb = Device_ALDB(self)
+        self._command_templates = {}
         super().__init__(core, plm, **kwargs)
         id_bytes = ID_STR_TO_BYTES(kwargs['device_id'])
         self._dev_addr_hi = id_bytes[0]
@@ -20,12 +109,39 @@ class Insteon_Device(Root_Insteon):
         self.last_sent_msg = ''
         self.last_rcvd_msg = ''
         self._recent_inc_msgs = {}
+        self._ack_latency = {}
+        saved = self.attribute('ack_latency') or {}
+        for msg_length in ('standard', 'extended'):
+            tracker = Latency_Tracker(DEVICE_ACK_TIMEOUT_MIN,
+                                      DEVICE_ACK_TIMEOUT_MAX)
+            # A state saved for all lengths together has no entry here
+            tracker.load(saved.get(msg_length))
+            self._ack_latency[msg_length] = tracker
         self.create_group(1, Insteon_Group)
         self._init_step_1()
 
+    @property
+    def ack_latency(self):
+        '''A dictionary of the Latency_Tracker of the time between the PLM
+        ack and the device ack of a message, for each message length'''
+        return self._ack_latency.copy()
+
+    def _add_ack_latency(self, msg):
+        '''Measures the device ack of msg, unless msg was resent'''
+        if (msg.plm_retry == 0 and msg.insteon_msg.device_retry == 0 and
+                msg.time_plm_ack):
+            rcvd_time = self.plm.time_rcvd or time.time()
+            self._ack_latency[msg.insteon_msg.msg_length].add(
+                rcvd_time - msg.time_plm_ack)
+            saved = {}
+            for msg_length, tracker in self._ack_latency.items():
+                saved[msg_length] = tracker.save()
+            self.attribute('ack_latency', saved)
+
     def _init_step_1(self):
         if self.attribute('engine_version') is None:
-            self.send_command('get_engine_version')
+            self.send_command('get_engine_version',
+                              priority=PRIORITY_BACKGROUND)
         else:
             self._init_step_2()
 
@@ -33,12 +149,13 @@ class Insteon_Device(Root_Insteon):
         if (self.attribute('dev_cat') is None or
                 self.attribute('sub_cat') is None or
                 self.attribute('firmware') is None):
-            self.send_command('id_request')
+            self.send_command('id_request', priority=PRIORITY_BACKGROUND)
         else:
             self._init_step_3()
 
     def _init_step_3(self):
-        self.send_command('light_status_request')
+        self.send_command('light_status_request',
+                          priority=PRIORITY_BACKGROUND)
 
     @property
     def dev_addr_hi(self):
@@ -52,6 +169,12 @@ class Insteon_Device(Root_Insteon):
     def dev_addr_low(self):
         return self._dev_addr_low
 
+    @property
+    def dev_addr_str(self):
+        ret = BYTE_TO_HEX(
+            bytes([self.dev_addr_hi, self.dev_addr_mid, self.dev_addr_low]))
+        return ret
+
     @property
     def dev_cat(self):
         return self.attribute('dev_cat')
@@ -64,6 +187,12 @@ class Insteon_Device(Root_Insteon):
     def firmware(self):
         return self.attribute('firmware')
 
+    def attribute(self, attr, value=None):
+        if (value is not None and attr in IDENTITY_ATTRIBUTES and
+                self._attributes.get(attr) != value):
+            self._command_templates.clear()
+        return super().attribute(attr, value)
+
     @property
     def smart_hops(self):
         if self.attribute('hop_array') is not None:
@@ -124,7 +253,10 @@ class Insteon_Device(Root_Insteon):
                     to_delete.append(i)
                 i += 1
             for position in reversed(to_delete):
+                # The cleanup ack covers the queued cleanup message
+                msgs[position]._resolve_future()
                 del self._device_msg_queue[state][position]
+        self._queue_changed()
 
     def _process_direct_msg(self, msg):
         '''processes an incomming direct message'''
@@ -132,22 +264,19 @@ class Insteon_Device(Root_Insteon):
         self._add_to_hop_array(hops_used)
         if (msg.insteon_msg.msg_length == 'extended' and
                 msg.get_byte_by_name('cmd_1') in EXT_DIRECT_SCHEMA):
-            command = EXT_DIRECT_SCHEMA[msg.get_byte_by_name('cmd_1')]
-            search_list = [
-                ['DevCat', self.attribute('dev_cat')],
-                ['SubCat', self.attribute('sub_cat')],
-                ['Firmware', self.attribute('firmware')],
-                ['Cmd2', msg.get_byte_by_name('cmd_2')]
-            ]
-            for search_item in search_list:
-                command = self._recursive_search_cmd(command, search_item)
-                if not command:
-                    print('not sure how to respond to this')
-                    return
+            command = EXT_DIRECT_HANDLERS.resolve(
+                msg.get_byte_by_name('cmd_1'),
+                self.attribute('dev_cat'),
+                self.attribute('sub_cat'),
+                self.attribute('firmware'),
+                msg.get_byte_by_name('cmd_2'))
+            if not command:
+                print('not sure how to respond to this')
+                return
             command(self, msg)
         else:
             print('direct message, that I dont know how to handle')
-            pprint.pprint(msg.__dict__)
+            print(BYTE_TO_HEX(msg.raw_view))
 
     def _process_direct_ack(self, msg):
         '''processes an incomming direct ack message'''
@@ -162,7 +291,8 @@ class Insteon_Device(Root_Insteon):
             if self.state_machine == 'set_aldb_delta':
                 self.attribute('aldb_delta', aldb_delta)
                 self.remove_state_machine('set_aldb_delta')
-            elif self.attribute('aldb_delta') != aldb_delta:
+            elif (self.attribute('aldb_delta') != aldb_delta and
+                    not self.state_pending('query_aldb')):
                 print('aldb has changed, rescanning')
                 self._aldb.query_aldb()
             # TODO, we want to change aldb_deltas that are at 0x00
@@ -171,18 +301,15 @@ class Insteon_Device(Root_Insteon):
         elif (self.last_sent_msg.get_byte_by_name('cmd_1') ==
                 msg.get_byte_by_name('cmd_1')):
             if msg.get_byte_by_name('cmd_1') in STD_DIRECT_ACK_SCHEMA:
-                command = STD_DIRECT_ACK_SCHEMA[msg.get_byte_by_name('cmd_1')]
-                search_list = [
-                    ['DevCat', self.attribute('dev_cat')],
-                    ['SubCat', self.attribute('sub_cat')],
-                    ['Firmware', self.attribute('firmware')],
-                    ['Cmd2', self.last_sent_msg.get_byte_by_name('cmd_2')]
-                ]
-                for search_item in search_list:
-                    command = self._recursive_search_cmd(command, search_item)
-                    if not command:
-                        print('not sure how to respond to this')
-                        return
+                command = STD_DIRECT_ACK_HANDLERS.resolve(
+                    msg.get_byte_by_name('cmd_1'),
+                    self.attribute('dev_cat'),
+                    self.attribute('sub_cat'),
+                    self.attribute('firmware'),
+                    self.last_sent_msg.get_byte_by_name('cmd_2'))
+                if not command:
+                    print('not sure how to respond to this')
+                    return
                 is_ack = command(self, msg)
                 if is_ack != False:
                     self.last_sent_msg.insteon_msg.device_ack = True
@@ -191,7 +318,7 @@ class Insteon_Device(Root_Insteon):
                 self.last_sent_msg.insteon_msg.device_ack = True
         else:
             print('ignoring an unmatched ack')
-            pprint.pprint(msg.__dict__)
+            print(BYTE_TO_HEX(msg.raw_view))
 
     def _process_direct_nack(self, msg):
         '''processes an incomming direct nack message'''
@@ -207,17 +334,17 @@ class Insteon_Device(Root_Insteon):
                 if cmd_2 == 0xFF:
                     print('nack received, senders ID not in database')
                     self.attribute('engine_version', 0x02)
-                    self.last_sent_msg.insteon_msg.device_ack = True
+                    self.last_sent_msg.insteon_msg.device_nak(msg)
                     print('creating plm->device link')
                     self.add_plm_to_dev_link()
                 elif cmd_2 == 0xFE:
                     print('nack received, no load')
                     self.attribute('engine_version', 0x02)
-                    self.last_sent_msg.insteon_msg.device_ack = True
+                    self.last_sent_msg.insteon_msg.device_nak(msg)
                 elif cmd_2 == 0xFD:
                     print('nack received, checksum is incorrect, resending')
                     self.attribute('engine_version', 0x02)
-                    self.plm.wait_to_send = 1
+                    self.plm.pacer.nak()
                     self._resend_msg(self.last_sent_msg)
                 elif cmd_2 == 0xFC:
                     print(
@@ -227,21 +354,24 @@ class Insteon_Device(Root_Insteon):
                 elif cmd_2 == 0xFB:
                     print('nack received, illegal value in command')
                     self.attribute('engine_version', 0x02)
-                    self.last_sent_msg.insteon_msg.device_ack = True
+                    self.last_sent_msg.insteon_msg.device_nak(msg)
                 else:
                     print(
                         'device nack`ed the last command, no further details, resending')
-                    self.plm.wait_to_send = 1
+                    self.plm.pacer.nak()
                     self._resend_msg(self.last_sent_msg)
             else:
                 print('device nack`ed the last command, resending')
-                self.plm.wait_to_send = 1
+                self.plm.pacer.nak()
         else:
             print('ignoring unmatched nack')
 
     def _is_valid_direct_ack(self, msg):
         ret = True
-        if self.last_sent_msg.plm_ack != True:
+        if not self.last_sent_msg:
+            print('ignoring a device response, nothing was sent')
+            ret = False
+        elif self.last_sent_msg.plm_ack != True:
             print('ignoring a device response received before PLM ack')
             ret = False
         elif self.last_sent_msg.insteon_msg.device_ack != False:
@@ -264,9 +394,8 @@ class Insteon_Device(Root_Insteon):
 
     def _set_plm_wait(self, msg):
         # Wait for additional hops to arrive
-        hop_delay = 50 if msg.insteon_msg.msg_length == 'standard' else 109
-        total_delay = hop_delay * msg.insteon_msg.hops_left
-        expire_time = (total_delay / 1000)
+        hop_delay = self.plm.hop_timing.hop_wait(msg.insteon_msg.msg_length)
+        expire_time = hop_delay * msg.insteon_msg.hops_left
         # Force a 5 millisecond delay for all
         self.plm.wait_to_send = expire_time + (5 / 1000)
 
@@ -275,6 +404,7 @@ class Insteon_Device(Root_Insteon):
         ret = None
         self._clear_stale_dupes()
         if self._is_msg_in_recent(msg):
+            self._measure_hop_gap(msg)
             ret = True
         else:
             self._store_msg_in_recent(msg)
@@ -284,8 +414,8 @@ class Insteon_Device(Root_Insteon):
     def _clear_stale_dupes(self):
         current_time = time.time()
         msgs_to_delete = []
-        for msg, wait_time in self._recent_inc_msgs.items():
-            if wait_time < current_time:
+        for msg, recent in self._recent_inc_msgs.items():
+            if recent[0] < current_time:
                 msgs_to_delete.append(msg)
         for msg in msgs_to_delete:
             del self._recent_inc_msgs[msg]
@@ -295,7 +425,7 @@ class Insteon_Device(Root_Insteon):
         # arguable whether this should be done in the Insteon_Message class
         search_bytes = msg.raw_msg
         search_bytes[8] = search_bytes[8] & 0b11110000
-        return BYTE_TO_HEX(search_bytes)
+        return bytes(search_bytes)
 
     def _is_msg_in_recent(self, msg):
         search_key = self._get_search_key(msg)
@@ -303,12 +433,27 @@ class Insteon_Device(Root_Insteon):
             return True
 
     def _store_msg_in_recent(self, msg):
+        '''Remembers msg with the time it expires, the time it arrived and
+        its hops left'''
         search_key = self._get_search_key(msg)
-        # These numbers come from real world use
-        hop_delay = 87 if msg.insteon_msg.msg_length == 'standard' else 183
+        hop_delay = self.plm.hop_timing.dedup_window(
+            msg.insteon_msg.msg_length)
         total_delay = hop_delay * msg.insteon_msg.hops_left
-        expire_time = time.time() + (total_delay / 1000)
-        self._recent_inc_msgs[search_key] = expire_time
+        rcvd_time = self.plm.time_rcvd or time.time()
+        self._recent_inc_msgs[search_key] = (time.time() + total_delay,
+                                             rcvd_time,
+                                             msg.insteon_msg.hops_left)
+
+    def _measure_hop_gap(self, msg):
+        '''Tells the plm the time per hop between the first copy of msg and
+        this one'''
+        expire_time, first_time, first_hops_left = \
+            self._recent_inc_msgs[self._get_search_key(msg)]
+        hops = first_hops_left - msg.insteon_msg.hops_left
+        if hops > 0:
+            rcvd_time = self.plm.time_rcvd or time.time()
+            self.plm._add_hop_gap(msg.insteon_msg.msg_length,
+                                  (rcvd_time - first_time) / hops)
 
     ###################################################################
     ##
@@ -348,7 +493,8 @@ class Insteon_Device(Root_Insteon):
                 for key in sorted(records):
                     print(key, ":", BYTE_TO_HEX(records[key]))
                 self.remove_state_machine('query_aldb')
-                self.send_command('light_status_request', 'set_aldb_delta')
+                self.send_command('light_status_request', 'set_aldb_delta',
+                                  priority=PRIORITY_BACKGROUND)
             elif self._aldb.is_empty_aldb(self._aldb._get_aldb_key(msb, lsb)):
                 # this is an empty record
                 print('empty record')
@@ -366,6 +512,10 @@ class Insteon_Device(Root_Insteon):
                 lsb += 1
                 self._aldb.peek_aldb(lsb)
 
+    def _state_expired(self, state):
+        if state == 'query_aldb':
+            self._aldb.query_stalled()
+
     def _ext_aldb_rcvd(self, msg):
         # Duplicate messages will not cause errors, so we don't check for them
         last_msg = self.search_last_sent_msg(insteon_cmd='read_aldb')
@@ -409,14 +559,41 @@ class Insteon_Device(Root_Insteon):
     ##
     ###################################################################
 
-    def send_command(self, command_name, state='', dev_bytes={}):
+    def send_command(self, command_name, state='', dev_bytes={},
+                     priority=PRIORITY_NORMAL):
+        '''Queues the command, returns a Command_Future of the message or
+        None if the device does not support the command.  priority is the
+        PRIORITY_ class of the message'''
+        ret = None
         message = self.create_message(command_name)
         if message is not None:
             message._insert_bytes_into_raw(dev_bytes)
+            message.priority = priority
             self._queue_device_msg(message, state)
+            ret = message.future
+        return ret
 
     def create_message(self, command_name):
         ret = None
+        template = self._get_command_template(command_name)
+        if template is not None:
+            ret = PLM_Message(self.plm,
+                              device=self,
+                              plm_cmd='insteon_send',
+                              dev_template=template)
+        return ret
+
+    def _get_command_template(self, command_name):
+        '''Returns the cached Command_Template for this command, building
+        it from the COMMAND_SCHEMA the first time'''
+        key = (command_name,
+               self.attribute('dev_cat'),
+               self.attribute('sub_cat'),
+               self.attribute('firmware'),
+               self.attribute('engine_version'))
+        if key in self._command_templates:
+            return self._command_templates[key]
+        ret = None
         try:
             cmd_schema = COMMAND_SCHEMA[command_name]
         except Exception as e:
@@ -437,27 +614,23 @@ class Insteon_Device(Root_Insteon):
             if cmd_schema:
                 command = cmd_schema.copy()
                 command['name'] = command_name
-                ret = PLM_Message(self.plm,
-                                  device=self,
-                                  plm_cmd='insteon_send',
-                                  dev_cmd=command)
+                message = PLM_Message(self.plm,
+                                      device=self,
+                                      plm_cmd='insteon_send',
+                                      dev_cmd=command)
+                ret = Command_Template(message, command)
+                self._command_templates[key] = ret
         return ret
 
     def _recursive_search_cmd(self, command, search_item):
-        unique_cmd = ''
-        catch_all_cmd = ''
-        for command_item in command:
-            if isinstance(command_item[search_item[0]], tuple):
-                if search_item[1] in command_item[search_item[0]]:
-                    unique_cmd = command_item['value']
-            elif command_item[search_item[0]] == 'all':
-                catch_all_cmd = command_item['value']
-        if unique_cmd != '':
-            return unique_cmd
-        elif catch_all_cmd != '':
-            return catch_all_cmd
-        else:
-            return False
+        return search_cmd_schema(command, search_item)
+
+    @property
+    def handler_cache_stats(self):
+        '''Returns the hit and miss counters of the shared caches of
+        incoming message handlers'''
+        return {'ext_direct': EXT_DIRECT_HANDLERS.stats,
+                'std_direct_ack': STD_DIRECT_ACK_HANDLERS.stats}
 
     def write_aldb_record(self, msb, lsb):
         # TODO This is only the base structure still need to add more basically just
@@ -0,0 +1,165 @@
+'''
+Serial I/O for a PLM on its own threads.
+
+A PLM_IO_Thread reads the serial port on a reader thread and writes it on a
+writer thread.  The reader frames the bytes as they arrive and hands each
+complete message, with the time it arrived, to the thread that processes
+the PLM.  Slow reads or writes on one PLM then no longer hold up the others,
+and the arrival time of an ack does not depend on when the PLM is next
+processed.
+
+Each hand off is a collections.deque with one thread appending and the
+other popping.  Both operations are atomic, so neither side takes a lock.
+
+An error from the port, such as a closed socket or a serial port that was
+unplugged, stops both threads.  The error is kept, error_callback is
+called so the PLM can mark its port inactive, and wakeup is called so the
+thread processing the PLM notices.
+'''
+import collections
+import threading
+import time
+
+from .buffer import Read_Buffer
+from .capture import CAPTURE_READ
+from .framing import Frame_Decoder
+
+# Seconds a blocking read waits before checking if the thread should stop
+READ_TIMEOUT = 0.2
+
+
+class PLM_IO_Thread(object):
+    '''Reads and writes the serial port of a PLM on background threads'''
+
+    def __init__(self, serial, wakeup=None, busy_callback=None,
+                 error_callback=None):
+        self._serial = serial
+        self._wakeup = wakeup
+        self._busy_callback = busy_callback
+        self._error_callback = error_callback
+        self._error = None
+        self._decoder = Frame_Decoder(Read_Buffer(),
+                                      busy_callback=self._rcvd_busy)
+        self._frames = collections.deque()
+        self._writes = collections.deque()
+        self._write_event = threading.Event()
+        self._frame_time = 0
+        self._running = False
+        self._reader = None
+        self._writer = None
+        self._rcvd_time = 0
+        # A Capture_Writer that records the bytes read, set by the PLM
+        self.capture = None
+
+    @property
+    def decoder(self):
+        return self._decoder
+
+    @property
+    def frame_time(self):
+        '''The time that the last frame returned by next_frame arrived'''
+        return self._frame_time
+
+    @property
+    def backlog(self):
+        '''The number of frames waiting to be processed'''
+        return len(self._frames)
+
+    @property
+    def error(self):
+        '''The exception that stopped the threads, or None'''
+        return self._error
+
+    def start(self):
+        self._running = True
+        self._serial.timeout = READ_TIMEOUT
+        self._reader = threading.Thread(target=self._read_loop, daemon=True)
+        self._writer = threading.Thread(target=self._write_loop,
+                                        daemon=True)
+        self._reader.start()
+        self._writer.start()
+
+    def stop(self):
+        '''Stops both threads, waiting for them to finish'''
+        self._running = False
+        self._write_event.set()
+        for thread in (self._reader, self._writer):
+            if thread is not None:
+                thread.join()
+        if self._error is None:
+            # A port that failed can not be configured any more
+            self._serial.timeout = 0
+
+    def write(self, data):
+        '''Queues data to be written to the port by the writer thread'''
+        self._writes.append(bytes(data))
+        self._write_event.set()
+
+    def next_frame(self):
+        '''Returns the next complete message, or None.  Busy signals from
+        the PLM are passed to busy_callback in the order they arrived.
+        Call this from the thread that processes the PLM'''
+        frames = self._frames
+        while frames:
+            rcvd_time, frame = frames.popleft()
+            if frame is None:
+                if self._busy_callback is not None:
+                    self._busy_callback()
+                continue
+            self._frame_time = rcvd_time
+            return frame
+        return None
+
+    def _rcvd_busy(self):
+        self._frames.append((self._rcvd_time, None))
+
+    def _read_loop(self):
+        try:
+            self._read_port()
+        except Exception as error:
+            self._failed(error)
+
+    def _read_port(self):
+        serial = self._serial
+        while self._running:
+            # Blocks until at least one byte arrives or READ_TIMEOUT
+            data = serial.read(max(1, serial.inWaiting()))
+            if not data:
+                continue
+            self._rcvd_time = time.time()
+            capture = self.capture
+            if capture is not None:
+                capture.write(CAPTURE_READ, data, self._rcvd_time)
+            self._decoder.feed(data)
+            frame = self._decoder.next_frame()
+            while frame is not None:
+                # The frame is a view of the read buffer, copy it before
+                # the buffer is reused
+                self._frames.append((self._rcvd_time, bytes(frame)))
+                frame = self._decoder.next_frame()
+            if self._wakeup is not None:
+                self._wakeup()
+
+    def _write_loop(self):
+        writes = self._writes
+        try:
+            while self._running:
+                self._write_event.wait()
+                self._write_event.clear()
+                while writes and self._running:
+                    self._serial.write(writes.popleft())
+        except Exception as error:
+            self._failed(error)
+
+    def _failed(self, error):
+        '''Stops both threads after an error on the port'''
+        if self._error is None:
+            self._error = error
+            print('io thread stopped, port error', error)
+        self._running = False
+        self._write_event.set()
+        self._writes.clear()
+        if self._error_callback is not None:
+            self._error_callback()
+        if self._wakeup is not None:
+            self._wakeup()
@@ -0,0 +1,107 @@
+'''
+Ack timeouts derived from the measured ack latencies.
+
+A Latency_Tracker keeps a moving average of the latency and of its mean
+deviation, the way TCP estimates round trip times, plus the last few
+samples for percentiles.  Its timeout is the average plus
+LATENCY_DEVIATIONS deviations, kept within the bounds given to it.  Until
+LATENCY_MIN_SAMPLES samples have been taken the caller's default timeout
+is used.
+
+The PLM keeps one tracker for the time the PLM takes to ack a message and
+every Insteon device keeps one for the time between the PLM ack and the
+device ack.  Only messages acked on their first attempt are measured, an
+ack to a resent message can not be matched to one send.  The state of a
+tracker is saved in the device attributes, so a slow device is known to
+be slow after a restart.
+'''
+import collections
+
+# Weight of a new sample in the average and in the deviation
+LATENCY_GAIN = 1 / 8
+DEVIATION_GAIN = 1 / 4
+# The timeout is the average plus this many mean deviations
+LATENCY_DEVIATIONS = 4
+# Samples needed before the timeout replaces the default
+LATENCY_MIN_SAMPLES = 4
+# Recent samples kept for the percentiles
+LATENCY_WINDOW = 32
+
+
+class Latency_Tracker(object):
+    '''Tracks a latency and derives a timeout from it'''
+
+    def __init__(self, min_timeout, max_timeout):
+        self._min_timeout = min_timeout
+        self._max_timeout = max_timeout
+        self._mean = 0.0
+        self._deviation = 0.0
+        self._count = 0
+        self._recent = collections.deque(maxlen=LATENCY_WINDOW)
+
+    @property
+    def mean(self):
+        return self._mean
+
+    @property
+    def deviation(self):
+        return self._deviation
+
+    @property
+    def count(self):
+        return self._count
+
+    def add(self, sample):
+        if self._count == 0:
+            self._mean = sample
+            self._deviation = sample / 2
+        else:
+            self._deviation += DEVIATION_GAIN * (abs(sample - self._mean) -
+                                                 self._deviation)
+            self._mean += LATENCY_GAIN * (sample - self._mean)
+        self._count += 1
+        self._recent.append(sample)
+
+    def percentile(self, fraction):
+        '''Returns the percentile of the recent samples, or None if there
+        are none'''
+        ret = None
+        if self._recent:
+            values = sorted(self._recent)
+            ret = values[min(len(values) - 1, int(len(values) * fraction))]
+        return ret
+
+    def timeout(self, default):
+        '''Returns the timeout, or default if too few samples were taken'''
+        ret = default
+        if self._count >= LATENCY_MIN_SAMPLES:
+            ret = self._mean + LATENCY_DEVIATIONS * self._deviation
+            ret = min(max(ret, self._min_timeout), self._max_timeout)
+        return ret
+
+    @property
+    def stats(self):
+        '''Returns a dictionary describing the latency'''
+        return {
+            'samples': self._count,
+            'mean': self._mean,
+            'deviation': self._deviation,
+            'p50': self.percentile(0.5),
+            'p90': self.percentile(0.9),
+            'timeout': self.timeout(None),
+        }
+
+    def save(self):
+        '''Returns the state of the tracker to store in the attributes'''
+        return {
+            'mean': self._mean,
+            'deviation': self._deviation,
+            'samples': min(self._count, LATENCY_WINDOW),
+        }
+
+    def load(self, state):
+        '''Restores the state returned by save, state may be None'''
+        if state:
+            self._mean = state['mean']
+            self._deviation = state['deviation']
+            self._count = state['samples']
@@ -1,10 +1,112 @@
 import time
+import types
+import concurrent.futures
 
 from .msg_schema import *
+from .msg_layout import PLM_REGISTRY
 from .helpers import *
 
+# Priority classes of the messages sent, lower values are sent first.
+# Interactive is for commands a user is waiting on, background for scans
+# and refreshes that can wait for the network to be idle
+PRIORITY_INTERACTIVE = 0
+PRIORITY_NORMAL = 1
+PRIORITY_BACKGROUND = 2
+
+
+def _no_callback():
+    pass
+
+
+class Message_Failed(Exception):
+    '''Raised when a message is abandoned after its retries are used up'''
+
+    def __init__(self, msg):
+        super().__init__('message failed ' + BYTE_TO_HEX(msg.raw_view))
+        self.msg = msg
+
+
+class Message_Nak(Message_Failed):
+    '''Raised when the device answers a message with a nak'''
+
+    def __init__(self, msg, nak_msg):
+        reason = nak_msg.get_byte_by_name('cmd_2')
+        Exception.__init__(self, 'message nak`ed ' +
+                           BYTE_TO_HEX(msg.raw_view) + ' reason ' +
+                           BYTE_TO_HEX(bytes([reason])))
+        self.msg = msg
+        self.nak_msg = nak_msg
+
+
+class Command_Future(concurrent.futures.Future):
+    '''Resolves with a queued message once it is acked.
+
+    A message with an insteon message is acked by the device, any other
+    message is acked by the plm.  If the message is abandoned after its
+    retries are used up the future raises Message_Failed, if the device
+    nak's the message it raises Message_Nak.'''
+
+    def __init__(self, msg):
+        super().__init__()
+        self._msg = msg
+        self._ack_msg = None
+        self._done_time = None
+
+    @property
+    def msg(self):
+        return self._msg
+
+    @property
+    def ack_msg(self):
+        '''The received message that acked or nak'ed the message, None
+        while the message is pending or if it failed'''
+        return self._ack_msg
+
+    @property
+    def latency(self):
+        '''Seconds from the message being created to it being acked or
+        failing, None while the message is pending'''
+        if self._done_time is None:
+            return None
+        return self._done_time - self._msg.creation_time
+
+    @property
+    def send_latency(self):
+        '''Seconds from the message last being sent to it being acked or
+        failing, None while the message is pending'''
+        if self._done_time is None or not self._msg.time_sent:
+            return None
+        return self._done_time - self._msg.time_sent
+
+    def _resolve(self, ack_msg=None):
+        if not self.done():
+            self._done_time = time.time()
+            self._ack_msg = ack_msg
+            self.set_result(self._msg)
+
+    def _nak(self, nak_msg):
+        if not self.done():
+            self._done_time = time.time()
+            self._ack_msg = nak_msg
+            self.set_exception(Message_Nak(self._msg, nak_msg))
+
+    def _fail(self):
+        if not self.done():
+            self._done_time = time.time()
+            self.set_exception(Message_Failed(self._msg))
+
 
 class PLM_Message(object):
+    # Thousands of messages can sit in the device queues and the sent
+    # history, so they do not carry a __dict__
+    __slots__ = ('_plm', '_plm_ack', '_seq_time', '_seq_lock',
+                 '_is_incomming', '_plm_retry', '_failed', '_layout',
+                 '_field_layout', '_positions', '_raw_msg', '_insteon_msg',
+                 '_insteon_attr',
+                 '_creation_time', '_time_sent', '_time_plm_ack', '_priority',
+                 '_plm_success_callback', '_msg_failed_callback', '_device',
+                 '_future')
+
     # Initialization Functions
 
     def __init__(self, plm, **kwargs):
@@ -15,14 +117,19 @@ class PLM_Message(object):
         self._is_incomming = False
         self._plm_retry = 0
         self._failed = False
-        self._plm_schema = {}
+        self._layout = None
+        self._field_layout = None
+        self._positions = {}
         self._raw_msg = bytes()
         self._insteon_msg = {}
-        self._insteon_attr = {}
+        self._insteon_attr = None
         self._creation_time = time.time()
         self._time_sent = 0
-        self._plm_success_callback = lambda: None
-        self._msg_failed_callback = lambda: None
+        self._time_plm_ack = 0
+        self._priority = PRIORITY_NORMAL
+        self._plm_success_callback = _no_callback
+        self._msg_failed_callback = _no_callback
+        self._future = None
         if 'is_incomming' in kwargs:
             self._is_incomming = True
         self._device = None
@@ -39,10 +146,36 @@ class PLM_Message(object):
     def device(self):
         return self._device
 
+    @property
+    def future(self):
+        '''A Command_Future that resolves with this message once it is
+        acked'''
+        if self._future is None:
+            self._future = Command_Future(self)
+        return self._future
+
+    def _resolve_future(self, ack_msg=None):
+        if self._future is not None:
+            self._future._resolve(ack_msg)
+
+    def _nak_future(self, nak_msg):
+        if self._future is not None:
+            self._future._nak(nak_msg)
+
     @property
     def creation_time(self):
         return self._creation_time
 
+    @property
+    def priority(self):
+        '''The priority class of the message, PRIORITY_INTERACTIVE,
+        PRIORITY_NORMAL or PRIORITY_BACKGROUND'''
+        return self._priority
+
+    @priority.setter
+    def priority(self, value):
+        self._priority = value
+
     @property
     def time_sent(self):
         return self._time_sent
@@ -62,8 +195,13 @@ class PLM_Message(object):
     def msg_from_raw(self, **kwargs):
         if 'raw_data' not in kwargs:
             return
-        self._plm_schema = PLM_SCHEMA[kwargs['raw_data'][1]].copy()
-        self._raw_msg = kwargs['raw_data']
+        # Incoming messages are immutable, this is the only copy made of
+        # the bytes read from the PLM
+        self._raw_msg = bytes(kwargs['raw_data'])
+        # The frame decoder only passes on messages with known prefixes
+        self._layout = PLM_REGISTRY.layout_for_prefix(self._raw_msg[1])
+        self._set_field_layout(
+            self._layout.recv_layout_for_length(len(self._raw_msg)))
         self._init_insteon_msg(**kwargs)
 
     def command_to_raw(self, **kwargs):
@@ -71,12 +209,12 @@ class PLM_Message(object):
         message'''
         if 'plm_cmd' not in kwargs:
             return
-        plm_cmd = kwargs['plm_cmd']
-        plm_prefix = self._set_plm_schema(plm_cmd)
-        if not plm_prefix:
-            return
-        if not self._initialize_raw_msg(plm_cmd, plm_prefix):
+        if not self._set_plm_schema(kwargs['plm_cmd']):
             return
+        if 'dev_template' in kwargs:
+            self._init_from_template(kwargs['dev_template'])
+        else:
+            self._initialize_raw_msg()
         self._init_plm_msg(**kwargs)
         self._init_insteon_msg(**kwargs)
         return self
@@ -85,80 +223,100 @@ class PLM_Message(object):
         if 'plm_bytes' in kwargs:
             plm_bytes = kwargs['plm_bytes']
             for key in plm_bytes:
-                if key in self.attribute_positions:
+                if self._get_byte_pos(key) is not None:
                     self._insert_byte_into_raw(plm_bytes[key], key)
 
     def _init_insteon_msg(self, **kwargs):
-        if self.plm_schema['name'] in ['insteon_received',
-                                       'insteon_ext_received', 'insteon_send']:
+        if self._layout.has_insteon_msg:
             self._insteon_msg = Insteon_Message(self, **kwargs)
 
-    def _initialize_raw_msg(self, plm_cmd, plm_prefix):
-        msg_direction = 'send_len'
-        if self.is_incomming:
-            msg_direction = 'rcvd_len'
-        if msg_direction in self.plm_schema:
-            self._msg_byte_length = self.plm_schema[msg_direction]
-            self._raw_msg = bytearray(self.plm_schema[msg_direction][0])
-            self._raw_msg[0] = 0x02
-            self._raw_msg[1] = plm_prefix
-            return True
-        else:
-            return False
+    def _initialize_raw_msg(self):
+        field_layout = self._layout.field_layout(self.is_incomming)
+        self._set_field_layout(field_layout)
+        self._raw_msg = bytearray(field_layout.length)
+        self._raw_msg[0] = 0x02
+        self._raw_msg[1] = self._layout.prefix
+
+    def _init_from_template(self, template):
+        self._set_field_layout(template.field_layout)
+        self._raw_msg = bytearray(template.raw)
+        # Shared with the template, _set_insteon_attr copies before writing
+        self._insteon_attr = template.insteon_attr
+
+    def _extend_raw_msg(self):
+        '''Converts a message being built into its extended length form'''
+        field_layout = self._layout.field_layout(self.is_incomming, True)
+        addl_length = field_layout.length - len(self._raw_msg)
+        self._raw_msg.extend(bytearray(addl_length))
+        self._set_field_layout(field_layout)
+
+    def _set_field_layout(self, field_layout):
+        self._field_layout = field_layout
+        self._positions = field_layout.index
 
     # Set Bytes in Message
     def _set_plm_schema(self, plm_cmd):
-        plm_schema = False
-        for plm_prefix, schema in PLM_SCHEMA.items():
-            if schema['name'] == plm_cmd:
-                plm_schema = schema
-                break
-        if plm_schema:
-            self._plm_schema = plm_schema
-            return plm_prefix
-        else:
+        layout = PLM_REGISTRY.layout_for_name(plm_cmd)
+        if layout is None or not layout.can_send:
             print("I don't know that plm command")
             return False
+        self._layout = layout
+        return True
 
     def _insert_byte_into_raw(self, data_byte, pos_name):
-        pos = self.attribute_positions[pos_name]
+        '''The only way to change the bytes of a message.  Only messages
+        being built to send can be changed, incoming messages are read only'''
+        if self.is_incomming:
+            raise TypeError('the bytes of an incoming message are read only')
+        pos = self._get_byte_pos(pos_name)
         self._raw_msg[pos] = data_byte
         return
 
+    def _set_insteon_attr(self, name, pos):
+        insteon_attr = {}
+        if self._insteon_attr is not None:
+            insteon_attr.update(self._insteon_attr)
+        insteon_attr[name] = pos
+        self._insteon_attr = insteon_attr
+
     def _insert_bytes_into_raw(self, byte_dict):
         for name, byte in byte_dict.items():
             self._insert_byte_into_raw(byte, name)
         return
 
     # Read Message Bytes
+    def _get_byte_pos(self, byte_name):
+        '''Returns the position of the named byte, or None'''
+        pos = self._positions.get(byte_name)
+        if pos is None and self._insteon_attr is not None:
+            pos = self._insteon_attr.get(byte_name)
+        return pos
+
     @property
     def attribute_positions(self):
-        msg_direction = 'send_byte_pos'
-        if self.is_incomming:
-            msg_direction = 'recv_byte_pos'
+        '''A read only mapping of attribute names to byte positions'''
+        if self._insteon_attr is None:
+            return self._field_layout.positions
         ret = self._insteon_attr.copy()
-        ret.update(self.plm_schema[msg_direction])
-        return ret
+        ret.update(self._field_layout.positions)
+        return types.MappingProxyType(ret)
 
     @property
     def parsed_attributes(self):
         '''Returns a dictionary of the attribute names associated with their
         byte values'''
         ret = {}
-        for name in self.attribute_positions.keys():
+        for name in self.attribute_positions:
             ret[name] = self.get_byte_by_name(name)
         return ret
 
     @property
     def plm_resp_flag(self):
-        if 'plm_resp' in self.attribute_positions or \
-                'plm_resp_e' in self.attribute_positions:
-            byte_pos = self.attribute_positions['plm_resp']
-            if 'plm_resp_e' in self.attribute_positions:
-                byte_pos_e = self.attribute_positions['plm_resp_e']
-                if byte_pos_e < len(self.raw_msg):
-                    byte_pos = byte_pos_e
-            return self.raw_msg[byte_pos]
+        # The extended layout of a message already points plm_resp at the
+        # final byte
+        byte_pos = self._positions.get('plm_resp')
+        if byte_pos is not None:
+            return self._raw_msg[byte_pos]
         else:
             return False
 
@@ -185,24 +343,40 @@ class PLM_Message(object):
 
     @property
     def raw_msg(self):
-        return self._raw_msg.copy()
+        '''Returns a copy of the message bytes which can be changed freely,
+        use raw_view to read the bytes without copying them'''
+        return bytearray(self._raw_msg)
+
+    @property
+    def raw_view(self):
+        '''Returns a read only memoryview of the message bytes'''
+        return memoryview(self._raw_msg).toreadonly()
+
+    def has_byte_name(self, byte_name):
+        return self._get_byte_pos(byte_name) is not None
 
     def get_byte_by_name(self, byte_name):
         ret = False
-        if byte_name in self.attribute_positions:
-            pos = self.attribute_positions[byte_name]
-            if pos < len(self.raw_msg):
-                ret = self.raw_msg[pos]
+        pos = self._positions.get(byte_name)
+        if pos is None and self._insteon_attr is not None:
+            pos = self._insteon_attr.get(byte_name)
+        if pos is not None and pos < len(self._raw_msg):
+            ret = self._raw_msg[pos]
         return ret
 
     # Message Meta Data
     @property
     def plm_schema(self):
-        return self._plm_schema.copy()
+        '''A read only view of the schema for this message'''
+        return self._layout.schema
+
+    @property
+    def plm_layout(self):
+        return self._layout
 
     @property
     def plm_cmd_type(self):
-        return self.plm_schema['name']
+        return self._layout.name
 
     @property
     def is_incomming(self):
@@ -217,6 +391,8 @@ class PLM_Message(object):
         self._failed = boolean
         if boolean is True:
             self._msg_failed_callback()
+            if self._future is not None:
+                self._future._fail()
 
     @property
     def plm_ack(self):
@@ -226,7 +402,11 @@ class PLM_Message(object):
     def plm_ack(self, boolean):
         self._plm_ack = boolean
         if boolean is True:
+            self._time_plm_ack = self._plm.time_rcvd or time.time()
+            self._plm._msg_plm_acked(self)
             self.plm_success_callback()
+            if not self._insteon_msg:
+                self._resolve_future(self._plm.rcvd_msg)
 
     @property
     def plm_retry(self):
@@ -277,16 +457,19 @@ class PLM_Message(object):
 
 
 class Insteon_Message(object):
+    __slots__ = ('_device_ack', '_device_retry', '_device_cmd_name',
+                 '_parent', '_device_success_callback')
 
     def __init__(self, parent, **kwargs):
         self._device_ack = False
         self._device_retry = 0
-        self._cmd_schema = {}
         self._device_cmd_name = ''
         self._parent = parent
-        self._device_success_callback = lambda: None
+        self._device_success_callback = _no_callback
         # Need to reinitialize the message length??? Extended message
-        if 'dev_cmd' in kwargs:
+        if 'dev_template' in kwargs:
+            self._construct_from_template(kwargs['dev_template'])
+        elif 'dev_cmd' in kwargs:
             self._construct_insteon_send(kwargs['dev_cmd'])
         if 'dev_bytes' in kwargs:
             for name, byte in kwargs['dev_bytes'].items():
@@ -294,9 +477,7 @@ class Insteon_Message(object):
 
     def _construct_insteon_send(self, dev_cmd):
         if dev_cmd['msg_length'] == 'extended':
-            length_array = self._parent._msg_byte_length
-            addl_length = length_array[1] - length_array[0]
-            self._parent._raw_msg.extend(bytearray(addl_length))
+            self._parent._extend_raw_msg()
         msg_flags = self._construct_msg_flags(dev_cmd)
         self._parent._insert_byte_into_raw(msg_flags, 'msg_flags')
         self._parent._insert_byte_into_raw(
@@ -319,10 +500,21 @@ class Insteon_Message(object):
                     value = dev_byte['function'](self._parent.device)
                     self._parent._insert_byte_into_raw(value, key)
                 if 'name' in dev_byte:
-                    self._parent._insteon_attr[dev_byte['name']] = \
-                        self._parent.attribute_positions[key]
+                    self._parent._set_insteon_attr(
+                        dev_byte['name'], self._parent._get_byte_pos(key))
         self._device_cmd_name = dev_cmd['name']
 
+    def _construct_from_template(self, template):
+        '''The template already holds every byte that does not change
+        between sends, only the hops and any function bytes are written'''
+        device = self._parent.device
+        hops = device.smart_hops
+        self._parent._raw_msg[template.msg_flags_pos] = \
+            template.msg_flags | (hops << 2) | hops
+        for pos, function in template.functions:
+            self._parent._raw_msg[pos] = function(device)
+        self._device_cmd_name = template.name
+
     def _construct_msg_flags(self, dev_cmd):
         msg_types = {
             'broadcast': 4,
@@ -351,14 +543,10 @@ class Insteon_Message(object):
             return
 
     def _calculate_i2cs_checksum(self):
-        # Sum Relevant Bytes
-        keys = ('cmd_1', 'cmd_2', 'usr_1', 'usr_2',
-                'usr_3', 'usr_4', 'usr_5', 'usr_6',
-                'usr_7', 'usr_8', 'usr_9', 'usr_10',
-                'usr_11', 'usr_12', 'usr_13')
-        bytesum = 0
-        for key in keys:
-            bytesum += self._parent.get_byte_by_name(key)
+        # Sum Relevant Bytes, cmd_1 through usr_13 are consecutive
+        start = self._parent._get_byte_pos('cmd_1')
+        end = self._parent._get_byte_pos('usr_13') + 1
+        bytesum = sum(self._parent.raw_view[start:end])
         # Flip Bits
         bytesum = ~ bytesum
         # Add 1
@@ -463,27 +651,21 @@ class Insteon_Message(object):
 
     @property
     def to_addr_str(self):
-        if 'to_addr_hi' in self._parent.attribute_positions:
-            byte_pos_hi = self._parent.attribute_positions['to_addr_hi']
-            byte_pos_mid = self._parent.attribute_positions['to_addr_mid']
-            byte_pos_low = self._parent.attribute_positions['to_addr_low']
-            return BYTE_TO_HEX(bytes((self._parent.raw_msg[byte_pos_hi],
-                                      self._parent.raw_msg[byte_pos_mid],
-                                      self._parent.raw_msg[byte_pos_low],
-                                      )))
+        byte_pos = self._parent._get_byte_pos('to_addr_hi')
+        if byte_pos is not None:
+            raw_view = self._parent.raw_view
+            # The address bytes are always consecutive
+            return BYTE_TO_HEX(raw_view[byte_pos:byte_pos + 3])
         else:
             return False
 
     @property
     def from_addr_str(self):
-        if 'to_addr_hi' in self._parent.attribute_positions:
-            byte_pos_hi = self._parent.attribute_positions['from_addr_hi']
-            byte_pos_mid = self._parent.attribute_positions['from_addr_mid']
-            byte_pos_low = self._parent.attribute_positions['from_addr_low']
-            return BYTE_TO_HEX(bytes((self._parent.raw_msg[byte_pos_hi],
-                                      self._parent.raw_msg[byte_pos_mid],
-                                      self._parent.raw_msg[byte_pos_low],
-                                      )))
+        if self._parent._get_byte_pos('to_addr_hi') is not None:
+            raw_view = self._parent.raw_view
+            byte_pos = self._parent._get_byte_pos('from_addr_hi')
+            # The address bytes are always consecutive
+            return BYTE_TO_HEX(raw_view[byte_pos:byte_pos + 3])
         else:
             return False
 
@@ -496,7 +678,15 @@ class Insteon_Message(object):
         self._device_ack = boolean
         if boolean == True:
             self._parent.device._add_to_hop_array(self.max_hops)
+            self._parent.device._add_ack_latency(self._parent)
             self.device_success_callback()
+            self._parent._resolve_future(self._parent.plm.rcvd_msg)
+
+    def device_nak(self, nak_msg):
+        '''Marks the message as answered by a nak from the device, it is
+        not resent and its future raises Message_Nak'''
+        self._parent._nak_future(nak_msg)
+        self.device_ack = True
 
     @property
     def device_success_callback(self):
@@ -506,3 +696,57 @@ class Insteon_Message(object):
     @device_success_callback.setter
     def device_success_callback(self, value):
         self._device_success_callback = value
+
+
+class Command_Template(object):
+    '''A prebuilt insteon_send message for one command on one device.
+
+    The template is taken from a message built from the COMMAND_SCHEMA.  It
+    holds the message bytes with the address and default bytes already
+    written, so building the command again is a copy of those bytes plus
+    the message flags and any bytes produced by functions.'''
+    __slots__ = ('_name', '_field_layout', '_raw', '_insteon_attr',
+                 '_msg_flags', '_msg_flags_pos', '_functions')
+
+    def __init__(self, message, dev_cmd):
+        self._name = dev_cmd['name']
+        self._field_layout = message._field_layout
+        self._raw = bytes(message.raw_view)
+        self._insteon_attr = message._insteon_attr
+        self._msg_flags_pos = message._get_byte_pos('msg_flags')
+        # Keep the message type and length, the hops are set on each send
+        self._msg_flags = self._raw[self._msg_flags_pos] & 0b11110000
+        functions = []
+        for key, dev_byte in dev_cmd.items():
+            if isinstance(dev_byte, dict) and 'function' in dev_byte:
+                functions.append((message._get_byte_pos(key),
+                                  dev_byte['function']))
+        self._functions = tuple(functions)
+
+    @property
+    def name(self):
+        return self._name
+
+    @property
+    def field_layout(self):
+        return self._field_layout
+
+    @property
+    def raw(self):
+        return self._raw
+
+    @property
+    def insteon_attr(self):
+        return self._insteon_attr
+
+    @property
+    def msg_flags(self):
+        return self._msg_flags
+
+    @property
+    def msg_flags_pos(self):
+        return self._msg_flags_pos
+
+    @property
+    def functions(self):
+        return self._functions
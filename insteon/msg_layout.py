@@ -0,0 +1,205 @@
+'''
+Compiled layouts of the messages in PLM_SCHEMA.
+
+Each schema entry is compiled once, at import, into a PLM_Layout.  The
+layout holds a Field_Layout for each variant of the message, sent or
+received and standard or extended length.  Messages reference these shared
+layouts rather than merging the schema dictionaries on every access.
+
+PLM_REGISTRY indexes the layouts by command name and by prefix.  The schema
+is validated when the registry is built, so a malformed entry fails at
+import rather than when the message is first sent or received.
+'''
+import types
+
+from .msg_schema import PLM_SCHEMA
+
+
+class Field_Layout(object):
+    '''The length and byte positions of one variant of a plm message'''
+    __slots__ = ('_length', '_index', '_positions', '_names', '_offsets')
+
+    def __init__(self, length, positions):
+        self._length = length
+        self._index = dict(positions)
+        self._positions = types.MappingProxyType(self._index)
+        self._names = tuple(positions.keys())
+        self._offsets = tuple(positions.values())
+
+    @property
+    def length(self):
+        return self._length
+
+    @property
+    def positions(self):
+        '''A read only mapping of byte names to byte positions'''
+        return self._positions
+
+    @property
+    def index(self):
+        '''The dict behind positions, for lookups on the hot path.  It is
+        shared by every message using this layout and must not be changed'''
+        return self._index
+
+    @property
+    def names(self):
+        return self._names
+
+    @property
+    def offsets(self):
+        '''The byte positions, in the same order as names'''
+        return self._offsets
+
+
+class PLM_Layout(object):
+    '''The compiled form of one PLM_SCHEMA entry'''
+    __slots__ = ('_prefix', '_schema', '_recv', '_send', '_has_insteon_msg',
+                 'ack_act', 'nack_act', 'bad_cmd_act', 'recv_act')
+
+    def __init__(self, prefix, schema):
+        self._prefix = prefix
+        self._schema = types.MappingProxyType(schema)
+        self._recv = self._compile(schema.get('rcvd_len'),
+                                   schema.get('recv_byte_pos', {}))
+        self._send = self._compile(schema.get('send_len'),
+                                   schema.get('send_byte_pos', {}))
+        # Only messages with message flags carry an insteon message
+        self._has_insteon_msg = (
+            'msg_flags' in schema.get('recv_byte_pos', {}) or
+            'msg_flags' in schema.get('send_byte_pos', {}))
+        self.ack_act = schema.get('ack_act')
+        self.nack_act = schema.get('nack_act')
+        self.bad_cmd_act = schema.get('bad_cmd_act')
+        self.recv_act = schema.get('recv_act')
+
+    def _compile(self, lengths, positions):
+        '''Returns a standard and an extended Field_Layout, these are the
+        same object for messages that only have one length'''
+        if not lengths or not lengths[0]:
+            # A length of 0 marks a message that is never sent
+            return (None, None)
+        positions = dict(positions)
+        if 'plm_resp_e' in positions:
+            ext_positions = positions.copy()
+            ext_positions['plm_resp'] = ext_positions.pop('plm_resp_e')
+            del positions['plm_resp_e']
+        else:
+            ext_positions = positions
+        std_layout = Field_Layout(lengths[0], positions)
+        if len(lengths) == 1:
+            return (std_layout, std_layout)
+        return (std_layout, Field_Layout(lengths[1], ext_positions))
+
+    @property
+    def prefix(self):
+        return self._prefix
+
+    @property
+    def name(self):
+        return self._schema['name']
+
+    @property
+    def schema(self):
+        '''A read only view of the PLM_SCHEMA entry'''
+        return self._schema
+
+    @property
+    def can_send(self):
+        return self._send[0] is not None
+
+    @property
+    def has_insteon_msg(self):
+        '''True if the message carries an insteon message'''
+        return self._has_insteon_msg
+
+    @property
+    def has_extended(self):
+        '''True if the received message can be standard or extended'''
+        return self._recv[0] is not self._recv[1]
+
+    def field_layout(self, is_incomming, is_extended=False):
+        layouts = self._recv if is_incomming else self._send
+        return layouts[1] if is_extended else layouts[0]
+
+    def recv_layout_for_length(self, length):
+        '''Returns the received Field_Layout matching the message length'''
+        if self._recv[1] is not None and length == self._recv[1].length:
+            return self._recv[1]
+        return self._recv[0]
+
+
+class PLM_Registry(object):
+    '''Looks up the compiled layout of a plm command by name or prefix'''
+
+    def __init__(self, schema):
+        self._validate(schema)
+        self._by_name = {}
+        self._by_prefix = [None] * 256
+        for prefix, schema_entry in schema.items():
+            layout = PLM_Layout(prefix, schema_entry)
+            self._by_name[layout.name] = layout
+            self._by_prefix[prefix] = layout
+
+    def _validate(self, schema):
+        names = set()
+        for prefix, schema_entry in schema.items():
+            if not isinstance(prefix, int) or not 0 <= prefix <= 0xFF:
+                raise ValueError('invalid plm prefix {!r}'.format(prefix))
+            name = schema_entry.get('name')
+            if not name:
+                raise ValueError('plm prefix {:02X} has no name'.format(prefix))
+            if name in names:
+                raise ValueError('plm command {} is defined twice'.format(name))
+            names.add(name)
+            if 'rcvd_len' not in schema_entry:
+                raise ValueError('plm command {} has no rcvd_len'.format(name))
+            for len_key, pos_key in (('rcvd_len', 'recv_byte_pos'),
+                                     ('send_len', 'send_byte_pos')):
+                self._validate_direction(name, schema_entry, len_key, pos_key)
+            for act in ('ack_act', 'nack_act', 'bad_cmd_act', 'recv_act'):
+                if act in schema_entry and not callable(schema_entry[act]):
+                    raise ValueError(
+                        'plm command {} {} is not callable'.format(name, act))
+
+    def _validate_direction(self, name, schema_entry, len_key, pos_key):
+        lengths = schema_entry.get(len_key)
+        if not lengths or not lengths[0]:
+            return
+        if len(lengths) not in (1, 2):
+            raise ValueError('plm command {} {} must have one or two '
+                             'lengths'.format(name, len_key))
+        positions = schema_entry.get(pos_key)
+        if positions is None:
+            raise ValueError('plm command {} has {} but no {}'.format(
+                name, len_key, pos_key))
+        if positions.get('plm_cmd') != 1:
+            raise ValueError('plm command {} {} must have plm_cmd at '
+                             'position 1'.format(name, pos_key))
+        if len(lengths) == 2 and 'msg_flags' not in positions:
+            raise ValueError('plm command {} has an extended length but no '
+                             'msg_flags in {}'.format(name, pos_key))
+        for byte_name, pos in positions.items():
+            if not 0 <= pos < lengths[-1]:
+                raise ValueError('plm command {} {} is outside of the '
+                                 'message'.format(name, byte_name))
+
+    def prefix_for_name(self, name):
+        '''Returns the prefix of the named plm command, or None'''
+        layout = self._by_name.get(name)
+        if layout is None:
+            return None
+        return layout.prefix
+
+    def layout_for_name(self, name):
+        '''Returns the PLM_Layout of the named plm command, or None'''
+        return self._by_name.get(name)
+
+    def layout_for_prefix(self, prefix):
+        '''Returns the PLM_Layout of the plm prefix, or None'''
+        return self._by_prefix[prefix]
+
+    def layouts(self):
+        '''Returns a list of every PLM_Layout'''
+        return list(self._by_name.values())
+
+PLM_REGISTRY = PLM_Registry(PLM_SCHEMA)
@@ -446,7 +446,7 @@ PLM_SCHEMA = {
         }
     },
     0x70: {
-        'rcvd_len': (4,),
+        'rcvd_len': (5,),
         'name': 'insteon_nak',
         'recv_byte_pos': {
             'plm_cmd': 1,
@@ -0,0 +1,120 @@
+'''
+Paces the messages sent to a PLM by the feedback the PLM gives.
+
+A PLM answers a 0x15 busy byte or a nak when it can not take a message,
+and a device naks a message the network garbled.  Rather than pausing for
+a fixed time after each of these, a Send_Pacer hands out sends from a
+token bucket.  The bucket fills at the current rate up to PACING_BURST
+tokens and each send takes one token.
+
+Every busy or nak signal multiplies the rate by PACING_BACKOFF and empties
+the bucket, so repeated signals back off quickly.  Every clean PLM ack
+adds PACING_RECOVERY messages per second back to the rate, up to the
+maximum.  The rate then settles around what the PLM can sustain.
+'''
+import time
+
+# Messages per second sent at most, and at least once backed off
+PACING_MAX_RATE = 20.0
+PACING_MIN_RATE = 1.0
+# Sends that can be made back to back after an idle period
+PACING_BURST = 2
+# The rate is multiplied by this on each busy or nak signal
+PACING_BACKOFF = 0.5
+# Messages per second added to the rate on each clean ack
+PACING_RECOVERY = 0.5
+
+
+class Send_Pacer(object):
+    '''A token bucket whose rate follows the busy and ack feedback'''
+
+    def __init__(self, max_rate=PACING_MAX_RATE, min_rate=PACING_MIN_RATE,
+                 burst=PACING_BURST):
+        self._max_rate = max_rate
+        self._min_rate = min_rate
+        self._burst = burst
+        self._rate = max_rate
+        self._tokens = burst
+        self._time = time.time()
+        self._stats = {
+            'sent': 0,
+            'acks': 0,
+            'busy': 0,
+            'naks': 0,
+            'backoffs': 0,
+            'lowest_rate': max_rate,
+        }
+
+    @property
+    def rate(self):
+        '''The messages per second currently allowed'''
+        return self._rate
+
+    @property
+    def stats(self):
+        '''Returns a dictionary of the current rate, the tokens in the
+        bucket and the feedback counters'''
+        self._refill(time.time())
+        ret = self._stats.copy()
+        ret['rate'] = self._rate
+        ret['tokens'] = self._tokens
+        return ret
+
+    def ready(self, now=None):
+        '''Returns True if a message can be sent now'''
+        if now is None:
+            now = time.time()
+        self._refill(now)
+        return self._tokens >= 1
+
+    def next_send_time(self, now=None):
+        '''Returns the time at which the next message can be sent'''
+        if now is None:
+            now = time.time()
+        self._refill(now)
+        ret = now
+        if self._tokens < 1:
+            ret = now + (1 - self._tokens) / self._rate
+        return ret
+
+    def sent(self, now=None):
+        '''Takes the token of a message that was sent'''
+        if now is None:
+            now = time.time()
+        self._refill(now)
+        self._tokens -= 1
+        self._stats['sent'] += 1
+
+    def refill(self):
+        '''Fills the bucket, the next sends do not wait'''
+        self._tokens = self._burst
+        self._time = time.time()
+
+    def ack(self):
+        '''Called on a clean ack, recovers some of the rate'''
+        self._stats['acks'] += 1
+        self._rate = min(self._max_rate, self._rate + PACING_RECOVERY)
+
+    def busy(self):
+        '''Called when the PLM says it is busy'''
+        self._stats['busy'] += 1
+        self._backoff()
+
+    def nak(self):
+        '''Called when the PLM or a device naks a message'''
+        self._stats['naks'] += 1
+        self._backoff()
+
+    def _backoff(self):
+        self._refill(time.time())
+        self._stats['backoffs'] += 1
+        self._rate = max(self._min_rate, self._rate * PACING_BACKOFF)
+        self._tokens = min(self._tokens, 0)
+        if self._rate < self._stats['lowest_rate']:
+            self._stats['lowest_rate'] = self._rate
+
+    def _refill(self, now):
+        if now > self._time:
+            self._tokens = min(self._burst,
+                               self._tokens + (now - self._time) * self._rate)
+            self._time = now
@@ -6,10 +6,25 @@ import pprint
 from .insteon_device import Insteon_Device
 from .base_objects import PLM_ALDB, Insteon_Group, Trigger_Manager, Trigger, \
     Root_Insteon
-from .message import PLM_Message
+from .message import PLM_Message, PRIORITY_NORMAL, PRIORITY_BACKGROUND
+from .buffer import Read_Buffer
+from .capture import Capture_Writer, CAPTURE_READ, CAPTURE_WRITE
+from .latency import Latency_Tracker
+from .pacing import Send_Pacer
+from .hop_timing import Hop_Timing
+from .framing import Frame_Decoder
+from .scheduler import Send_Scheduler
+from .io_thread import PLM_IO_Thread
+from .transport import open_transport
 from .helpers import *
 from .msg_schema import *
 
+# Seconds the PLM is given to ack a message until its acks have been
+# measured, and the bounds of the measured timeout
+PLM_ACK_TIMEOUT = 0.075
+PLM_ACK_TIMEOUT_MIN = 0.03
+PLM_ACK_TIMEOUT_MAX = 1.0
+
 
 class PLM_Group(Insteon_Group):
 
@@ -32,6 +47,7 @@ class PLM_Group(Insteon_Group):
                               plm_cmd='all_link_send',
                               plm_bytes=plm_bytes)
         self.parent._queue_device_msg(message, 'all_link_send')
+        ret = message.future
         records = self.parent._aldb.get_matching_records({
             'controller': True,
             'group': self.group_number,
@@ -54,6 +70,7 @@ class PLM_Group(Insteon_Group):
 
             linked_obj.send_command(
                 cmd_str, '', {'cmd_2': self.group_number})
+        return ret
 
 
 class PLM(Root_Insteon):
@@ -62,8 +79,34 @@ class PLM(Root_Insteon):
         self._devices = {}
         self._aldb = PLM_ALDB(self)
         self._trigger_mngr = Trigger_Manager(self)
+        self._send_scheduler = Send_Scheduler()
+        self._send_scheduler.add_device(self)
         super().__init__(core, self, **kwargs)
-        self._read_buffer = bytearray()
+        self._read_buffer = Read_Buffer()
+        self._decoder = Frame_Decoder(self._read_buffer,
+                                      busy_callback=self._plm_busy)
+        self._bulk_read = True
+        self._msgs_per_pass = 16
+        self._input_stats = {
+            'last_pass_frames': 0,
+            'max_pass_frames': 0,
+            'capped_passes': 0,
+            'total_frames': 0,
+        }
+        self._input_pending = False
+        self._in_flight_window = 1
+        self._in_flight = {}
+        self._plm_ack_latency = Latency_Tracker(PLM_ACK_TIMEOUT_MIN,
+                                                PLM_ACK_TIMEOUT_MAX)
+        self._plm_ack_latency.load(self.attribute('plm_ack_latency'))
+        self._pacer = Send_Pacer()
+        self._hop_timing = Hop_Timing()
+        self._hop_timing.load(self.attribute('hop_timing'))
+        self._msg_listeners = []
+        self._io_thread = None
+        self._capture = None
+        self._time_rcvd = 0
+        self._rcvd_msg = None
         self._last_sent_msg = ''
         self._msg_queue = []
         self._wait_to_send = 0
@@ -87,14 +130,7 @@ class PLM(Root_Insteon):
             print('you need to define a port for this plm')
         self.attribute('port', port)
         try:
-            self._serial = serial.Serial(
-                port=port,
-                baudrate=19200,
-                parity=serial.PARITY_NONE,
-                stopbits=serial.STOPBITS_ONE,
-                bytesize=serial.EIGHTBITS,
-                timeout=0
-            )
+            self._serial = open_transport(port)
         except serial.serialutil.SerialException:
             print('unable to connect to port', port)
             self.port_active = False
@@ -121,6 +157,140 @@ class PLM(Root_Insteon):
     def port(self):
         return self.attribute('port')
 
+    @property
+    def send_scheduler(self):
+        return self._send_scheduler
+
+    @property
+    def bulk_read(self):
+        '''If True, all bytes waiting on the port are read with a single
+        call, otherwise the port is read one byte at a time'''
+        return self._bulk_read
+
+    @bulk_read.setter
+    def bulk_read(self, value):
+        self._bulk_read = value
+
+    @property
+    def msgs_per_pass(self):
+        '''The maximum number of messages that will be dispatched on each
+        call to process_input, this prevents one busy PLM from starving the
+        others.  None means every complete message in the buffer is
+        dispatched, 1 dispatches a single message per pass'''
+        return self._msgs_per_pass
+
+    @msgs_per_pass.setter
+    def msgs_per_pass(self, value):
+        self._msgs_per_pass = value
+
+    @property
+    def plm_ack_latency(self):
+        '''The Latency_Tracker of the time the PLM takes to ack a message'''
+        return self._plm_ack_latency
+
+    @property
+    def hop_timing(self):
+        '''The Hop_Timing learned from the copies of received messages'''
+        return self._hop_timing
+
+    def _add_hop_gap(self, msg_length, gap):
+        '''Adds the seconds per hop between two copies of a message'''
+        self._hop_timing.add_gap(msg_length, gap)
+        self.attribute('hop_timing', self._hop_timing.save())
+
+    @property
+    def pacer(self):
+        '''The Send_Pacer that spaces the messages sent to the PLM'''
+        return self._pacer
+
+    def _msg_plm_acked(self, msg):
+        '''Called when the PLM acks msg.  Measures the ack, unless msg was
+        resent, and lets the pacer recover'''
+        self._pacer.ack()
+        if msg.plm_retry == 0 and msg.time_sent:
+            self._plm_ack_latency.add(msg.time_plm_ack - msg.time_sent)
+            self.attribute('plm_ack_latency', self._plm_ack_latency.save())
+
+    @property
+    def in_flight_window(self):
+        '''The number of messages that may be waiting on device acks at
+        once.  With 1, the default, nothing is sent until the last message
+        is acked by its device.  A larger window sends messages to other
+        devices once the PLM has acked the last message, each device still
+        has at most one message in flight'''
+        return self._in_flight_window
+
+    @in_flight_window.setter
+    def in_flight_window(self, value):
+        self._in_flight_window = max(1, value)
+
+    @property
+    def in_flight(self):
+        '''Returns a dictionary of the messages waiting on device acks,
+        keyed by the device address bytes and cmd_1'''
+        return self._in_flight.copy()
+
+    @property
+    def input_stats(self):
+        '''Returns a dictionary describing the depth of the input backlog.
+        last_pass_frames and max_pass_frames count the messages dispatched
+        per pass, capped_passes counts the passes that stopped at
+        msgs_per_pass, and backlog_bytes is what remains in the buffer'''
+        ret = self._input_stats.copy()
+        if self._io_thread is None:
+            ret.update(self._decoder.stats)
+            ret['backlog_bytes'] = len(self._read_buffer)
+        else:
+            ret.update(self._io_thread.decoder.stats)
+            ret['backlog_frames'] = self._io_thread.backlog
+        return ret
+
+    @property
+    def io_thread(self):
+        '''The PLM_IO_Thread doing the serial I/O, or None if the port is
+        read and written directly'''
+        return self._io_thread
+
+    def start_io_thread(self, wakeup=None):
+        '''Moves the serial reads and writes onto a PLM_IO_Thread.  wakeup
+        is called from the reader thread whenever data arrives'''
+        if self._io_thread is None and self.port_active:
+            self._io_thread = PLM_IO_Thread(self._serial, wakeup,
+                                            busy_callback=self._plm_busy,
+                                            error_callback=self._io_failed)
+            self._io_thread.capture = self._capture
+            self._io_thread.start()
+
+    def _io_failed(self):
+        '''Called from the io thread when the port fails, the messages
+        still to be sent then fail'''
+        self.port_active = False
+
+    def stop_io_thread(self):
+        if self._io_thread is not None:
+            self._io_thread.stop()
+            self._io_thread = None
+
+    @property
+    def capture(self):
+        '''The Capture_Writer recording the traffic of the PLM, or None'''
+        return self._capture
+
+    def start_capture(self, path):
+        '''Appends every byte read from and written to the port, with the
+        time, to the capture file at path.  See capture.py'''
+        self.stop_capture()
+        self._capture = Capture_Writer(path)
+        if self._io_thread is not None:
+            self._io_thread.capture = self._capture
+
+    def stop_capture(self):
+        if self._capture is not None:
+            if self._io_thread is not None:
+                self._io_thread.capture = None
+            self._capture.close()
+            self._capture = None
+
     @property
     def dev_addr_hi(self):
         return self._dev_addr_hi
@@ -158,66 +328,90 @@ class PLM(Root_Insteon):
                                                  byte_address=byte_address)
         return self._devices[byte_address]
 
+    def fileno(self):
+        '''Returns the file descriptor of the serial port, or None if the
+        port is not active or is read by an io thread'''
+        if not self.port_active or self._io_thread is not None:
+            return None
+        return self._serial.fileno()
+
+    def next_deadline(self):
+        '''Returns the time at which the plm next needs to be processed if
+        no data arrives in the meantime, or None if it can wait for data'''
+        if self._input_pending:
+            # The last pass left messages in the read buffer
+            return time.time()
+        if self._is_ack_pending():
+            ret = self._unacked_deadline(self._last_sent_msg)
+        elif (len(self._in_flight) < self._in_flight_window and
+                self._next_sending_device() is not None):
+            ret = max(self.wait_to_send, self._pacer.next_send_time())
+        else:
+            ret = self._send_scheduler.next_expiry()
+        for msg in self._in_flight.values():
+            deadline = self._unacked_deadline(msg)
+            if deadline is not None and (ret is None or deadline < ret):
+                ret = deadline
+        if self.port_active and self._io_thread is None:
+            # Transports without a file descriptor have to be polled
+            poll = self._serial.next_poll()
+            if poll is not None and (ret is None or poll < ret):
+                ret = poll
+        return ret
+
     def _read(self):
         '''Reads bytes from PLM and loads them into a buffer'''
         if self.port_active:
-            while self._serial.inWaiting() > 0:
-                self._read_buffer.extend(self._serial.read())
+            if self._capture is not None:
+                waiting = self._serial.inWaiting()
+                if waiting > 0:
+                    data = self._serial.read(waiting)
+                    self._capture.write(CAPTURE_READ, data)
+                    self._read_buffer.extend(data)
+            elif self.bulk_read:
+                self._read_buffer.fill_from(self._serial)
+            else:
+                while self._serial.inWaiting() > 0:
+                    self._read_buffer.extend(self._serial.read())
 
     def process_input(self):
-        '''Reads available bytes from PLM, then parses the bytes
-            into a message'''
-        self._read()
-        self._advance_to_msg_start()
-        bytes = self._parse_read_buffer()
-        if bytes:
-            self.process_inc_msg(bytes)
-
-    def _advance_to_msg_start(self):
-        '''Removes extraneous bytes from start of read buffer'''
-        if len(self._read_buffer) >= 2:
-            # Handle Errors First
-            good_prefix = bytes.fromhex('02')
-            wait_prefix = bytes.fromhex('15')
-            if not self._read_buffer.startswith((good_prefix, wait_prefix)):
-                print('Removed bad starting string from', BYTE_TO_HEX(
-                    self._read_buffer))
-                index = self._read_buffer.find(good_prefix)
-                del self._read_buffer[0:index]
-                print('resulting buffer is', BYTE_TO_HEX(self._read_buffer))
-            if self._read_buffer.startswith(wait_prefix):
-                print('need to slow down!!', BYTE_TO_HEX(self._read_buffer))
-                self.wait_to_send = .5
-                del self._read_buffer[0:1]
-                self._advance_to_msg_start()
-
-    def _parse_read_buffer(self):
-        '''Parses messages out of the read buffer'''
-        ret = None
-        if len(self._read_buffer) >= 2:
-            # Process the message
-            cmd_prefix = self._read_buffer[1]
-            if cmd_prefix in PLM_SCHEMA:
-                byte_length = PLM_SCHEMA[cmd_prefix]['rcvd_len']
-                # This solves Insteon stupidity.  0x62 messages can
-                # be either standard or extended length.  The only way
-                # to determine which length we have received is to look
-                # at the message flags
-                is_extended = 0
-                if (cmd_prefix == 0x62 and
-                        len(self._read_buffer) >= 6 and
-                        self._read_buffer[5] & 16):
-                    is_extended = 1
-                msg_length = byte_length[is_extended]
-                if msg_length <= len(self._read_buffer):
-                    ret = self._read_buffer[0:msg_length]
-                    del self._read_buffer[0:msg_length]
+        '''Reads available bytes from PLM, then parses and dispatches every
+            complete message in the buffer, up to msgs_per_pass'''
+        io_thread = self._io_thread
+        if io_thread is None:
+            self._read()
+            next_frame = self._decoder.next_frame
+        else:
+            next_frame = io_thread.next_frame
+        frames = 0
+        self._input_pending = False
+        while self.msgs_per_pass is None or frames < self.msgs_per_pass:
+            frame = next_frame()
+            if frame is None:
+                break
+            if io_thread is None:
+                self.process_inc_msg(frame)
             else:
-                print("error, I don't know this prefix",
-                      BYTE_TO_HEX(cmd_prefix))
-                index = self._read_buffer.find(bytes.fromhex('02'))
-                del self._read_buffer[0:index]
-        return ret
+                self.process_inc_msg(frame, io_thread.frame_time)
+            frames += 1
+        else:
+            # Only capped if the cap left messages behind
+            if io_thread is None:
+                remaining = len(self._read_buffer)
+            else:
+                remaining = io_thread.backlog
+            if remaining:
+                self._input_stats['capped_passes'] += 1
+                self._input_pending = True
+        self._input_stats['last_pass_frames'] = frames
+        self._input_stats['total_frames'] += frames
+        if frames > self._input_stats['max_pass_frames']:
+            self._input_stats['max_pass_frames'] = frames
+
+    def _plm_busy(self):
+        '''Called when the PLM sends a 0x15 byte to say it is busy'''
+        print('need to slow down!!')
+        self._pacer.busy()
 
     @property
     def wait_to_send(self):
@@ -229,35 +423,71 @@ class PLM(Root_Insteon):
             self._wait_to_send = time.time()
         self._wait_to_send += value
 
-    def process_inc_msg(self, raw_msg):
+    def process_inc_msg(self, raw_msg, time_rcvd=None):
+        '''Dispatches one message.  time_rcvd is when the message arrived,
+        if it was read by an io thread'''
+        if time_rcvd is None:
+            time_rcvd = time.time()
+        self._time_rcvd = time_rcvd
+        try:
+            self._dispatch_inc_msg(raw_msg)
+        finally:
+            self._time_rcvd = 0
+            self._rcvd_msg = None
+
+    def _dispatch_inc_msg(self, raw_msg):
         now = datetime.datetime.now().strftime("%M:%S.%f")
         print(now, 'found legitimate msg', BYTE_TO_HEX(raw_msg))
         msg = PLM_Message(self, raw_data=raw_msg, is_incomming=True)
+        self._rcvd_msg = msg
         self._msg_dispatcher(msg)
         self._trigger_mngr.match_msg(msg)
         # TODO clean up expired triggers?
+        for listener in self._msg_listeners:
+            listener(msg)
+
+    @property
+    def time_rcvd(self):
+        '''The time that the message being processed arrived, or 0 when no
+        message is being processed'''
+        return self._time_rcvd
+
+    @property
+    def rcvd_msg(self):
+        '''The message being processed, or None when no message is being
+        processed'''
+        return self._rcvd_msg
+
+    def add_msg_listener(self, function):
+        '''Calls function with each message received from the plm, after
+        the message has been processed'''
+        self._msg_listeners.append(function)
+
+    def remove_msg_listener(self, function):
+        self._msg_listeners.remove(function)
 
     def _msg_dispatcher(self, msg):
+        layout = msg.plm_layout
         if msg.plm_resp_ack:
-            if 'ack_act' in msg.plm_schema:
-                msg.plm_schema['ack_act'](self, msg)
+            if layout.ack_act is not None:
+                layout.ack_act(self, msg)
             else:
                 # Attempting default action
                 self.rcvd_plm_ack(msg)
         elif msg.plm_resp_nack:
-            self.wait_to_send = .5
-            if 'nack_act' in msg.plm_schema:
-                msg.plm_schema['nack_act'](self, msg)
+            self._pacer.nak()
+            if layout.nack_act is not None:
+                layout.nack_act(self, msg)
             else:
                 print('PLM sent NACK to last command, retrying last message')
         elif msg.plm_resp_bad_cmd:
-            self.wait_to_send = .5
-            if 'bad_cmd_act' in msg.plm_schema:
-                msg.plm_schema['bad_cmd_act'](self, msg)
+            self._pacer.nak()
+            if layout.bad_cmd_act is not None:
+                layout.bad_cmd_act(self, msg)
             else:
                 print('PLM said bad command, retrying last message')
-        elif 'recv_act' in msg.plm_schema:
-            msg.plm_schema['recv_act'](self, msg)
+        elif layout.recv_act is not None:
+            layout.recv_act(self, msg)
 
     def get_device_by_addr(self, addr):
         ret = None
@@ -275,15 +505,20 @@ class PLM(Root_Insteon):
 
     def _send_msg(self, msg):
         self._last_sent_msg = msg
+        self._pacer.sent()
         self.write(msg)
 
-    def _resend_failed_msg(self):
-        msg = self._last_sent_msg
+    def _resend_failed_msg(self, msg=None):
+        '''Queues msg, by default the last sent message, to be sent again'''
+        if msg is None:
+            msg = self._last_sent_msg
+            self._last_sent_msg = {}
+        else:
+            self._end_in_flight(msg)
         msg.plm_ack = False
         if msg._insteon_msg:
             msg._insteon_msg.hops_left += 1
             msg._insteon_msg.max_hops += 1
-        self._last_sent_msg = {}
         if msg._device:
             msg._device._resend_msg(msg)
         else:
@@ -294,9 +529,15 @@ class PLM(Root_Insteon):
         if msg.insteon_msg:
             msg.insteon_msg._set_i2cs_checksum()
         if self.port_active:
-            print(now, 'sending data', BYTE_TO_HEX(msg.raw_msg))
+            print(now, 'sending data', BYTE_TO_HEX(msg.raw_view))
             msg.time_sent = time.time()
-            self._serial.write(msg.raw_msg)
+            if self._capture is not None:
+                self._capture.write(CAPTURE_WRITE, msg.raw_view,
+                                    msg.time_sent)
+            if self._io_thread is None:
+                self._serial.write(msg.raw_view)
+            else:
+                self._io_thread.write(msg.raw_view)
         else:
             msg.failed = True
             print(
@@ -317,10 +558,15 @@ class PLM(Root_Insteon):
             self.attribute('sub_cat', msg_obj.get_byte_by_name('sub_cat'))
             self.attribute('firmware', msg_obj.get_byte_by_name('firmware'))
 
-    def send_command(self, command, state='', plm_bytes={}):
+    def send_command(self, command, state='', plm_bytes={},
+                     priority=PRIORITY_NORMAL):
+        '''Queues the command, returns a Command_Future of the message.
+        priority is the PRIORITY_ class of the message'''
         message = self.create_message(command)
         message._insert_bytes_into_raw(plm_bytes)
+        message.priority = priority
         self._queue_device_msg(message, state)
+        return message.future
 
     def create_message(self, command):
         message = PLM_Message(
@@ -330,14 +576,18 @@ class PLM(Root_Insteon):
 
     def process_unacked_msg(self):
         '''checks for unacked messages'''
+        self._update_in_flight()
+        for msg in list(self._in_flight.values()):
+            self._check_device_ack(msg, msg)
         if self._is_ack_pending():
             msg = self._last_sent_msg
         else:
             return
         now = datetime.datetime.now().strftime("%M:%S.%f")
-        # allow 75 milliseconds for the PLM to ack a message
+        deadline = self._unacked_deadline(msg)
+        timed_out = deadline is not None and time.time() > deadline
         if msg.plm_ack is False:
-            if msg.time_sent < time.time() - (75 / 1000):
+            if timed_out:
                 print(now, 'PLM failed to ack the last message')
                 if msg.plm_retry >= 3:
                     print(now, 'PLM retries exceeded, abandoning this message')
@@ -347,49 +597,109 @@ class PLM(Root_Insteon):
                     self._resend_failed_msg()
             return
         if msg.seq_lock:
-            if msg.time_sent < time.time() - msg.seq_time:
+            if timed_out:
                 print(now, 'PLM sequence lock expired, moving on')
                 msg.seq_lock = False
             return
+        self._check_device_ack(msg)
+
+    def _check_device_ack(self, msg, in_flight_msg=None):
+        '''Resends or abandons msg if its device ack has timed out.
+        in_flight_msg is msg if it is in the in flight table'''
         if msg.insteon_msg and msg.insteon_msg.device_ack is False:
-            total_hops = msg.insteon_msg.max_hops * 2
-            hop_delay = 75 if msg.insteon_msg.msg_length == 'standard' else 200
-            # Increase delay on each subsequent retry
-            hop_delay = (msg.insteon_msg.device_retry + 1) * hop_delay
-            # Add 1 additional second based on trial and error, perhaps
-            # to allow device to 'think'
-            total_delay = (total_hops * hop_delay / 1000) + 1
-            if msg.time_plm_ack < time.time() - total_delay:
+            deadline = self._unacked_deadline(msg)
+            if deadline is None or time.time() <= deadline:
+                return
+            now = datetime.datetime.now().strftime("%M:%S.%f")
+            print(
+                now,
+                'device failed to ack a message, total delay =',
+                self._device_ack_delay(msg),
+                'total hops=', msg.insteon_msg.max_hops * 2)
+            if msg.insteon_msg.device_retry >= 3:
                 print(
                     now,
-                    'device failed to ack a message, total delay =',
-                    total_delay, 'total hops=', total_hops)
-                if msg.insteon_msg.device_retry >= 3:
-                    print(
-                        now,
-                        'device retries exceeded, abandoning this message')
-                    msg.failed = True
-                else:
-                    msg.insteon_msg.device_retry += 1
-                    self._resend_failed_msg()
-            return
+                    'device retries exceeded, abandoning this message')
+                msg.failed = True
+                if in_flight_msg is not None:
+                    self._end_in_flight(msg)
+            else:
+                msg.insteon_msg.device_retry += 1
+                self._resend_failed_msg(in_flight_msg)
+
+    def _update_in_flight(self):
+        '''Moves the last sent message into the in flight table once the
+        PLM has acked it, and drops the messages that are done'''
+        msg = self._last_sent_msg
+        if (self._in_flight_window > 1 and msg and not msg.failed and
+                msg.plm_ack and not msg.seq_lock and msg.insteon_msg and
+                not msg.insteon_msg.device_ack):
+            key = self._in_flight_key(msg)
+            if key not in self._in_flight:
+                self._in_flight[key] = msg
+                self._send_scheduler.hold(msg.device)
+                self._last_sent_msg = {}
+        done = [msg for msg in self._in_flight.values()
+                if msg.failed or msg.insteon_msg.device_ack]
+        for msg in done:
+            self._end_in_flight(msg)
+
+    def _in_flight_key(self, msg):
+        device = msg.device
+        return (bytes([device.dev_addr_hi, device.dev_addr_mid,
+                       device.dev_addr_low]),
+                msg.get_byte_by_name('cmd_1'))
+
+    def _end_in_flight(self, msg):
+        key = self._in_flight_key(msg)
+        if self._in_flight.get(key) is msg:
+            del self._in_flight[key]
+            self._send_scheduler.release(msg.device)
+
+    def _unacked_deadline(self, msg):
+        '''Returns the time at which the step of msg that is waiting on an
+        ack times out'''
+        if msg.plm_ack is False:
+            return msg.time_sent + self._plm_ack_latency.timeout(
+                PLM_ACK_TIMEOUT)
+        if msg.seq_lock:
+            return msg.time_sent + msg.seq_time
+        if msg.insteon_msg and msg.insteon_msg.device_ack is False:
+            return msg.time_plm_ack + self._device_ack_delay(msg)
+        return None
+
+    def _device_ack_delay(self, msg):
+        '''Returns the seconds to wait for a device to ack msg.  Once
+        enough acks of messages of the same length from the device have
+        been measured the delay comes from their latency, otherwise from
+        the hops the message may take.  It is never less than the time
+        msg and its ack take to hop'''
+        insteon_msg = msg.insteon_msg
+        retries = insteon_msg.device_retry
+        tracker = msg.device.ack_latency[insteon_msg.msg_length]
+        measured = tracker.timeout(None)
+        if measured is not None:
+            # The ack is a standard message whatever the length of msg
+            hop_time = insteon_msg.max_hops * (
+                self._hop_timing.hop_wait(insteon_msg.msg_length) +
+                self._hop_timing.hop_wait('standard'))
+            return max(measured, hop_time) * (retries + 1)
+        total_hops = msg.insteon_msg.max_hops * 2
+        hop_delay = 75 if msg.insteon_msg.msg_length == 'standard' else 200
+        # Increase delay on each subsequent retry
+        hop_delay = (msg.insteon_msg.device_retry + 1) * hop_delay
+        # Add 1 additional second based on trial and error, perhaps
+        # to allow device to 'think'
+        return (total_hops * hop_delay / 1000) + 1
 
     def process_queue(self):
-        '''Loops through all of the devices and sends the
-        oldest message currently waiting in a device queue
-        if there are no other conflicts'''
+        '''Sends the oldest message currently waiting in a device
+        queue if there are no other conflicts'''
+        self._update_in_flight()
         if (not self._is_ack_pending() and
-                time.time() > self.wait_to_send):
-            devices = [self, ]
-            msg_time = 0
-            sending_device = False
-            for id, device in self._devices.items():
-                devices.append(device)
-            for device in devices:
-                dev_msg_time = device.next_msg_create_time()
-                if dev_msg_time and (msg_time == 0 or dev_msg_time < msg_time):
-                    sending_device = device
-                    msg_time = dev_msg_time
+                len(self._in_flight) < self._in_flight_window and
+                time.time() > self.wait_to_send and self._pacer.ready()):
+            sending_device = self._next_sending_device()
             if sending_device:
                 dev_msg = sending_device.pop_device_queue()
                 if dev_msg:
@@ -398,6 +708,16 @@ class PLM(Root_Insteon):
                         device.last_sent_msg = dev_msg
                     self._send_msg(dev_msg)
 
+    def _next_sending_device(self):
+        '''Returns the device whose message is to be sent next, or None.
+        Background messages are only sent while no message is in flight,
+        they only use the time the network is idle'''
+        ret = self._send_scheduler.next_device()
+        if (ret is not None and self._in_flight and
+                ret.next_msg_priority() == PRIORITY_BACKGROUND):
+            ret = None
+        return ret
+
     def _is_ack_pending(self):
         ret = False
         if self._last_sent_msg and not self._last_sent_msg.failed:
@@ -411,15 +731,15 @@ class PLM(Root_Insteon):
         return ret
 
     def rcvd_plm_ack(self, msg):
-        if (self._last_sent_msg.plm_ack is False and
-                msg.raw_msg[0:-1] == self._last_sent_msg.raw_msg):
+        if (self._last_sent_msg and
+                self._last_sent_msg.plm_ack is False and
+                msg.raw_view[0:-1] == self._last_sent_msg.raw_view):
             self._last_sent_msg.plm_ack = True
-            self._last_sent_msg.time_plm_ack = time.time()
         else:
             print('received spurious plm ack')
 
     def rcvd_all_link_manage_ack(self, msg):
-        aldb = msg.raw_msg[3:11]
+        aldb = bytearray(msg.raw_view[3:11])
         ctrl_code = msg.get_byte_by_name('ctrl_code')
         link_flags = msg.get_byte_by_name('link_flags')
         search_attributes = {
@@ -483,8 +803,9 @@ class PLM(Root_Insteon):
         self.wait_to_send = .5
 
     def rcvd_aldb_record(self, msg):
-        self._aldb.add_record(msg.raw_msg[2:])
-        self.send_command('all_link_next_rec', 'query_aldb')
+        self._aldb.add_record(bytearray(msg.raw_view[2:]))
+        self.send_command('all_link_next_rec', 'query_aldb',
+                          priority=PRIORITY_BACKGROUND)
 
     def end_of_aldb(self, msg):
         self._last_sent_msg.plm_ack = True
@@ -505,7 +826,7 @@ class PLM(Root_Insteon):
                 link_flag = 0xE2
             record = bytearray(8)
             record[0] = link_flag
-            record[1:8] = msg.raw_msg[3:]
+            record[1:8] = msg.raw_view[3:]
             self._aldb.add_record(record)
             # notify the linked device
             device_id = BYTE_TO_ID(record[2], record[3], record[4])
@@ -0,0 +1,172 @@
+'''
+Picks the device whose queued message should be sent next.
+
+Each device's next message is the oldest message queued in its current
+state machine.  Rather than asking every device for that time on every
+loop, the scheduler keeps the times in a heap and only asks a device again
+after the device reports that its queue or state machine has changed.
+
+Heap entries are never removed in place.  When a device's next message
+changes a new entry is pushed and the old one is left behind, it is
+recognised as stale and dropped when it reaches the top of the heap.
+
+A device in a state machine other than default can change its next message
+without being touched, when the state expires.  A second heap holds the
+expiry times of those states so the device is asked again once its state
+has expired.
+
+Devices are ordered by the priority class of their next message first and
+its creation time second, so an interactive command is sent before any
+normal or background message that has been waiting longer.
+
+A device can be held, for example while a message sent to it is still
+waiting on its ack.  A held device is treated as having nothing to send
+until it is released.
+'''
+import heapq
+import itertools
+import time
+
+
+class Send_Scheduler(object):
+    '''Tracks the time of the next message waiting on each device'''
+
+    def __init__(self):
+        self._listener = None
+        self._heap = []
+        self._heads = {}
+        self._expiry_heap = []
+        self._expiries = {}
+        self._order = {}
+        self._dirty = {}
+        self._held = set()
+        self._counter = itertools.count()
+        self._stats = {
+            'refreshes': 0,
+            'stale_entries': 0,
+            'expired_states': 0,
+            'compactions': 0,
+        }
+
+    @property
+    def stats(self):
+        '''Returns a dictionary of the scheduler counters'''
+        ret = self._stats.copy()
+        ret['devices'] = len(self._order)
+        ret['waiting_devices'] = len(self._heads)
+        ret['heap_size'] = len(self._heap)
+        ret['held_devices'] = len(self._held)
+        return ret
+
+    @property
+    def listener(self):
+        '''A function called with no arguments whenever a device is
+        touched, used to wake an event loop when a message is queued'''
+        return self._listener
+
+    @listener.setter
+    def listener(self, function):
+        self._listener = function
+
+    def add_device(self, device):
+        '''Registers the device.  Devices that queue messages with the same
+        time are sent in the order they were added'''
+        self.touch(device)
+
+    def touch(self, device):
+        '''Marks the next message of the device as possibly changed, it is
+        looked up again before the next device is picked'''
+        if device not in self._order:
+            self._order[device] = len(self._order)
+        self._dirty[device] = True
+        if self._listener is not None:
+            self._listener()
+
+    def hold(self, device):
+        '''Stops the device from being returned by next_device until it is
+        released'''
+        self._held.add(device)
+        self.touch(device)
+
+    def release(self, device):
+        if device in self._held:
+            self._held.discard(device)
+            self.touch(device)
+
+    def is_held(self, device):
+        return device in self._held
+
+    def next_device(self, now=None):
+        '''Returns the device with the oldest message of the highest
+        priority waiting to be sent, or None if no device has a message
+        waiting'''
+        if now is None:
+            now = time.time()
+        self._expire_states(now)
+        while self._dirty:
+            device = self._dirty.popitem()[0]
+            self._refresh(device)
+        heap = self._heap
+        while heap:
+            entry = heap[0]
+            if self._heads.get(entry[4]) is entry:
+                return entry[4]
+            heapq.heappop(heap)
+            self._stats['stale_entries'] += 1
+        return None
+
+    def next_expiry(self):
+        '''Returns the earliest time at which a state machine may expire,
+        or None if no device is in a state other than default'''
+        expiry_heap = self._expiry_heap
+        while expiry_heap:
+            expiry, seq, device = expiry_heap[0]
+            if self._expiries.get(device) == expiry:
+                return expiry
+            heapq.heappop(expiry_heap)
+        return None
+
+    def _expire_states(self, now):
+        expiry_heap = self._expiry_heap
+        while expiry_heap and expiry_heap[0][0] <= now:
+            expiry, seq, device = heapq.heappop(expiry_heap)
+            if self._expiries.get(device) == expiry:
+                del self._expiries[device]
+                self._dirty[device] = True
+                self._stats['expired_states'] += 1
+
+    def _refresh(self, device):
+        self._stats['refreshes'] += 1
+        if device in self._held:
+            msg_time = None
+        else:
+            msg_time = device.next_msg_create_time()
+        head = self._heads.get(device)
+        if msg_time:
+            priority = device.next_msg_priority()
+            if head is None or head[0:2] != (priority, msg_time):
+                entry = (priority, msg_time, self._order[device],
+                         next(self._counter), device)
+                self._heads[device] = entry
+                heapq.heappush(self._heap, entry)
+        elif head is not None:
+            del self._heads[device]
+        expiry = device.state_machine_expiry
+        if expiry is None:
+            self._expiries.pop(device, None)
+        elif self._expiries.get(device) != expiry:
+            self._expiries[device] = expiry
+            heapq.heappush(self._expiry_heap,
+                           (expiry, next(self._counter), device))
+        if (len(self._heap) > 2 * len(self._heads) + 64 or
+                len(self._expiry_heap) > 2 * len(self._expiries) + 64):
+            self._compact()
+
+    def _compact(self):
+        '''Rebuilds the heaps without their stale entries'''
+        self._heap = list(self._heads.values())
+        heapq.heapify(self._heap)
+        self._expiry_heap = [entry for entry in self._expiry_heap
+                             if self._expiries.get(entry[2]) == entry[0]]
+        heapq.heapify(self._expiry_heap)
+        self._stats['compactions'] += 1
@@ -0,0 +1,538 @@
+'''
+Runs each PLM in its own worker process.
+
+A single process handling every PLM, device state machine and the REST
+server is limited by the GIL.  A Sharded_Core starts one worker process per
+PLM instead.  Each worker owns its PLM, the devices, their queues and ALDB
+caches, and runs the same event driven loop as Insteon_Core.
+
+The coordinator talks to each worker over a pipe.  Commands are routed to
+the worker whose PLM knows the device address.  The workers send their
+state, in the form saved in the config file, so the coordinator holds a
+merged read only view of every PLM and device.  That view is what
+get_all_plms returns to the REST server and what is saved to the config
+file.
+
+A worker sends its full state when it starts and when the coordinator
+asks for it.  After that it only sends the state of the devices that a
+message was received from or sent to, and of the PLM itself when a
+message from the PLM was received, so the cost of an update does not
+grow with the number of devices.
+'''
+import atexit
+import collections
+import concurrent.futures
+import itertools
+import multiprocessing
+import multiprocessing.connection
+import selectors
+import signal
+import threading
+import time
+
+from .core import SAVE_INTERVAL, device_state, plm_state, read_config, \
+    write_config
+from .helpers import BYTE_TO_ID
+from .message import PRIORITY_NORMAL
+from .plm import PLM
+from .rest_server import Rest_Server
+
+# Seconds between the state updates sent by a worker while it is changing
+STATE_INTERVAL = 0.25
+# Seconds to wait for a new worker to report its state
+START_TIMEOUT = 10
+# Seconds the coordinator waits for messages before checking if it is
+# closing
+LISTEN_TIMEOUT = 0.2
+
+
+class Command_Failed(Exception):
+    '''Raised by the future of a command that the worker could not send,
+    that failed, or that the device nak'ed'''
+
+
+class Shard_Future(concurrent.futures.Future):
+    '''Resolves with the bytes of the message sent once the worker reports
+    that the command was acked'''
+
+    def __init__(self):
+        super().__init__()
+        self._ack_msg = None
+
+    @property
+    def ack_msg(self):
+        '''The bytes of the message that acked the command'''
+        return self._ack_msg
+
+
+def run_worker(conn, plm_kwargs):
+    '''The entry point of a worker process'''
+    # Ctrl+C is handled by the coordinator, which stops the workers
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    Shard_Worker(conn, plm_kwargs).run()
+
+
+class Shard_Worker(object):
+    '''Runs one PLM inside a worker process, taking requests from the
+    coordinator and sending back results and state'''
+
+    def __init__(self, conn, plm_kwargs):
+        self._conn = conn
+        self._plm = PLM(None, **plm_kwargs)
+        self._plm.add_msg_listener(self._rcvd_msg)
+        self._selector = selectors.DefaultSelector()
+        self._selector.register(conn.fileno(), selectors.EVENT_READ)
+        if self._plm.fileno() is not None:
+            self._selector.register(self._plm.fileno(), selectors.EVENT_READ)
+        self._results = collections.deque()
+        # The full state is sent first, then only what changed
+        self._full_state = True
+        self._plm_changed = False
+        self._changed_devices = set()
+        self._known_devices = set(self._plm._devices)
+        self._last_state_time = 0
+        self._running = False
+
+    def run(self):
+        self._running = True
+        while self._running:
+            self._send_updates()
+            self._selector.select(self._time_to_deadline())
+            while self._running and self._conn.poll():
+                try:
+                    request = self._conn.recv()
+                except EOFError:
+                    # The coordinator has gone away
+                    self._running = False
+                    break
+                self._process_request(request)
+            plm = self._plm
+            plm.process_input()
+            plm.process_unacked_msg()
+            plm.process_queue()
+        self._send_updates(True)
+
+    @property
+    def _state_changed(self):
+        return (self._full_state or self._plm_changed or
+                bool(self._changed_devices))
+
+    def _time_to_deadline(self):
+        deadline = self._plm.next_deadline()
+        if self._state_changed:
+            state_deadline = self._last_state_time + STATE_INTERVAL
+            if deadline is None or state_deadline < deadline:
+                deadline = state_deadline
+        if deadline is None:
+            return None
+        return max(0, deadline - time.time())
+
+    def _process_request(self, request):
+        if request[0] == 'send_command':
+            self._send_command(*request[1:])
+        elif request[0] == 'add_device':
+            self._plm.add_device(request[1], attributes=request[2])
+            self._device_changed(request[1])
+        elif request[0] == 'state':
+            self._full_state = True
+        elif request[0] == 'stop':
+            self._running = False
+        else:
+            print('unknown request from coordinator', request[0])
+
+    def _send_command(self, request_id, address, command_name, state,
+                      dev_bytes, priority):
+        future = None
+        if address == self._plm.dev_addr_str:
+            future = self._plm.send_command(command_name, state, dev_bytes,
+                                            priority)
+        else:
+            device = self._plm.get_device_by_addr(address)
+            if device is not None:
+                future = device.send_command(command_name, state, dev_bytes,
+                                             priority)
+        if future is None:
+            self._results.append(('result', request_id, False,
+                                  'unable to send ' + command_name, None))
+        else:
+            future.add_done_callback(
+                lambda future: self._command_done(request_id, future))
+
+    def _command_done(self, request_id, future):
+        ack_msg = None
+        if future.ack_msg is not None:
+            ack_msg = bytes(future.ack_msg.raw_view)
+        if future.exception() is None:
+            self._results.append(('result', request_id, True,
+                                  bytes(future.msg.raw_view), ack_msg))
+        else:
+            self._results.append(('result', request_id, False,
+                                  str(future.exception()), ack_msg))
+        device = future.msg.device
+        if device is None or device is self._plm:
+            self._plm_changed = True
+        else:
+            self._device_changed(device.dev_addr_str)
+
+    def _rcvd_msg(self, msg):
+        '''Marks the device the message came from or was sent to as
+        changed, or the PLM if the message is not about a device'''
+        address = None
+        for prefix in ('from_addr_', 'to_addr_'):
+            if msg.has_byte_name(prefix + 'hi'):
+                address = BYTE_TO_ID(msg.get_byte_by_name(prefix + 'hi'),
+                                     msg.get_byte_by_name(prefix + 'mid'),
+                                     msg.get_byte_by_name(prefix + 'low'))
+                break
+        if address is None or address not in self._plm._devices:
+            self._plm_changed = True
+        else:
+            self._device_changed(address)
+
+    def _device_changed(self, address):
+        self._changed_devices.add(address.upper())
+
+    def _send_updates(self, force=False):
+        while self._results:
+            self._conn.send(self._results.popleft())
+        devices = self._plm._devices
+        if len(devices) != len(self._known_devices):
+            # Devices added by the PLM itself
+            self._changed_devices.update(set(devices) - self._known_devices)
+            self._known_devices = set(devices)
+        if self._state_changed and (force or self._last_state_time <
+                                    time.time() - STATE_INTERVAL):
+            plm = self._plm
+            if self._full_state:
+                self._conn.send(('state', plm.dev_addr_str, plm.port_active,
+                                 plm_state(plm)))
+            else:
+                changed = {}
+                for address in self._changed_devices:
+                    if address in devices:
+                        changed[address] = device_state(devices[address])
+                plm_part = None
+                if self._plm_changed:
+                    plm_part = plm_state(plm, devices=False)
+                self._conn.send(('delta', plm.dev_addr_str, plm.port_active,
+                                 plm_part, changed))
+            self._full_state = False
+            self._plm_changed = False
+            self._changed_devices = set()
+            self._last_state_time = time.time()
+
+
+class PLM_Shard(object):
+    '''A PLM running in a worker process, seen by the coordinator as a read
+    only copy of its last reported state'''
+
+    def __init__(self, core, process, conn, plm_kwargs):
+        self._core = core
+        self._process = process
+        self._conn = conn
+        self._send_lock = threading.Lock()
+        self._ready = threading.Event()
+        self._dev_addr_str = plm_kwargs.get('device_id', '')
+        self._port_active = False
+        self._state = plm_kwargs.get('attributes', {}).copy()
+        if 'port' in plm_kwargs:
+            self._state['port'] = plm_kwargs['port']
+        self._stats = {'states': 0, 'deltas': 0, 'devices_updated': 0}
+
+    @property
+    def pid(self):
+        return self._process.pid
+
+    @property
+    def conn(self):
+        return self._conn
+
+    @property
+    def dev_addr_str(self):
+        return self._dev_addr_str
+
+    @property
+    def dev_cat(self):
+        return self.attribute('dev_cat')
+
+    @property
+    def sub_cat(self):
+        return self.attribute('sub_cat')
+
+    @property
+    def firmware(self):
+        return self.attribute('firmware')
+
+    @property
+    def port(self):
+        return self.attribute('port')
+
+    @property
+    def port_active(self):
+        return self._port_active
+
+    @property
+    def state(self):
+        '''The last state reported by the worker, in the form saved in the
+        config file'''
+        return self._state
+
+    @property
+    def stats(self):
+        '''Counts of the full states and of the deltas received from the
+        worker, and of the devices updated by the deltas'''
+        return self._stats.copy()
+
+    def attribute(self, attr):
+        return self._state.get(attr)
+
+    def get_device_by_addr(self, addr):
+        ret = None
+        if addr in self._state.get('Devices', {}):
+            ret = Device_View(self, addr)
+        else:
+            print('error, unknown device address=', addr)
+        return ret
+
+    def get_all_devices(self):
+        ret = []
+        for addr in self._state.get('Devices', {}):
+            ret.append(Device_View(self, addr))
+        return ret
+
+    def add_device(self, device_id, attributes={}):
+        '''Asks the worker to add the device, it can be used once the
+        worker next reports its state'''
+        self._send(('add_device', device_id.upper(), attributes))
+
+    def wait_ready(self, timeout=None):
+        '''Waits for the first state from the worker, returns False if it
+        did not arrive within timeout seconds'''
+        return self._ready.wait(timeout)
+
+    def request_state(self):
+        '''Asks the worker to send its full state'''
+        self._send(('state',))
+
+    def stop(self):
+        '''Stops the worker process, waiting for its final state'''
+        if self._process.is_alive():
+            try:
+                self._send(('stop',))
+            except (BrokenPipeError, OSError):
+                pass
+            self._process.join(START_TIMEOUT)
+        if self._process.is_alive():
+            self._process.terminate()
+            self._process.join()
+
+    def _send(self, request):
+        with self._send_lock:
+            self._conn.send(request)
+
+    def _rcvd_state(self, dev_addr_str, port_active, state):
+        self._dev_addr_str = dev_addr_str
+        self._port_active = port_active
+        self._state = state
+        self._stats['states'] += 1
+        self._ready.set()
+
+    def _rcvd_delta(self, dev_addr_str, port_active, plm_part, devices):
+        '''Merges the state of the PLM and of the devices that changed.
+        The state is read from other threads, so a dict that gains keys is
+        copied and swapped in rather than changed in place'''
+        self._dev_addr_str = dev_addr_str
+        self._port_active = port_active
+        state = self._state
+        known = state.get('Devices', {})
+        if any(address not in known for address in devices):
+            known = known.copy()
+        known.update(devices)
+        if plm_part is not None or known is not state.get('Devices'):
+            state = dict(plm_part if plm_part is not None else state)
+            state['Devices'] = known
+            self._state = state
+        self._stats['deltas'] += 1
+        self._stats['devices_updated'] += len(devices)
+
+
+class Device_View(object):
+    '''A read only view of a device, from the last state of its PLM'''
+
+    def __init__(self, plm, address):
+        self._plm = plm
+        self._address = address
+
+    @property
+    def plm(self):
+        return self._plm
+
+    @property
+    def dev_addr_str(self):
+        return self._address
+
+    def attribute(self, attr):
+        return self._plm.state['Devices'].get(self._address, {}).get(attr)
+
+    def send_command(self, command_name, state='', dev_bytes={},
+                     priority=PRIORITY_NORMAL):
+        return self._plm._core.send_command(self._address, command_name,
+                                            state, dev_bytes, priority)
+
+
+class Sharded_Core(object):
+    '''Provides the global management functions of Insteon_Core, with each
+    plm running in a worker process'''
+
+    def __init__(self):
+        self._shards = []
+        self._routes = {}
+        self._pending = {}
+        self._request_ids = itertools.count()
+        self._context = multiprocessing.get_context('spawn')
+        self._last_saved_time = time.time()
+        self._running = True
+        self._listener = threading.Thread(target=self._listen, daemon=True)
+        self._listener.start()
+        self._load_state()
+        # Be sure to save and stop the workers before exiting
+        atexit.register(self.close)
+
+    def start_rest_server(self):
+        rest_server = Rest_Server(self)
+        rest_server.start()
+
+    def add_plm(self, **kwargs):
+        '''Starts a worker process for the plm, returns its PLM_Shard once
+        the worker has reported its state'''
+        ret = None
+        if 'attributes' in kwargs:
+            port = kwargs['attributes']['port']
+        elif 'port' in kwargs:
+            port = kwargs['port']
+        else:
+            print('you need to define a port for this plm')
+            return ret
+        for shard in self._shards:
+            if shard.port == port:
+                ret = shard
+        if ret is None:
+            conn, worker_conn = self._context.Pipe()
+            process = self._context.Process(target=run_worker,
+                                            args=(worker_conn, kwargs),
+                                            daemon=True)
+            process.start()
+            worker_conn.close()
+            ret = PLM_Shard(self, process, conn, kwargs)
+            self._shards.append(ret)
+            if not ret.wait_ready(START_TIMEOUT):
+                print('worker for plm on port', port, 'did not start')
+        return ret
+
+    def get_plm_by_id(self, id):
+        ret = None
+        for shard in self._shards:
+            if shard.dev_addr_str == id:
+                ret = shard
+        return ret
+
+    def get_all_plms(self):
+        ret = []
+        for shard in self._shards:
+            ret.append(shard)
+        return ret
+
+    def send_command(self, address, command_name, state='', dev_bytes={},
+                     priority=PRIORITY_NORMAL):
+        '''Sends the command to the device from the worker of the plm that
+        knows the device.  Returns a Shard_Future, or None if no plm knows
+        the address'''
+        ret = None
+        address = address.upper()
+        shard = self._routes.get(address)
+        if shard is None:
+            print('error, unknown device address=', address)
+        else:
+            request_id = next(self._request_ids)
+            ret = Shard_Future()
+            self._pending[request_id] = ret
+            shard._send(('send_command', request_id, address, command_name,
+                         state, dev_bytes, priority))
+        return ret
+
+    def close(self):
+        '''Stops the workers and saves the config'''
+        if not self._running:
+            return
+        self._running = False
+        self._listener.join()
+        for shard in self._shards:
+            shard.stop()
+        # Take the final states sent by the workers as they stopped
+        for shard in self._shards:
+            while shard.conn.poll():
+                try:
+                    self._process_msg(shard, shard.conn.recv())
+                except EOFError:
+                    break
+        for request_id in list(self._pending):
+            self._pending.pop(request_id).set_exception(
+                Command_Failed('worker stopped'))
+        self._save_state(True)
+
+    def _listen(self):
+        while self._running:
+            conns = {}
+            for shard in self._shards:
+                if not shard.conn.closed:
+                    conns[shard.conn] = shard
+            for conn in multiprocessing.connection.wait(
+                    list(conns), timeout=LISTEN_TIMEOUT):
+                try:
+                    msg = conn.recv()
+                except EOFError:
+                    print('worker for plm', conns[conn].dev_addr_str,
+                          'has stopped')
+                    conn.close()
+                    continue
+                self._process_msg(conns[conn], msg)
+            if not conns:
+                time.sleep(LISTEN_TIMEOUT)
+            self._save_state()
+
+    def _process_msg(self, shard, msg):
+        if msg[0] == 'state':
+            shard._rcvd_state(*msg[1:])
+            if shard.dev_addr_str:
+                self._routes[shard.dev_addr_str] = shard
+            for address in shard.state.get('Devices', {}):
+                self._routes[address] = shard
+        elif msg[0] == 'delta':
+            shard._rcvd_delta(*msg[1:])
+            if shard.dev_addr_str:
+                self._routes[shard.dev_addr_str] = shard
+            for address in msg[4]:
+                self._routes[address] = shard
+        elif msg[0] == 'result':
+            request_id, success, data, ack_msg = msg[1:]
+            future = self._pending.pop(request_id, None)
+            if future is not None:
+                future._ack_msg = ack_msg
+                if success:
+                    future.set_result(data)
+                else:
+                    future.set_exception(Command_Failed(data))
+
+    def _save_state(self, is_exit=False):
+        if self._last_saved_time < time.time() - SAVE_INTERVAL or is_exit:
+            out_data = {'PLMs': {}}
+            for shard in self._shards:
+                out_data['PLMs'][shard.dev_addr_str] = shard.state
+            write_config(out_data)
+            self._last_saved_time = time.time()
+
+    def _load_state(self):
+        read_data = read_config()
+        if 'PLMs' in read_data:
+            for plm_id, plm_data in read_data['PLMs'].items():
+                self.add_plm(attributes=plm_data, device_id=plm_id)
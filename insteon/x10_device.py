@@ -26,6 +26,7 @@ class X10_Device(Base_Device):
                                   plm_bytes=plm_bytes)
             self._queue_device_msg(message, state)
             self.status = command.lower()
+            return message.future
         else:
             print("Unrecognized command ", command)
 
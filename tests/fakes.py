@@ -0,0 +1,38 @@
+'''
+Stand ins for the serial port of a PLM, shared by the tests.
+
+Fake_Port is for tests that call the PLM directly.  open_pty is for tests
+that need a real port, they answer the PLM on the master side.
+'''
+import os
+
+
+class Fake_Port(object):
+    '''Returns the queued data from read, counting the calls, and drops
+    what is written'''
+
+    def __init__(self, data=b''):
+        self.data = bytearray(data)
+        self.reads = 0
+
+    def inWaiting(self):
+        return len(self.data)
+
+    def read(self, length=1):
+        self.reads += 1
+        ret = bytes(self.data[0:length])
+        del self.data[0:length]
+        return ret
+
+    def write(self, data):
+        return len(data)
+
+    def next_poll(self):
+        return None
+
+
+def open_pty():
+    '''Returns the master side of a new pty and the name of the slave side
+    to give the PLM as its port'''
+    master, slave = os.openpty()
+    return master, os.ttyname(slave)
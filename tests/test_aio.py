@@ -0,0 +1,103 @@
+import asyncio
+import contextlib
+import io
+import unittest
+# append parent directory to import path
+import env
+# now we can import the lib module
+import insteon.aio
+import insteon.plm
+from insteon.emulator import PLM_Emulator, Emulated_Device
+
+ALDB_RECORD = bytes.fromhex('0257E2011CB587010020')
+
+
+class MyTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        # One hop away, so the device acks with 2 hops left
+        self.device = Emulated_Device('1CB587', aldb_delta=0x05, hops=1)
+        self.emulator = PLM_Emulator(devices=[self.device],
+                                     aldb_records=[ALDB_RECORD[2:]])
+        self.emulator.start()
+        self.output = io.StringIO()
+        self.redirect = contextlib.redirect_stdout(self.output)
+        self.redirect.__enter__()
+        self.plm = insteon.plm.PLM(None, port=self.emulator.port,
+                                   device_id=self.emulator.plm_id)
+        self.plm.add_device('1CB587', attributes=self.device.attributes)
+        self.async_plm = insteon.aio.Async_PLM(self.plm)
+        self.async_plm.start()
+
+    async def asyncTearDown(self):
+        self.async_plm.stop()
+        self.plm._serial.close()
+        self.emulator.stop()
+        self.redirect.__exit__(None, None, None)
+
+    async def test_query_aldb(self):
+        # Let the query started with the plm finish first
+        await self.async_plm.wait_for_state(self.plm, 'query_aldb', 5)
+        records = await self.async_plm.query_aldb(timeout=5)
+        self.assertEqual(list(records.values()),
+                         [bytearray(ALDB_RECORD[2:])])
+
+    async def test_send_command(self):
+        device = self.async_plm.get_device_by_addr('1CB587')
+        msg = await device.send_command('on', timeout=5)
+        self.assertTrue(msg.insteon_msg.device_ack)
+        self.assertEqual(msg.future.ack_msg.raw_msg,
+                         bytes.fromhex('02501CB58720F5F52B11FF'))
+        self.assertEqual(self.device.rcvd[-1],
+                         bytes.fromhex('02621CB5870F11FF'))
+
+    async def test_messages(self):
+        stream = self.async_plm.messages()
+        device = self.async_plm.get_device_by_addr('1CB587')
+        await device.send_command('on', timeout=5)
+        stream.close()
+        msgs = [msg async for msg in stream]
+        self.assertEqual(msgs[-1].raw_msg,
+                         bytes.fromhex('02501CB58720F5F52B11FF'))
+
+    async def test_command_futures(self):
+        device = self.plm.get_device_by_addr('1CB587')
+        futures = []
+        for i in range(20):
+            futures.append(device.send_command('on', '', {'cmd_2': i}))
+        await asyncio.wait_for(asyncio.gather(
+            *[asyncio.wrap_future(future) for future in futures]), 10)
+        for i, future in enumerate(futures):
+            self.assertIs(future.result(), future.msg)
+            self.assertEqual(future.msg.get_byte_by_name('cmd_2'), i)
+            self.assertGreater(future.latency, 0)
+            self.assertGreater(future.send_latency, 0)
+            self.assertLessEqual(future.send_latency, future.latency)
+        # Sent in the order queued
+        self.assertEqual([future.msg.time_sent for future in futures],
+                         sorted(future.msg.time_sent for future in futures))
+
+    async def test_nak_command(self):
+        device = self.plm.get_device_by_addr('1CB587')
+        for reason in (0xFB, 0xFE):
+            self.device.nak_rate = 1.0
+            self.device.nak_reason = reason
+            future = device.send_command('on')
+            with self.assertRaises(insteon.aio.Message_Nak) as context:
+                await asyncio.wait_for(asyncio.wrap_future(future), 5)
+            self.assertIsInstance(context.exception,
+                                  insteon.aio.Message_Failed)
+            self.assertIs(context.exception.msg, future.msg)
+            self.assertIs(context.exception.nak_msg, future.ack_msg)
+            self.assertEqual(future.ack_msg.get_byte_by_name('cmd_2'),
+                             reason)
+            # A nak is an answer, the message is not resent
+            self.assertEqual(future.msg.insteon_msg.device_retry, 0)
+
+    async def test_failed_command(self):
+        self.emulator.plm_nak_rate = 1.0
+        device = self.async_plm.get_device_by_addr('1CB587')
+        with self.assertRaises(insteon.aio.Message_Failed):
+            await device.send_command('on', timeout=5)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,96 @@
+import unittest
+# append parent directory to import path
+import env
+from fakes import Fake_Port
+# now we can import the lib module
+from insteon.buffer import Read_Buffer
+
+
+class MyTest(unittest.TestCase):
+    def test_extend_fits(self):
+        buffer = Read_Buffer(8)
+        store = buffer._buffer
+        buffer.extend(b'\x02\x50')
+        buffer.extend(b'\x1C\xB5')
+        self.assertIs(buffer._buffer, store)
+        self.assertEqual(buffer, b'\x02\x50\x1C\xB5')
+        self.assertEqual((buffer._head, buffer._tail), (0, 4))
+
+    def test_compact_to_front(self):
+        buffer = Read_Buffer(8)
+        store = buffer._buffer
+        buffer.extend(b'\x01\x02\x03\x04\x05\x06')
+        buffer.consume(4)
+        # 4 bytes do not fit after the tail, but do once the 2 unread
+        # bytes are moved to the start
+        buffer.extend(b'\x07\x08\x09\x0A')
+        self.assertIs(buffer._buffer, store)
+        self.assertEqual(buffer.capacity, 8)
+        self.assertEqual((buffer._head, buffer._tail), (0, 6))
+        self.assertEqual(buffer, b'\x05\x06\x07\x08\x09\x0A')
+
+    def test_grow(self):
+        buffer = Read_Buffer(8)
+        buffer.extend(b'\x01\x02\x03\x04\x05\x06')
+        buffer.consume(1)
+        buffer.extend(bytes(range(7, 12)))
+        self.assertEqual(buffer.capacity, 16)
+        self.assertEqual(buffer, bytes(range(2, 12)))
+        buffer.extend(bytes(40))
+        self.assertEqual(buffer.capacity, 50)
+        self.assertEqual(len(buffer), 50)
+
+    def test_consume_resets(self):
+        buffer = Read_Buffer(8)
+        buffer.extend(b'\x01\x02\x03')
+        buffer.consume(2)
+        self.assertEqual((buffer._head, buffer._tail), (2, 3))
+        buffer.consume(1)
+        self.assertEqual((buffer._head, buffer._tail), (0, 0))
+        # Consuming more than is waiting empties the buffer
+        buffer.extend(b'\x01\x02')
+        buffer.consume(10)
+        self.assertEqual(len(buffer), 0)
+        self.assertEqual((buffer._head, buffer._tail), (0, 0))
+
+    def test_delitem(self):
+        buffer = Read_Buffer(8)
+        buffer.extend(b'\x01\x02\x03\x04')
+        del buffer[0:2]
+        self.assertEqual(buffer, b'\x03\x04')
+        del buffer[:1]
+        self.assertEqual(buffer, b'\x04')
+        with self.assertRaises(ValueError):
+            del buffer[1:2]
+        with self.assertRaises(TypeError):
+            del buffer[0]
+        with self.assertRaises(TypeError):
+            del buffer[0:2:2]
+        del buffer[:]
+        self.assertEqual((buffer._head, buffer._tail), (0, 0))
+
+    def test_indexing(self):
+        buffer = Read_Buffer(8)
+        buffer.extend(b'\x01\x02\x03\x04')
+        buffer.consume(1)
+        self.assertEqual(buffer[0], 0x02)
+        self.assertEqual(buffer[-1], 0x04)
+        self.assertEqual(buffer[1:], b'\x03\x04')
+        self.assertEqual(buffer.find(b'\x04'), 2)
+        self.assertEqual(buffer.find(b'\x01'), -1)
+        self.assertTrue(buffer.startswith((b'\x01', b'\x02\x03')))
+        with self.assertRaises(IndexError):
+            buffer[3]
+
+    def test_fill_from(self):
+        buffer = Read_Buffer(8)
+        port = Fake_Port(bytes(range(20)))
+        self.assertEqual(buffer.fill_from(port), 20)
+        self.assertEqual(port.reads, 1)
+        self.assertEqual(buffer, bytes(range(20)))
+        # Nothing waiting does not read
+        self.assertEqual(buffer.fill_from(port), 0)
+        self.assertEqual(port.reads, 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,126 @@
+import contextlib
+import io
+import os
+import select
+import shutil
+import tempfile
+import time
+import unittest
+# append parent directory to import path
+import env
+# now we can import the lib module
+import insteon.plm
+from insteon.capture import Capture_Writer, Capture_Reader, Capture_Replay, \
+    CAPTURE_READ, CAPTURE_WRITE, FILE_MAGIC, RECORD_HEADER
+from insteon.emulator import PLM_Emulator, Emulated_Device
+
+
+class MyTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'plm.cap')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_write_and_read(self):
+        writer = Capture_Writer(self.path)
+        writer.write(CAPTURE_WRITE, b'\x02\x60', 10.0)
+        writer.write(CAPTURE_READ, bytearray(b'\x02\x60\x20\xF5'), 10.5)
+        writer.close()
+        # Appending keeps the earlier records
+        writer = Capture_Writer(self.path)
+        writer.write(CAPTURE_READ, b'\xF5\x03', 11.0)
+        writer.close()
+        self.assertEqual(list(Capture_Reader(self.path)),
+                         [(10.0, CAPTURE_WRITE, b'\x02\x60'),
+                          (10.5, CAPTURE_READ, b'\x02\x60\x20\xF5'),
+                          (11.0, CAPTURE_READ, b'\xF5\x03')])
+        self.assertEqual(os.path.getsize(self.path),
+                         len(FILE_MAGIC) + 3 * RECORD_HEADER.size + 8)
+
+    def test_truncated_record(self):
+        writer = Capture_Writer(self.path)
+        writer.write(CAPTURE_READ, b'\x02\x50', 1.0)
+        writer.write(CAPTURE_READ, b'\x02\x50\x1C\xB5', 2.0)
+        writer.close()
+        with open(self.path, 'r+b') as capture:
+            capture.truncate(os.path.getsize(self.path) - 1)
+        self.assertEqual(list(Capture_Reader(self.path)),
+                         [(1.0, CAPTURE_READ, b'\x02\x50')])
+
+    def test_not_a_capture(self):
+        with open(self.path, 'wb') as capture:
+            capture.write(b'\x00' * 32)
+        with self.assertRaises(ValueError):
+            list(Capture_Reader(self.path))
+
+    def test_capture_and_replay(self):
+        emulator = PLM_Emulator(devices=[Emulated_Device('1CB587')], seed=1)
+        emulator.start()
+        attributes = emulator.plm_attributes()
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                plm = insteon.plm.PLM(None, device_id=emulator.plm_id,
+                                      attributes=attributes)
+                plm.start_capture(self.path)
+                device = plm.get_device_by_addr('1CB587')
+                future = device.send_command('on', '', {'cmd_2': 0x80})
+                end = time.time() + 5
+                while not future.done() and time.time() < end:
+                    select.select([plm.fileno()], [], [], 0.01)
+                    plm.process_input()
+                    plm.process_unacked_msg()
+                    plm.process_queue()
+            self.assertTrue(future.done())
+            plm.stop_capture()
+            plm._serial.close()
+        finally:
+            emulator.stop()
+        records = list(Capture_Reader(self.path))
+        self.assertTrue(any(direction == CAPTURE_WRITE and data[1] == 0x62
+                            for rcvd_time, direction, data in records))
+        read_bytes = sum(len(data) for rcvd_time, direction, data in records
+                         if direction == CAPTURE_READ)
+
+        attributes['port'] = '/nonexistent'
+        with contextlib.redirect_stdout(io.StringIO()):
+            replay_plm = insteon.plm.PLM(None, device_id=emulator.plm_id,
+                                         attributes=attributes)
+            # The commands sent by the application are not in the capture
+            replay_device = replay_plm.get_device_by_addr('1CB587')
+            replay_future = replay_device.send_command('on', '',
+                                                       {'cmd_2': 0x80})
+            replay = Capture_Replay(replay_plm, self.path)
+            stats = replay.run()
+        self.assertEqual(stats['bytes'], read_bytes)
+        self.assertEqual(replay_plm.input_stats['total_frames'],
+                         plm.input_stats['total_frames'])
+        # The replayed PLM sent the same messages and got the same acks
+        self.assertEqual(replay.port.written,
+                         [bytes(data) for rcvd_time, direction, data in records
+                          if direction == CAPTURE_WRITE])
+        self.assertTrue(replay_future.done())
+        self.assertEqual(
+            replay_future.ack_msg.get_byte_by_name('cmd_2'), 0x80)
+        self.assertEqual(replay_device.attribute('status'),
+                         device.attribute('status'))
+
+    def test_replay_speed(self):
+        writer = Capture_Writer(self.path)
+        writer.write(CAPTURE_READ, b'\x15', 100.0)
+        writer.write(CAPTURE_READ, b'\x15', 100.2)
+        writer.close()
+        with contextlib.redirect_stdout(io.StringIO()):
+            plm = insteon.plm.PLM(None, port='/nonexistent',
+                                  device_id='20F5F5')
+            stats = Capture_Replay(plm, self.path).run(speed=1)
+        self.assertEqual(stats['records'], 2)
+        self.assertGreaterEqual(stats['elapsed'], 0.2)
+        with contextlib.redirect_stdout(io.StringIO()):
+            stats = Capture_Replay(plm, self.path).run(speed=4)
+        self.assertLess(stats['elapsed'], 0.2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,119 @@
+import contextlib
+import io
+import os
+import unittest
+# append parent directory to import path
+import env
+from fakes import open_pty
+# now we can import the lib module
+import insteon.plm
+from insteon.message import PLM_Message
+from insteon.msg_schema import COMMAND_SCHEMA
+
+TEST_COMMAND = [
+    {'DevCat': 'all',
+        'value': [
+            {'SubCat': 'all',
+                'value': [
+                    {'Firmware': 'all',
+                        'value': {
+                            'cmd_1': {
+                                'default': 0x11
+                            },
+                            'cmd_2': {
+                                'default': 0xFF,
+                                'function': lambda x: x.attribute('test_level')
+                            },
+                            'msg_length': 'standard',
+                            'message_type': 'direct'
+                        }
+                     }
+                ]
+             }
+        ]
+     }
+]
+
+
+class MyTest(unittest.TestCase):
+    def setUp(self):
+        self.master, port = open_pty()
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.plm = insteon.plm.PLM(None, port=port,
+                                       device_id='20F5F5')
+            self.device = self.plm.add_device(
+                '1CB587', attributes={'engine_version': 0x02,
+                                      'dev_cat': 0x02,
+                                      'sub_cat': 0x20,
+                                      'firmware': 0x41,
+                                      'test_level': 0x40})
+        COMMAND_SCHEMA['test_level'] = TEST_COMMAND
+
+    def tearDown(self):
+        del COMMAND_SCHEMA['test_level']
+        os.close(self.master)
+
+    def schema_message(self, command_name):
+        '''Builds the message by walking the COMMAND_SCHEMA'''
+        command = COMMAND_SCHEMA[command_name]
+        for search_item in (['DevCat', self.device.dev_cat],
+                            ['SubCat', self.device.sub_cat],
+                            ['Firmware', self.device.firmware]):
+            command = self.device._recursive_search_cmd(command, search_item)
+        command = command.copy()
+        command['name'] = command_name
+        return PLM_Message(self.plm, device=self.device,
+                           plm_cmd='insteon_send', dev_cmd=command)
+
+    def assert_same_frame(self, command_name, dev_bytes={}):
+        with contextlib.redirect_stdout(io.StringIO()):
+            expected = self.schema_message(command_name)
+            # Built twice so the second comes from the cached template
+            self.device.create_message(command_name)
+            message = self.device.create_message(command_name)
+        for msg in (expected, message):
+            msg._insert_bytes_into_raw(dev_bytes)
+            msg.insteon_msg._set_i2cs_checksum()
+        self.assertEqual(message.raw_view, expected.raw_view)
+        self.assertEqual(message.insteon_msg.device_cmd_name, command_name)
+        return message
+
+    def test_standard_command(self):
+        message = self.assert_same_frame('light_status_request')
+        self.assertEqual(bytes(message.raw_view),
+                         bytes.fromhex('02621CB5870F1900'))
+
+    def test_extended_command(self):
+        message = self.assert_same_frame('write_aldb',
+                                         {'msb': 0x0F, 'lsb': 0xF7,
+                                          'link_flags': 0xE2,
+                                          'dev_addr_hi': 0x20})
+        self.assertEqual(message.insteon_msg.msg_length, 'extended')
+        self.assertTrue(message.insteon_msg.valid_i2cs_checksum)
+        self.assertNotEqual(message.get_byte_by_name('usr_14'), 0)
+
+    def test_function_bytes(self):
+        message = self.assert_same_frame('test_level')
+        self.assertEqual(message.get_byte_by_name('cmd_2'), 0x40)
+        # The function is called again on each send
+        self.device.attribute('test_level', 0x80)
+        message = self.assert_same_frame('test_level')
+        self.assertEqual(message.get_byte_by_name('cmd_2'), 0x80)
+
+    def test_identity_change_clears_templates(self):
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.device.create_message('light_status_request')
+        self.assertEqual(len(self.device._command_templates), 1)
+        # Setting the same value keeps the templates
+        self.device.attribute('dev_cat', 0x02)
+        self.assertEqual(len(self.device._command_templates), 1)
+        self.device.attribute('dev_cat', 0x01)
+        self.assertEqual(len(self.device._command_templates), 0)
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.device.create_message('light_status_request')
+        self.assertEqual(len(self.device._command_templates), 1)
+        self.device.attribute('engine_version', 0x01)
+        self.assertEqual(len(self.device._command_templates), 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,106 @@
+import atexit
+import contextlib
+import io
+import os
+import signal
+import tempfile
+import threading
+import unittest
+# append parent directory to import path
+import env
+from fakes import open_pty
+# now we can import the lib module
+import insteon.core
+
+REPLIES = {
+    # Get first all link record, the plm has none
+    bytes.fromhex('0269'): bytes.fromhex('026915'),
+    # Get plm info
+    bytes.fromhex('0260'): bytes.fromhex('026020F5F503159B06'),
+}
+
+
+class MyTest(unittest.TestCase):
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tempdir = tempfile.TemporaryDirectory()
+        os.chdir(self.tempdir.name)
+        self.sigint = signal.getsignal(signal.SIGINT)
+        self.master, port = open_pty()
+        self.running = True
+        self.responder = threading.Thread(target=self.respond, daemon=True)
+        self.responder.start()
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.core = insteon.core.Insteon_Core(threaded_io=True)
+            self.plm = self.core.add_plm(port=port,
+                                         device_id='20F5F5')
+
+    def tearDown(self):
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.core.close()
+        atexit.unregister(self.core.close)
+        signal.signal(signal.SIGINT, self.sigint)
+        self.running = False
+        os.close(self.master)
+        os.chdir(self.cwd)
+        self.tempdir.cleanup()
+
+    def respond(self):
+        while self.running:
+            try:
+                data = os.read(self.master, 100)
+            except OSError:
+                break
+            reply = REPLIES.get(data)
+            if reply is not None:
+                os.write(self.master, reply)
+
+    def test_threaded_io(self):
+        self.assertIsNotNone(self.plm.io_thread)
+        self.assertIsNone(self.plm.fileno())
+        with contextlib.redirect_stdout(io.StringIO()):
+            future = self.plm.send_command('plm_info')
+            pending = self.core.run_until_complete([future], timeout=5)
+        self.assertEqual(len(pending), 0)
+        self.assertEqual(self.plm.attribute('firmware'), 0x9B)
+        self.assertFalse(self.plm.state_pending('query_aldb'))
+        self.assertGreater(future.msg.time_plm_ack, 0)
+        self.assertLessEqual(future.msg.time_plm_ack,
+                             self.plm.io_thread.frame_time)
+
+    def test_run_forever_submit(self):
+        futures = []
+        done = threading.Event()
+
+        def fail():
+            raise ValueError('submitted function failed')
+
+        def send():
+            futures.append(self.plm.send_command('plm_info'))
+            futures[0].add_done_callback(lambda future: done.set())
+
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            thread = threading.Thread(target=self.core.run_forever)
+            thread.start()
+            self.core.submit(fail)
+            self.core.submit(send)
+            done.wait(5)
+            self.core.stop()
+            thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertTrue(futures[0].done())
+        self.assertEqual(self.plm.attribute('firmware'), 0x9B)
+        self.assertIn('submitted function failed', output.getvalue())
+
+    def test_close_stops_io_threads(self):
+        io_thread = self.plm.io_thread
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.core.close()
+        self.assertIsNone(self.plm.io_thread)
+        self.assertFalse(io_thread._reader.is_alive())
+        self.assertFalse(io_thread._writer.is_alive())
+        self.assertTrue(os.path.exists('config.json'))
+
+if __name__ == '__main__':
+    unittest.main()
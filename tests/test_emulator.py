@@ -0,0 +1,241 @@
+import concurrent.futures
+import contextlib
+import io
+import select
+import time
+import unittest
+# append parent directory to import path
+import env
+# now we can import the lib module
+import insteon.plm
+from insteon.emulator import PLM_Emulator, Emulated_Device
+from insteon.message import Message_Nak, PRIORITY_INTERACTIVE, \
+    PRIORITY_BACKGROUND
+
+ALDB_RECORDS = [bytes.fromhex('E2011CB587010020'),
+                bytes.fromhex('A2012AB587010020')]
+DEVICE_ALDB_RECORDS = [bytes.fromhex('E20120F5F5000000'),
+                       bytes.fromhex('A20120F5F5FF1C01'),
+                       bytes.fromhex('A20220F5F5FF1C02')]
+
+
+class MyTest(unittest.TestCase):
+    def setUp(self):
+        self.devices = [Emulated_Device('1CB587',
+                                        aldb_records=DEVICE_ALDB_RECORDS),
+                        Emulated_Device('2AB587', hops=2, duplicates=1,
+                                        ack_latency=0.02),
+                        Emulated_Device('3CB587', nak_rate=1.0,
+                                        nak_reason=0xFB),
+                        Emulated_Device('6CB587')]
+        self.emulator = PLM_Emulator(devices=self.devices,
+                                     aldb_records=ALDB_RECORDS, seed=1)
+        self.emulator.start()
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.plm = insteon.plm.PLM(
+                None, device_id=self.emulator.plm_id,
+                attributes=self.emulator.plm_attributes())
+
+    def tearDown(self):
+        self.plm._serial.close()
+        self.emulator.stop()
+
+    def run_plm(self, done, timeout=5):
+        '''Runs the plm the way the core does until done returns True'''
+        end = time.time() + timeout
+        with contextlib.redirect_stdout(io.StringIO()):
+            while not done() and time.time() < end:
+                deadline = self.plm.next_deadline()
+                if deadline is None or deadline > end:
+                    deadline = end
+                select.select([self.plm.fileno()], [], [],
+                              max(0, deadline - time.time()))
+                self.plm.process_input()
+                self.plm.process_unacked_msg()
+                self.plm.process_queue()
+        self.assertTrue(done())
+
+    def test_plm_info_and_aldb(self):
+        self.run_plm(lambda: not self.plm.state_pending('query_aldb'))
+        records = self.plm._aldb.get_all_records()
+        self.assertEqual(sorted(bytes(record) for record in records.values()),
+                         sorted(ALDB_RECORDS))
+        with contextlib.redirect_stdout(io.StringIO()):
+            future = self.plm.send_command('plm_info')
+        self.run_plm(future.done)
+        self.assertEqual(self.plm.attribute('firmware'), 0x9B)
+
+    def test_device_commands(self):
+        futures = []
+        with contextlib.redirect_stdout(io.StringIO()):
+            for address in ('1CB587', '2AB587'):
+                device = self.plm.get_device_by_addr(address)
+                futures.append(device.send_command('on', '', {'cmd_2': 0x80}))
+        self.run_plm(lambda: all(future.done() for future in futures))
+        for future in futures:
+            self.assertEqual(future.ack_msg.get_byte_by_name('cmd_1'), 0x11)
+        self.assertEqual(self.devices[0].level, 0x80)
+        self.assertEqual(self.devices[1].level, 0x80)
+        for device in self.devices[0:2]:
+            self.assertEqual(
+                [frame[6] for frame in device.rcvd if frame[6] != 0x19],
+                [0x11])
+        # One duplicate of each ack from the device two hops away
+        stats = self.emulator.stats
+        self.assertEqual(stats['duplicates'],
+                         len(self.devices[1].rcvd))
+        # The first ack of the device two hops away used both hops
+        self.assertEqual(
+            futures[1].ack_msg.insteon_msg.hops_left,
+            futures[1].msg.insteon_msg.max_hops - 2)
+
+    def test_device_nak(self):
+        with contextlib.redirect_stdout(io.StringIO()):
+            device = self.plm.get_device_by_addr('3CB587')
+            future = device.send_command('on')
+        self.run_plm(future.done)
+        self.assertIsInstance(future.exception(), Message_Nak)
+        self.assertEqual(future.ack_msg.get_byte_by_name('cmd_2'), 0xFB)
+        self.assertEqual(self.emulator.stats['device_naks'],
+                         len(self.devices[2].rcvd))
+
+    def test_busy(self):
+        self.emulator.busy_rate = 0.25
+        with contextlib.redirect_stdout(io.StringIO()):
+            device = self.plm.get_device_by_addr('1CB587')
+            futures = [device.send_command('on') for i in range(2)]
+        self.run_plm(lambda: all(future.done() for future in futures), 20)
+        for future in futures:
+            self.assertIsNone(future.exception())
+        stats = self.emulator.stats
+        self.assertGreater(stats['busy'], 0)
+        self.assertEqual(self.plm.input_stats['busy_bytes'], stats['busy'])
+
+    def test_in_flight_window(self):
+        self.run_plm(lambda: not self.plm.state_pending('query_aldb'))
+        slow = Emulated_Device('5CB587', ack_latency=0.5)
+        self.emulator.add_device(slow)
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.plm.add_device('5CB587', attributes=slow.attributes)
+        self.run_plm(lambda: self.plm.next_deadline() is None)
+        self.plm.in_flight_window = 4
+        with contextlib.redirect_stdout(io.StringIO()):
+            slow_future = self.plm.get_device_by_addr('5CB587').send_command(
+                'on')
+            slow_next = self.plm.get_device_by_addr('5CB587').send_command(
+                'off')
+            fast_future = self.plm.get_device_by_addr('1CB587').send_command(
+                'on')
+        self.run_plm(fast_future.done)
+        # The fast device was not held up by the slow one, and the slow
+        # device still has one message in flight at a time
+        self.assertFalse(slow_future.done())
+        self.assertEqual(self.plm.send_scheduler.stats['held_devices'], 1)
+        self.assertEqual(list(self.plm.in_flight),
+                         [(bytes.fromhex('5CB587'), 0x11)])
+        self.run_plm(slow_next.done)
+        self.assertIsNone(slow_future.exception())
+        self.assertIsNone(slow_next.exception())
+        self.assertEqual([frame[6] for frame in slow.rcvd], [0x19, 0x11, 0x13])
+        self.assertEqual(self.plm.in_flight, {})
+
+    def test_device_aldb(self):
+        self.run_plm(lambda: self.plm.next_deadline() is None)
+        device = self.plm.get_device_by_addr('1CB587')
+        with contextlib.redirect_stdout(io.StringIO()):
+            device._aldb.query_aldb()
+        self.run_plm(lambda: not device.state_pending('query_aldb'))
+        records = device._aldb.get_all_records()
+        self.assertEqual(sorted(records), ['0FE7', '0FEF', '0FF7', '0FFF'])
+        self.assertEqual([bytes(records[key]) for key in
+                          ('0FFF', '0FF7', '0FEF')], DEVICE_ALDB_RECORDS)
+        self.assertEqual(bytes(records['0FE7']), bytes(8))
+        # One read asked for all of the records
+        self.assertEqual([frame[12] for frame in self.devices[0].rcvd
+                          if frame[6] == 0x2F], [0x00])
+        self.assertEqual(device._aldb.stats['streamed'], 4)
+
+    def test_bulk_aldb_gaps(self):
+        self.run_plm(lambda: self.plm.next_deadline() is None)
+        aldb = [bytes([0xA2, i]) + bytes.fromhex('20F5F5000000')
+                for i in range(16)]
+        self.devices[0].aldb = aldb
+        self.devices[0].aldb_loss_rate = 0.2
+        device = self.plm.get_device_by_addr('1CB587')
+        with contextlib.redirect_stdout(io.StringIO()):
+            device._aldb.query_aldb()
+        self.run_plm(lambda: not device.state_pending('query_aldb'),
+                     timeout=20)
+        records = device._aldb.get_all_records()
+        self.assertEqual([bytes(records[key])
+                          for key in sorted(records, reverse=True)],
+                         aldb + [bytes(8)])
+        # Only the records lost were read again
+        stats = device._aldb.stats
+        self.assertGreater(stats['refetched'], 0)
+        self.assertEqual(stats['streamed'] + stats['refetched'], 17)
+        self.assertEqual(stats['stalls'], 0)
+
+    def test_ack_timeout_per_length(self):
+        self.run_plm(lambda: self.plm.next_deadline() is None)
+        self.devices[0].hops = 2
+        device = self.plm.get_device_by_addr('1CB587')
+        with contextlib.redirect_stdout(io.StringIO()):
+            futures = [device.send_command('on', '', {'cmd_2': i})
+                       for i in range(32)]
+        self.run_plm(lambda: all(future.done() for future in futures))
+        self.assertIsNotNone(device.ack_latency['standard'].timeout(None))
+        # The extended reads ack slower than the standard commands taught,
+        # none of them is resent
+        with contextlib.redirect_stdout(io.StringIO()):
+            device._aldb.query_aldb(bulk=False)
+        self.run_plm(lambda: not device.state_pending('query_aldb'),
+                     timeout=10)
+        self.assertEqual(len(device._aldb.get_all_records()), 4)
+        self.assertEqual(len([frame for frame in self.devices[0].rcvd
+                              if frame[6] == 0x2F]), 4)
+
+    def test_interactive_during_scan(self):
+        self.run_plm(lambda: self.plm.next_deadline() is None)
+        scanned = self.plm.get_device_by_addr('1CB587')
+        with contextlib.redirect_stdout(io.StringIO()):
+            scanned._aldb.query_aldb()
+            # Background work queued on another device first
+            background = self.plm.get_device_by_addr('6CB587').send_command(
+                'light_status_request', priority=PRIORITY_BACKGROUND)
+            future = self.plm.get_device_by_addr('2AB587').send_command(
+                'on', '', {'cmd_2': 0x40}, PRIORITY_INTERACTIVE)
+        self.run_plm(future.done)
+        # The interactive command went out before the background message
+        # queued ahead of it, and before the scan finished
+        self.assertFalse(background.done())
+        self.assertTrue(scanned.state_pending('query_aldb'))
+        self.run_plm(lambda: not scanned.state_pending('query_aldb'))
+
+    def test_preempt_scan(self):
+        self.run_plm(lambda: self.plm.next_deadline() is None)
+        device = self.plm.get_device_by_addr('1CB587')
+        with contextlib.redirect_stdout(io.StringIO()):
+            device._aldb.query_aldb(bulk=False)
+        self.run_plm(lambda: len(device._aldb.get_all_records()) == 1)
+        with contextlib.redirect_stdout(io.StringIO()):
+            future = device.send_command('on', '', {'cmd_2': 0x40},
+                                         PRIORITY_INTERACTIVE)
+        self.run_plm(future.done)
+        self.assertTrue(device.state_pending('query_aldb'))
+        self.assertEqual(device.preemptions, 1)
+        self.run_plm(lambda: not device.state_pending('query_aldb'))
+        # The command went out between two reads and the scan resumed
+        self.assertEqual([frame[6] for frame in self.devices[0].rcvd
+                          if frame[6] != 0x19],
+                         [0x2F, 0x11, 0x2F, 0x2F, 0x2F])
+        self.assertEqual(len(device._aldb.get_all_records()), 4)
+
+    def test_unknown_device(self):
+        with contextlib.redirect_stdout(io.StringIO()):
+            device = self.plm.add_device('4CB587')
+            device.send_command('on')
+        self.run_plm(lambda: self.emulator.stats['unknown_devices'] > 0)
+
+if __name__ == '__main__':
+    unittest.main()
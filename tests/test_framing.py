@@ -0,0 +1,75 @@
+import unittest
+# append parent directory to import path
+import env
+# now we can import the lib module
+import insteon.framing
+
+class MyTest(unittest.TestCase):
+    def setUp(self):
+        self.busy_count = 0
+        self.decoder = insteon.framing.Frame_Decoder(
+            busy_callback=self.busy_callback)
+
+    def busy_callback(self):
+        self.busy_count += 1
+
+    def test_advance_to_msg_start(self):
+        self.decoder.feed(bytearray.fromhex('0002'))
+        self.assertEqual(self.decoder.next_frame(), None)
+        self.assertEqual(self.decoder.buffer, bytes([0x02]))
+        self.assertEqual(self.decoder.stats['skipped_bytes'], 1)
+        self.decoder.buffer.clear()
+        self.decoder.feed(bytearray.fromhex('1502'))
+        self.assertEqual(self.decoder.next_frame(), None)
+        self.assertEqual(self.decoder.buffer, bytes([0x02]))
+        self.assertEqual(self.busy_count, 1)
+
+    def test_parse_read_buffer(self):
+        self.decoder.feed(bytearray.fromhex(
+            '02621CB587052BFB0602501CB58720F5F5212BF5'))
+        self.assertEqual(self.decoder.next_frame(),
+                         bytearray.fromhex('02621CB587052BFB06'))
+        self.assertEqual(self.decoder.next_frame(),
+                         bytearray.fromhex('02501CB58720F5F5212BF5'))
+        self.assertEqual(self.decoder.next_frame(), None)
+        self.assertEqual(len(self.decoder.buffer), 0)
+
+    def test_extended_insteon_send(self):
+        msg = bytearray.fromhex(
+            '02621CB587152F0000000FFF010000000000000000D106')
+        self.decoder.feed(msg[0:9])
+        self.assertEqual(self.decoder.next_frame(), None)
+        self.decoder.feed(msg[9:])
+        self.assertEqual(self.decoder.next_frame(), msg)
+
+    def test_partial_message(self):
+        msg = bytearray.fromhex('02501CB58720F5F5212BF5')
+        for i in range(len(msg) - 1):
+            self.decoder.feed(msg[i:i + 1])
+            self.assertEqual(self.decoder.next_frame(), None)
+        self.decoder.feed(msg[-1:])
+        self.assertEqual(self.decoder.next_frame(), msg)
+
+    def test_unknown_prefix(self):
+        self.decoder.feed(bytearray.fromhex('02FF0102501CB58720F5F5212BF5'))
+        self.assertEqual(self.decoder.next_frame(),
+                         bytearray.fromhex('02501CB58720F5F5212BF5'))
+        self.assertEqual(self.decoder.stats['unknown_prefixes'], 1)
+
+    def test_busy_bytes_between_messages(self):
+        self.decoder.feed(bytearray.fromhex('0260') + bytes(6) +
+                          bytes([0x06]) + bytes([0x15]) * 5000 +
+                          bytearray.fromhex('0255'))
+        frames = list(bytes(frame) for frame in self.decoder.frames())
+        self.assertEqual(len(frames), 2)
+        self.assertEqual(frames[1], bytes.fromhex('0255'))
+        self.assertEqual(self.busy_count, 5000)
+
+    def test_frames_limit(self):
+        self.decoder.feed(bytearray.fromhex('0255') * 5)
+        self.assertEqual(len(list(self.decoder.frames(limit=3))), 3)
+        self.assertEqual(self.decoder.stats['frames'], 3)
+        self.assertEqual(len(self.decoder.buffer), 4)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+import unittest
+# append parent directory to import path
+import env
+# now we can import the lib module
+import insteon.insteon_device
+
+class MyTest(unittest.TestCase):
+    def setUp(self):
+        self.schema = {
+            0x2F: [
+                {'DevCat': 'all',
+                    'value': [
+                        {'SubCat': 'all',
+                            'value': [
+                                {'Firmware': 'all',
+                                    'value': [
+                                        {'Cmd2': (0x00,),
+                                            'value': 'aldb_entry'},
+                                        {'Cmd2': 'all',
+                                            'value': 'other'}
+                                    ]
+                                 }
+                            ]
+                         }
+                    ]
+                 },
+                {'DevCat': (0x02,),
+                    'value': [
+                        {'SubCat': 'all',
+                            'value': [
+                                {'Firmware': 'all',
+                                    'value': [
+                                        {'Cmd2': 'all',
+                                            'value': 'switch'}
+                                    ]
+                                 }
+                            ]
+                         }
+                    ]
+                 }
+            ]
+        }
+        self.cache = insteon.insteon_device.Handler_Cache(self.schema)
+
+    def test_resolve(self):
+        self.assertEqual(
+            self.cache.resolve(0x2F, 0x01, 0x20, 0x41, 0x00), 'aldb_entry')
+        self.assertEqual(
+            self.cache.resolve(0x2F, 0x01, 0x20, 0x41, 0x05), 'other')
+        self.assertEqual(
+            self.cache.resolve(0x2F, 0x02, 0x20, 0x41, 0x00), 'switch')
+        self.assertEqual(
+            self.cache.resolve(0x30, 0x01, 0x20, 0x41, 0x00), False)
+
+    def test_stats(self):
+        for i in range(3):
+            self.cache.resolve(0x2F, 0x01, 0x20, 0x41, 0x00)
+        self.cache.resolve(0x30, 0x01, 0x20, 0x41, 0x00)
+        self.cache.resolve(0x30, 0x01, 0x20, 0x41, 0x00)
+        stats = self.cache.stats
+        self.assertEqual(stats['misses'], 2)
+        self.assertEqual(stats['hits'], 3)
+        self.assertEqual(stats['size'], 2)
+
+    def test_max_size(self):
+        cache = insteon.insteon_device.Handler_Cache(self.schema, max_size=4)
+        for cmd_2 in range(10):
+            cache.resolve(0x2F, 0x01, 0x20, 0x41, cmd_2)
+        self.assertLessEqual(cache.stats['size'], 4)
+        self.assertEqual(cache.stats['clears'], 2)
+        self.assertEqual(
+            cache.resolve(0x2F, 0x01, 0x20, 0x41, 0x00), 'aldb_entry')
+
+if __name__ == '__main__':
+    unittest.main()
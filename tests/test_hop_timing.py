@@ -0,0 +1,76 @@
+import contextlib
+import io
+import select
+import time
+import unittest
+# append parent directory to import path
+import env
+# now we can import the lib module
+import insteon.plm
+from insteon.emulator import PLM_Emulator, Emulated_Device
+from insteon.hop_timing import Hop_Timing, HOP_WAIT, HOP_DEDUP, \
+    HOP_TIMING_MIN, HOP_DEDUP_MARGIN
+
+
+class MyTest(unittest.TestCase):
+    def test_defaults_until_measured(self):
+        timing = Hop_Timing()
+        self.assertEqual(timing.hop_wait('standard'), HOP_WAIT['standard'])
+        self.assertEqual(timing.dedup_window('extended'),
+                         HOP_DEDUP['extended'])
+
+    def test_fit(self):
+        timing = Hop_Timing()
+        for gap in (0.030, 0.031, 0.029, 0.030, 0.030, 0.031):
+            timing.add_gap('standard', gap)
+        # Gaps too long to be copies are ignored
+        timing.add_gap('standard', 5)
+        hop_wait = timing.hop_wait('standard')
+        self.assertGreater(hop_wait, 0.030)
+        self.assertLess(hop_wait, HOP_WAIT['standard'])
+        self.assertAlmostEqual(timing.dedup_window('standard'),
+                               hop_wait * HOP_DEDUP_MARGIN)
+        # The extended messages are learned separately
+        self.assertEqual(timing.hop_wait('extended'), HOP_WAIT['extended'])
+        for gap in (0.001,) * 8:
+            timing.add_gap('extended', gap)
+        self.assertEqual(timing.hop_wait('extended'), HOP_TIMING_MIN)
+        loaded = Hop_Timing()
+        loaded.load(timing.save())
+        for msg_length in HOP_WAIT:
+            self.assertEqual(loaded.hop_wait(msg_length),
+                             timing.hop_wait(msg_length))
+
+    def test_learned_from_copies(self):
+        device = Emulated_Device('1CB587', hops=1, duplicates=2)
+        hop_delay = {False: 0.030, True: 0.060}
+        emulator = PLM_Emulator(devices=[device], hop_delay=hop_delay,
+                                seed=1)
+        emulator.start()
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                plm = insteon.plm.PLM(None, device_id=emulator.plm_id,
+                                      attributes=emulator.plm_attributes())
+                plm_device = plm.get_device_by_addr('1CB587')
+                futures = [plm_device.send_command('on', '', {'cmd_2': i})
+                           for i in range(6)]
+                end = time.time() + 10
+                while (not all(future.done() for future in futures) and
+                        time.time() < end):
+                    select.select([plm.fileno()], [], [], 0.01)
+                    plm.process_input()
+                    plm.process_unacked_msg()
+                    plm.process_queue()
+            plm._serial.close()
+        finally:
+            emulator.stop()
+        stats = plm.hop_timing.stats['standard']
+        self.assertGreaterEqual(stats['samples'], 4)
+        self.assertAlmostEqual(stats['mean'], 0.030, delta=0.01)
+        self.assertLess(plm.hop_timing.hop_wait('standard'),
+                        HOP_WAIT['standard'])
+        self.assertEqual(plm.attribute('hop_timing'), plm.hop_timing.save())
+
+
+if __name__ == '__main__':
+    unittest.main()
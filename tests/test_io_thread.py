@@ -0,0 +1,85 @@
+import contextlib
+import io
+import os
+import threading
+import time
+import unittest
+# append parent directory to import path
+import env
+from fakes import open_pty
+# now we can import the lib module
+import insteon.plm
+from insteon.message import Message_Failed
+
+
+class MyTest(unittest.TestCase):
+    def setUp(self):
+        self.master, port = open_pty()
+        self.wakeup = threading.Event()
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.plm = insteon.plm.PLM(None, port=port,
+                                       device_id='20F5F5')
+            # Drop the aldb query queued at startup
+            self.plm.send_scheduler.next_device().pop_device_queue()
+            self.plm.remove_state_machine('query_aldb')
+        self.plm.start_io_thread(wakeup=self.wakeup.set)
+
+    def tearDown(self):
+        self.plm.stop_io_thread()
+        if self.master is not None:
+            os.close(self.master)
+
+    def run_plm(self, future, timeout=2):
+        end = time.time() + timeout
+        with contextlib.redirect_stdout(io.StringIO()):
+            while not future.done() and time.time() < end:
+                self.wakeup.wait(0.01)
+                self.wakeup.clear()
+                self.plm.process_input()
+                self.plm.process_unacked_msg()
+                self.plm.process_queue()
+
+    def test_write_and_ack(self):
+        with contextlib.redirect_stdout(io.StringIO()):
+            future = self.plm.send_command('plm_info')
+            self.plm.process_queue()
+        self.assertEqual(os.read(self.master, 100), bytes.fromhex('0260'))
+        os.write(self.master, bytes.fromhex('026020F5F503159B06'))
+        self.run_plm(future)
+        self.assertTrue(future.done())
+        self.assertEqual(self.plm.attribute('firmware'), 0x9B)
+        # The ack time is when the reader thread received it
+        self.assertEqual(future.msg.time_plm_ack,
+                         self.plm.io_thread.frame_time)
+        self.assertLess(future.msg.time_plm_ack, future._done_time)
+
+    def test_busy_before_frame(self):
+        os.write(self.master, bytes.fromhex('15') +
+                 bytes.fromhex('02501CB58720F5F5412B00'))
+        self.wakeup.wait(2)
+        time.sleep(0.05)
+        start = time.time()
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.plm.process_input()
+        # The busy byte backs off the pacer
+        self.assertEqual(self.plm.pacer.stats['busy'], 1)
+        self.assertFalse(self.plm.pacer.ready())
+        self.assertGreater(self.plm.pacer.next_send_time(), start)
+        stats = self.plm.input_stats
+        self.assertEqual(stats['busy_bytes'], 1)
+        self.assertEqual(stats['frames'], 1)
+        self.assertEqual(stats['backlog_frames'], 0)
+
+    def test_port_closed(self):
+        with contextlib.redirect_stdout(io.StringIO()):
+            future = self.plm.send_command('plm_info')
+        os.close(self.master)
+        self.master = None
+        self.assertTrue(self.wakeup.wait(2))
+        self.run_plm(future, timeout=5)
+        self.assertIsNotNone(self.plm.io_thread.error)
+        self.assertFalse(self.plm.port_active)
+        self.assertIsInstance(future.exception(), Message_Failed)
+
+if __name__ == '__main__':
+    unittest.main()
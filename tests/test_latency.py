@@ -0,0 +1,85 @@
+import contextlib
+import io
+import select
+import time
+import unittest
+# append parent directory to import path
+import env
+# now we can import the lib module
+import insteon.plm
+from insteon.emulator import PLM_Emulator, Emulated_Device
+from insteon.latency import Latency_Tracker, LATENCY_MIN_SAMPLES
+
+
+class MyTest(unittest.TestCase):
+    def test_default_until_measured(self):
+        tracker = Latency_Tracker(0.1, 5.0)
+        for i in range(LATENCY_MIN_SAMPLES - 1):
+            tracker.add(0.05)
+            self.assertEqual(tracker.timeout(1.3), 1.3)
+        tracker.add(0.05)
+        # Steady samples leave no deviation, the lower bound applies
+        self.assertAlmostEqual(tracker.timeout(1.3), 0.1)
+        self.assertEqual(tracker.percentile(0.5), 0.05)
+
+    def test_slow_and_varying(self):
+        tracker = Latency_Tracker(0.1, 5.0)
+        for sample in (1.5, 1.8, 1.4, 2.0, 1.6, 1.9):
+            tracker.add(sample)
+        timeout = tracker.timeout(1.3)
+        self.assertGreater(timeout, 2.0)
+        self.assertLessEqual(timeout, 5.0)
+        for i in range(20):
+            tracker.add(20)
+        self.assertEqual(tracker.timeout(1.3), 5.0)
+        self.assertEqual(tracker.stats['p90'], 20)
+
+    def test_save_and_load(self):
+        tracker = Latency_Tracker(0.1, 5.0)
+        for sample in (0.3, 0.4, 0.5, 0.4):
+            tracker.add(sample)
+        loaded = Latency_Tracker(0.1, 5.0)
+        loaded.load(tracker.save())
+        self.assertEqual(loaded.timeout(1.3), tracker.timeout(1.3))
+        empty = Latency_Tracker(0.1, 5.0)
+        empty.load(None)
+        self.assertEqual(empty.count, 0)
+
+    def test_measured_device_acks(self):
+        device = Emulated_Device('1CB587', ack_latency=0.01)
+        emulator = PLM_Emulator(devices=[device], seed=1)
+        emulator.start()
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                plm = insteon.plm.PLM(None, device_id=emulator.plm_id,
+                                      attributes=emulator.plm_attributes())
+                plm_device = plm.get_device_by_addr('1CB587')
+                # Identical acks close together are dropped as duplicates
+                futures = [plm_device.send_command('on', '', {'cmd_2': i})
+                           for i in range(6)]
+                end = time.time() + 10
+                while (not all(future.done() for future in futures) and
+                        time.time() < end):
+                    select.select([plm.fileno()], [], [], 0.01)
+                    plm.process_input()
+                    plm.process_unacked_msg()
+                    plm.process_queue()
+            plm._serial.close()
+        finally:
+            emulator.stop()
+        self.assertTrue(all(future.done() for future in futures))
+        tracker = plm_device.ack_latency['standard']
+        self.assertGreaterEqual(tracker.count, LATENCY_MIN_SAMPLES)
+        self.assertEqual(plm_device.ack_latency['extended'].count, 0)
+        self.assertGreaterEqual(plm.plm_ack_latency.count,
+                                LATENCY_MIN_SAMPLES)
+        # A responsive device is retried well before the fixed second
+        msg = futures[-1].msg
+        msg.insteon_msg.device_retry = 0
+        self.assertLess(plm._device_ack_delay(msg), 0.5)
+        self.assertEqual(plm_device.attribute('ack_latency')['standard'],
+                         tracker.save())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,49 @@
+import unittest
+# append parent directory to import path
+import env
+# now we can import the lib module
+from insteon.pacing import Send_Pacer, PACING_BACKOFF, PACING_RECOVERY
+
+
+class MyTest(unittest.TestCase):
+    def setUp(self):
+        self.pacer = Send_Pacer(max_rate=10.0, min_rate=1.0, burst=2)
+
+    def test_burst_then_rate(self):
+        now = self.pacer._time
+        self.assertTrue(self.pacer.ready(now))
+        self.pacer.sent(now)
+        self.pacer.sent(now)
+        self.assertFalse(self.pacer.ready(now))
+        self.assertAlmostEqual(self.pacer.next_send_time(now), now + 0.1)
+        self.assertTrue(self.pacer.ready(now + 0.11))
+
+    def test_backoff_and_recovery(self):
+        self.pacer.busy()
+        self.assertEqual(self.pacer.rate, 10.0 * PACING_BACKOFF)
+        self.assertFalse(self.pacer.ready())
+        self.pacer.nak()
+        self.assertEqual(self.pacer.rate, 10.0 * PACING_BACKOFF ** 2)
+        for i in range(10):
+            self.pacer.busy()
+        self.assertEqual(self.pacer.rate, 1.0)
+        self.pacer.ack()
+        self.assertEqual(self.pacer.rate, 1.0 + PACING_RECOVERY)
+        for i in range(100):
+            self.pacer.ack()
+        self.assertEqual(self.pacer.rate, 10.0)
+        stats = self.pacer.stats
+        self.assertEqual(stats['busy'], 11)
+        self.assertEqual(stats['naks'], 1)
+        self.assertEqual(stats['backoffs'], 12)
+        self.assertEqual(stats['lowest_rate'], 1.0)
+        self.assertEqual(stats['rate'], 10.0)
+
+    def test_refill(self):
+        self.pacer.busy()
+        self.pacer.refill()
+        self.assertTrue(self.pacer.ready())
+
+
+if __name__ == '__main__':
+    unittest.main()
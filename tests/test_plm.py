@@ -1,29 +1,102 @@
+import contextlib
+import io
+import time
 import unittest
 # append parent directory to import path
 import env
+from fakes import Fake_Port
 # now we can import the lib module
 import insteon.plm
+import insteon.base_objects
+from insteon.message import PLM_Message
+
+# A device ack, not matched to a sent message
+ACK_FRAME = bytes.fromhex('02501CB58720F5F52B1100')
+
 
 class MyTest(unittest.TestCase):
     def setUp(self):
-        self.PLM = insteon.plm.PLM('test_fixture', None)
-    
-    def test_advance_to_msg_start(self):
-        self.PLM._read_buffer = bytearray.fromhex('0002')
-        self.PLM._advance_to_msg_start()
-        self.assertEqual(self.PLM._read_buffer, bytes([0x02]))
-        self.PLM._read_buffer = bytearray.fromhex('1502')
-        self.PLM._advance_to_msg_start()
-        self.assertEqual(self.PLM._read_buffer, bytes([0x02]))
-
-    def test_parse_read_buffer(self):
-        self.PLM._read_buffer = bytearray.fromhex(
-            '02621CB587052BFB0602501CB58720F5F5212BF5')
-        #TODO test each msg type, test handling of extended messages on 0x62
-        self.assertEqual(self.PLM._parse_read_buffer(), 
-                         bytearray.fromhex('02621CB587052BFB06'))
-        self.assertEqual(self.PLM._parse_read_buffer(), 
-                         bytearray.fromhex('02501CB58720F5F5212BF5'))
-        
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.plm = insteon.plm.PLM(None, port='/nonexistent',
+                                       device_id='20F5F5')
+        self.plm.port_active = True
+        self.plm._serial = Fake_Port()
+
+    def process_input(self):
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.plm.process_input()
+        return self.plm.input_stats
+
+    def test_input_cap(self):
+        self.plm.msgs_per_pass = 4
+        self.plm._serial.data.extend(ACK_FRAME * 10 + ACK_FRAME[0:5])
+        stats = self.process_input()
+        self.assertEqual(stats['last_pass_frames'], 4)
+        self.assertEqual(stats['capped_passes'], 1)
+        self.assertEqual(stats['backlog_bytes'], 6 * 11 + 5)
+        self.assertTrue(self.plm._input_pending)
+        stats = self.process_input()
+        self.assertEqual(stats['capped_passes'], 2)
+        stats = self.process_input()
+        self.assertEqual(stats['last_pass_frames'], 2)
+        self.assertEqual(stats['max_pass_frames'], 4)
+        self.assertEqual(stats['capped_passes'], 2)
+        self.assertEqual(stats['total_frames'], 10)
+        # The partial message stays in the buffer
+        self.assertEqual(stats['backlog_bytes'], 5)
+        self.assertFalse(self.plm._input_pending)
+
+    def test_input_exactly_cap(self):
+        self.plm.msgs_per_pass = 4
+        self.plm._serial.data.extend(ACK_FRAME * 4)
+        stats = self.process_input()
+        self.assertEqual(stats['last_pass_frames'], 4)
+        self.assertEqual(stats['capped_passes'], 0)
+        self.assertEqual(stats['backlog_bytes'], 0)
+        self.assertFalse(self.plm._input_pending)
+
+    def test_incoming_read_only(self):
+        msg = PLM_Message(self.plm, raw_data=ACK_FRAME, is_incomming=True)
+        with self.assertRaises(TypeError):
+            msg._insert_byte_into_raw(0x13, 'cmd_1')
+        with self.assertRaises(TypeError):
+            msg._insert_bytes_into_raw({'cmd_2': 0xFF})
+        # raw_msg is a copy that can be changed freely
+        raw_msg = msg.raw_msg
+        raw_msg[9] = 0x13
+        self.assertEqual(msg.raw_view, ACK_FRAME)
+
+    def test_deadline_plm_ack(self):
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.plm.process_queue()
+        msg = self.plm._last_sent_msg
+        self.assertEqual(msg.plm_cmd_type, 'all_link_first_rec')
+        self.assertEqual(self.plm.next_deadline(), msg.time_sent + 0.075)
+
+    def test_deadline_state_machine(self):
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.plm.process_queue()
+        self.plm._last_sent_msg.plm_ack = True
+        self.assertEqual(
+            self.plm.next_deadline(),
+            self.plm.state_machine_expiry)
+        self.assertAlmostEqual(
+            self.plm.next_deadline(),
+            time.time() + insteon.base_objects.STATE_MACHINE_TIMEOUT,
+            delta=1)
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.plm.remove_state_machine('query_aldb')
+        self.assertEqual(self.plm.next_deadline(), None)
+
+    def test_deadline_wait_to_send(self):
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.plm.process_queue()
+        self.plm._last_sent_msg.plm_ack = True
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.plm.remove_state_machine('query_aldb')
+            self.plm.send_command('plm_info')
+        self.plm.wait_to_send = 0.5
+        self.assertEqual(self.plm.next_deadline(), self.plm.wait_to_send)
+
 if __name__ == '__main__':
-    unittest.main()
\ No newline at end of file
+    unittest.main()
@@ -0,0 +1,119 @@
+import contextlib
+import io
+import random
+import time
+import types
+import unittest
+# append parent directory to import path
+import env
+# now we can import the lib module
+import insteon.base_objects
+import insteon.scheduler
+from insteon.message import PRIORITY_INTERACTIVE, PRIORITY_NORMAL, \
+    PRIORITY_BACKGROUND
+
+class MyTest(unittest.TestCase):
+    def setUp(self):
+        self.scheduler = insteon.scheduler.Send_Scheduler()
+        self.plm = types.SimpleNamespace(send_scheduler=self.scheduler)
+        self.devices = []
+        for i in range(5):
+            device = insteon.base_objects.Base_Device(None, self.plm)
+            self.scheduler.add_device(device)
+            self.devices.append(device)
+        self.msg_time = 1000
+
+    def queue_msg(self, device, state='', priority=PRIORITY_NORMAL):
+        self.msg_time += 1
+        msg = types.SimpleNamespace(creation_time=self.msg_time,
+                                    time_sent=time.time(), priority=priority)
+        device._queue_device_msg(msg, state)
+        return msg
+
+    def scan_next_device(self):
+        '''The full scan that the scheduler replaced'''
+        msg_time = 0
+        sending_device = None
+        for device in self.devices:
+            dev_msg_time = device.next_msg_create_time()
+            if dev_msg_time and (msg_time == 0 or dev_msg_time < msg_time):
+                sending_device = device
+                msg_time = dev_msg_time
+        return sending_device
+
+    def test_oldest_message_first(self):
+        self.assertEqual(self.scheduler.next_device(), None)
+        self.queue_msg(self.devices[3])
+        self.queue_msg(self.devices[1])
+        self.assertIs(self.scheduler.next_device(), self.devices[3])
+        self.devices[3].pop_device_queue()
+        self.assertIs(self.scheduler.next_device(), self.devices[1])
+        self.devices[1].pop_device_queue()
+        self.assertEqual(self.scheduler.next_device(), None)
+
+    def test_priority_first(self):
+        self.queue_msg(self.devices[0], priority=PRIORITY_BACKGROUND)
+        self.queue_msg(self.devices[1])
+        self.queue_msg(self.devices[2], priority=PRIORITY_INTERACTIVE)
+        order = []
+        while self.scheduler.next_device() is not None:
+            device = self.scheduler.next_device()
+            order.append(device)
+            device.pop_device_queue()
+        self.assertEqual(order, [self.devices[2], self.devices[1],
+                                 self.devices[0]])
+
+    def test_state_machine_blocks_queue(self):
+        device = self.devices[0]
+        self.queue_msg(device, 'query_aldb')
+        self.queue_msg(device)
+        self.queue_msg(self.devices[1])
+        self.assertIs(self.scheduler.next_device(), device)
+        device.pop_device_queue()
+        # The default message waits until the state is finished
+        self.assertIs(self.scheduler.next_device(), self.devices[1])
+        self.devices[1].pop_device_queue()
+        self.assertEqual(self.scheduler.next_device(), None)
+        with contextlib.redirect_stdout(io.StringIO()):
+            device.remove_state_machine('query_aldb')
+        self.assertIs(self.scheduler.next_device(), device)
+
+    def test_state_machine_expires(self):
+        device = self.devices[0]
+        self.queue_msg(device, 'query_aldb')
+        self.queue_msg(device)
+        self.assertIs(self.scheduler.next_device(), device)
+        device.pop_device_queue()
+        device._state_machine_time = (
+            time.time() - insteon.base_objects.STATE_MACHINE_TIMEOUT + 0.05)
+        device._queue_changed()
+        self.assertEqual(self.scheduler.next_device(), None)
+        time.sleep(0.06)
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.assertIs(self.scheduler.next_device(), device)
+        self.assertEqual(device.state_machine, 'default')
+
+    def test_matches_scan(self):
+        rand = random.Random(7)
+        states = ['', '', '', 'query_aldb', 'set_aldb_delta']
+        with contextlib.redirect_stdout(io.StringIO()):
+            for i in range(2000):
+                device = rand.choice(self.devices)
+                action = rand.random()
+                if action < 0.5:
+                    self.queue_msg(device, rand.choice(states))
+                elif action < 0.8:
+                    next_device = self.scheduler.next_device()
+                    if next_device is not None:
+                        next_device.pop_device_queue()
+                elif action < 0.9:
+                    device.remove_state_machine(device.state_machine)
+                else:
+                    msg = device.pop_device_queue()
+                    if msg is not None:
+                        device._resend_msg(msg)
+                self.assertIs(self.scheduler.next_device(),
+                              self.scan_next_device())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,153 @@
+import atexit
+import concurrent.futures
+import contextlib
+import io
+import json
+import os
+import tempfile
+import time
+import unittest
+# append parent directory to import path
+import env
+# now we can import the lib module
+import insteon.shard
+from insteon.emulator import PLM_Emulator, Emulated_Device
+
+DEVICE_ATTRIBUTES = {'engine_version': 0x02,
+                     'dev_cat': 0x02,
+                     'sub_cat': 0x20,
+                     'firmware': 0x41,
+                     'aldb_delta': 0x05}
+
+
+class MyTest(unittest.TestCase):
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tempdir = tempfile.TemporaryDirectory()
+        os.chdir(self.tempdir.name)
+        # 3CB587 is only known to the PLMs once a test adds it
+        self.emulators = [
+            PLM_Emulator('20F5F5', devices=[
+                Emulated_Device('1CB587', aldb_delta=0x05, hops=1)]),
+            PLM_Emulator('20F5F6', devices=[
+                Emulated_Device('2AB587', aldb_delta=0x05, hops=1),
+                Emulated_Device('3CB587', dev_cat=0x01, hops=1)])]
+        self.core = insteon.shard.Sharded_Core()
+        with contextlib.redirect_stdout(io.StringIO()):
+            for emulator, address in zip(self.emulators,
+                                         ('1CB587', '2AB587')):
+                emulator.start()
+                self.core.add_plm(
+                    device_id=emulator.plm_id,
+                    attributes={'port': emulator.port,
+                                'Devices': {address: DEVICE_ATTRIBUTES}})
+
+    def tearDown(self):
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.core.close()
+        atexit.unregister(self.core.close)
+        for emulator in self.emulators:
+            emulator.stop()
+        os.chdir(self.cwd)
+        self.tempdir.cleanup()
+
+    def test_worker_processes(self):
+        plms = self.core.get_all_plms()
+        self.assertEqual([plm.dev_addr_str for plm in plms],
+                         ['20F5F5', '20F5F6'])
+        pids = set(plm.pid for plm in plms)
+        self.assertEqual(len(pids), 2)
+        self.assertNotIn(os.getpid(), pids)
+        for plm in plms:
+            self.assertTrue(plm.port_active)
+
+    def test_route_by_address(self):
+        futures = [self.core.send_command('1CB587', 'on'),
+                   self.core.send_command('2ab587', 'off')]
+        done, pending = concurrent.futures.wait(futures, 10)
+        self.assertEqual(len(pending), 0)
+        # The hops in the flags depend on the hop history, skip them
+        self.assertEqual(strip_flags(futures[0].result()),
+                         bytes.fromhex('02621CB58711FF'))
+        self.assertEqual(strip_flags(futures[0].ack_msg, 8),
+                         bytes.fromhex('02501CB58720F5F511FF'))
+        self.assertEqual(strip_flags(futures[1].ack_msg, 8),
+                         bytes.fromhex('02502AB58720F5F61300'))
+        # Each command was only sent by the plm that knows the device
+        device = self.emulators[0].get_device_by_addr('1CB587')
+        self.assertEqual(strip_flags(device.rcvd[-1]),
+                         bytes.fromhex('02621CB58711FF'))
+        device = self.emulators[1].get_device_by_addr('2AB587')
+        self.assertEqual(strip_flags(device.rcvd[-1]),
+                         bytes.fromhex('02622AB5871300'))
+        for emulator in self.emulators:
+            self.assertEqual(emulator.stats['unknown_devices'], 0)
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.assertIsNone(self.core.send_command('3CB587', 'on'))
+
+    def test_failed_command(self):
+        future = self.core.send_command('1CB587', 'not_a_command')
+        with self.assertRaises(insteon.shard.Command_Failed):
+            future.result(10)
+
+    def test_merged_view(self):
+        plm = self.core.get_plm_by_id('20F5F6')
+        device = plm.get_device_by_addr('2AB587')
+        self.assertEqual(device.attribute('dev_cat'), 0x02)
+        self.assertEqual(len(plm.get_all_devices()), 1)
+        plm.add_device('3cb587', attributes={'dev_cat': 0x01})
+        # The device is in the view once the worker reports its state
+        end = time.time() + 5
+        while len(plm.get_all_devices()) < 2 and time.time() < end:
+            time.sleep(0.05)
+        self.assertEqual(plm.get_device_by_addr('3CB587').attribute('dev_cat'),
+                         0x01)
+        future = self.core.send_command('3CB587', 'id_request')
+        self.assertEqual(strip_flags(future.result(10)),
+                         bytes.fromhex('02623CB5871000'))
+        self.assertEqual(self.core.get_plm_by_id('20F5F5').
+                         get_device_by_addr('1CB587').dev_addr_str, '1CB587')
+
+    def test_state_deltas(self):
+        plm = self.core.get_plm_by_id('20F5F5')
+        other = self.core.get_plm_by_id('20F5F6')
+        self.core.send_command('1CB587', 'on').result(10)
+        time.sleep(insteon.shard.STATE_INTERVAL * 2)
+        before = plm.stats
+        other_before = other.stats
+        future = self.core.send_command('1CB587', 'off')
+        future.result(10)
+        end = time.time() + 5
+        while plm.stats['deltas'] == before['deltas'] and time.time() < end:
+            time.sleep(0.05)
+        # Only the device the command went to was sent, no full state
+        stats = plm.stats
+        self.assertEqual(stats['states'], before['states'])
+        self.assertGreater(stats['deltas'], before['deltas'])
+        self.assertEqual(stats['devices_updated'] - before['devices_updated'],
+                         stats['deltas'] - before['deltas'])
+        self.assertEqual(other.stats, other_before)
+        self.assertIn('1CB587', plm.state['Devices'])
+        self.assertEqual(plm.attribute('port'), self.emulators[0].port)
+        # A full state is sent on request
+        plm.request_state()
+        while plm.stats['states'] == stats['states'] and time.time() < end:
+            time.sleep(0.05)
+        self.assertEqual(plm.stats['states'], stats['states'] + 1)
+
+    def test_close_saves_config(self):
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.core.close()
+        with open('config.json') as infile:
+            config = json.load(infile)
+        self.assertEqual(sorted(config['PLMs']), ['20F5F5', '20F5F6'])
+        self.assertIn('2AB587', config['PLMs']['20F5F6']['Devices'])
+        for plm in self.core.get_all_plms():
+            self.assertFalse(plm._process.is_alive())
+
+
+def strip_flags(msg, pos=5):
+    return msg[0:pos] + msg[pos + 1:]
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,134 @@
+import contextlib
+import io
+import os
+import socket
+import tempfile
+import threading
+import time
+import unittest
+# append parent directory to import path
+import env
+# now we can import the lib module
+import insteon.plm
+import insteon.transport
+
+# A device ack, not matched to a sent message
+ACK_FRAME = bytes.fromhex('02501CB58720F5F52B1100')
+
+
+class MyTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.listener = None
+        self.conn = None
+        self.plm = None
+
+    def tearDown(self):
+        if self.plm is not None:
+            self.plm.stop_io_thread()
+            self.plm._serial.close()
+        for sock in (self.conn, self.listener):
+            if sock is not None:
+                sock.close()
+        self.tempdir.cleanup()
+
+    def listen(self, family):
+        self.listener = socket.socket(family, socket.SOCK_STREAM)
+        if family == socket.AF_INET:
+            self.listener.bind(('127.0.0.1', 0))
+            port = 'tcp://127.0.0.1:%d' % self.listener.getsockname()[1]
+        else:
+            path = os.path.join(self.tempdir.name, 'plm.sock')
+            self.listener.bind(path)
+            port = 'unix://' + path
+        self.listener.listen(1)
+        return port
+
+    def open_plm(self, family):
+        port = self.listen(family)
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.plm = insteon.plm.PLM(None, port=port, device_id='20F5F5')
+        self.conn = self.listener.accept()[0]
+        self.conn.settimeout(2)
+
+    def run_plm(self):
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.plm.process_input()
+            self.plm.process_unacked_msg()
+            self.plm.process_queue()
+
+    def query_aldb(self):
+        '''Runs the aldb query queued at startup, the plm has no links'''
+        self.run_plm()
+        self.assertEqual(self.conn.recv(100), bytes.fromhex('0269'))
+        self.conn.sendall(bytes.fromhex('026915'))
+        end = time.time() + 2
+        while self.plm.state_pending('query_aldb') and time.time() < end:
+            time.sleep(0.01)
+            self.run_plm()
+        self.assertFalse(self.plm.state_pending('query_aldb'))
+
+    def test_tcp(self):
+        self.open_plm(socket.AF_INET)
+        self.assertTrue(self.plm.port_active)
+        self.assertIsInstance(self.plm._serial,
+                              insteon.transport.Socket_Transport)
+        self.query_aldb()
+
+    def test_unix(self):
+        self.open_plm(socket.AF_UNIX)
+        self.assertTrue(self.plm.port_active)
+        self.query_aldb()
+
+    def test_bulk_read(self):
+        self.open_plm(socket.AF_INET)
+        self.plm.msgs_per_pass = None
+        self.conn.sendall(ACK_FRAME * 500)
+        time.sleep(0.1)
+        self.run_plm()
+        stats = self.plm.input_stats
+        self.assertEqual(stats['last_pass_frames'], 500)
+        self.assertEqual(stats['backlog_bytes'], 0)
+
+    def test_io_thread(self):
+        self.open_plm(socket.AF_UNIX)
+        wakeup = threading.Event()
+        self.plm.start_io_thread(wakeup=wakeup.set)
+        self.query_aldb()
+        with contextlib.redirect_stdout(io.StringIO()):
+            future = self.plm.send_command('plm_info')
+        # Sent once the wait after the last message has passed
+        end = time.time() + 2
+        while not future.msg.time_sent and time.time() < end:
+            time.sleep(0.01)
+            self.run_plm()
+        self.assertEqual(self.conn.recv(100), bytes.fromhex('0260'))
+        self.conn.sendall(bytes.fromhex('026020F5F503159B06'))
+        end = time.time() + 2
+        while not future.done() and time.time() < end:
+            wakeup.wait(0.1)
+            wakeup.clear()
+            self.run_plm()
+        self.assertTrue(future.done())
+        self.assertEqual(self.plm.attribute('firmware'), 0x9B)
+
+    def test_connection_refused(self):
+        port = self.listen(socket.AF_INET)
+        self.listener.close()
+        self.listener = None
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            plm = insteon.plm.PLM(None, port=port, device_id='20F5F5')
+        self.assertFalse(plm.port_active)
+        self.assertIn('unable to connect to port', output.getvalue())
+
+    def test_closed_by_peer(self):
+        self.open_plm(socket.AF_INET)
+        self.conn.close()
+        self.conn = None
+        time.sleep(0.05)
+        with self.assertRaises(insteon.transport.Transport_Error):
+            self.plm._serial.inWaiting()
+
+if __name__ == '__main__':
+    unittest.main()